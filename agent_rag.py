@@ -5,16 +5,51 @@ https://github.com/microsoft/agent-framework
 
 import os
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from openai import AzureOpenAI
+from openai import AzureOpenAI, APITimeoutError
 from azure.search.documents import SearchClient
 from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob import BlobServiceClient
 import faiss
 import numpy as np
 
+from rate_limited_openai import create_openai_client
+from embedding_batches import embed_texts
+from tokenizer import count_tokens, truncate_to_tokens
+from request_deadline import (
+    Deadline,
+    DeadlineExceeded,
+    deadline_scope,
+    current_deadline,
+    degrade,
+    degraded_reasons,
+    submit_with_context,
+    timeout_kwargs,
+)
+
+
+def compact_tool_output(content: str, max_tokens: int) -> str:
+    """
+    ツール出力を抽出的に圧縮する
+    
+    空行区切りの各ブロック（検索結果1件ずつ）の先頭をトークン予算の均等割りで残し、
+    どの情報源も履歴から消えないようにする。
+    """
+    blocks = [block for block in content.split("\n\n") if block.strip()]
+    if not blocks:
+        return content
+    
+    per_block = max(1, max_tokens // len(blocks))
+    snippets = []
+    for block in blocks:
+        snippet = truncate_to_tokens(block, per_block)
+        snippets.append(snippet if snippet == block else f"{snippet}…")
+    return "\n\n".join(snippets)
+
 
 class DocumentStore:
     """ドキュメントのベクトルストア管理"""
@@ -25,23 +60,47 @@ class DocumentStore:
         self.documents: List[Dict[str, Any]] = []
         self.index: Optional[faiss.IndexFlatL2] = None
         self.dimension = 1536  # text-embedding-ada-002の次元数
+        self.logger = logging.getLogger(__name__)
+        
+        # バッチEmbedding設定（1リクエストあたりの件数・トークン上限と並列数）
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        self.embedding_batch_max_tokens = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+        self.embedding_max_workers = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+    
+    def _embed_texts(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """テキストをバッチ単位でEmbedding化（失敗したバッチのテキストはNone）"""
+        return embed_texts(
+            self.client,
+            self.embedding_deployment,
+            texts,
+            self.embedding_batch_size,
+            self.embedding_batch_max_tokens,
+            self.embedding_max_workers
+        )
+    
+    def add_documents(self, texts: List[str], metadata: Optional[List[Dict]] = None) -> List[int]:
+        """
+        ドキュメントを追加してインデックスを構築
         
-    def add_documents(self, texts: List[str], metadata: Optional[List[Dict]] = None):
-        """ドキュメントを追加してインデックスを構築"""
+        Embeddingに失敗したバッチがあっても成功分はインデックスに追加する。
+        
+        Returns:
+            Embeddingに失敗したテキストのインデックス（texts内の位置）
+        """
         if not texts:
-            return
-        
-        # Embeddingsを生成
-        embeddings = []
-        for text in texts:
-            response = self.client.embeddings.create(
-                input=text,
-                model=self.embedding_deployment
-            )
-            embeddings.append(response.data[0].embedding)
+            return []
+        
+        # Embeddingsを生成（バッチ単位）
+        embeddings = self._embed_texts(texts)
         
         # ドキュメント情報を保存
+        failed = []
+        new_embeddings = []
         for i, text in enumerate(texts):
+            if embeddings[i] is None:
+                failed.append(i)
+                continue
+            
             meta = metadata[i] if metadata and i < len(metadata) else {}
             self.documents.append({
                 "id": len(self.documents),
@@ -49,14 +108,22 @@ class DocumentStore:
                 "metadata": meta,
                 "embedding": embeddings[i]
             })
+            new_embeddings.append(embeddings[i])
         
-        # FAISSインデックスを構築
-        embeddings_array = np.array([doc["embedding"] for doc in self.documents]).astype('float32')
+        if failed:
+            self.logger.warning(f"Embedding失敗: {len(failed)}/{len(texts)}件")
+        
+        if not new_embeddings:
+            return failed
+        
+        # 新しいベクトルだけをFAISSインデックスに追加
+        embeddings_array = np.array(new_embeddings).astype('float32')
         
         if self.index is None:
             self.index = faiss.IndexFlatL2(self.dimension)
         
         self.index.add(embeddings_array)
+        return failed
         
     def search(self, query: str, k: int = 3) -> List[Dict[str, Any]]:
         """クエリに対して類似ドキュメントを検索"""
@@ -81,6 +148,10 @@ class DocumentStore:
         return results
 
 
+class ToolError(Exception):
+    """ツールの実行に失敗した（メッセージはそのままツールの結果としてモデルに返す）"""
+
+
 class AgentTool:
     """エージェントが使用するツールの基底クラス"""
     
@@ -89,7 +160,7 @@ class AgentTool:
         self.description = description
     
     def execute(self, *args, **kwargs) -> str:
-        """ツールを実行"""
+        """ツールを実行（失敗した場合は結果の文字列を返さずToolErrorを送出する）"""
         raise NotImplementedError
     
     def to_function_definition(self) -> Dict[str, Any]:
@@ -153,13 +224,14 @@ class AzureSearchTool(AgentTool):
     def execute(self, query: str) -> str:
         """Azure AI Searchで検索"""
         if not self.search_client:
-            return "Azure AI Searchが設定されていません。"
+            raise ToolError("Azure AI Searchが設定されていません。")
         
         try:
             results = self.search_client.search(
                 search_text=query,
                 top=3,
-                include_total_count=True
+                include_total_count=True,
+                **timeout_kwargs()
             )
             
             search_results = []
@@ -172,7 +244,7 @@ class AzureSearchTool(AgentTool):
             
             return "\n\n".join(search_results)
         except Exception as e:
-            return f"Azure Search検索中にエラーが発生: {str(e)}"
+            raise ToolError(f"Azure Search検索中にエラーが発生: {str(e)}") from e
     
     def to_function_definition(self) -> Dict[str, Any]:
         return {
@@ -194,9 +266,57 @@ class AzureSearchTool(AgentTool):
         }
 
 
+class ToolResultMemo:
+    """
+    エージェント1回の実行内で使うツール結果のメモ
+    
+    キーはツール名と正規化した引数（文字列は前後の空白除去・連続空白の圧縮・大文字小文字の同一視）。
+    """
+    
+    def __init__(self):
+        self._results: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _normalize(value: Any) -> Any:
+        if isinstance(value, str):
+            return " ".join(value.split()).casefold()
+        if isinstance(value, dict):
+            return {k: ToolResultMemo._normalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [ToolResultMemo._normalize(v) for v in value]
+        return value
+    
+    def key(self, tool_name: str, arguments: Dict[str, Any]) -> str:
+        normalized = json.dumps(self._normalize(arguments), sort_keys=True, ensure_ascii=False)
+        return f"{tool_name}:{normalized}"
+    
+    def get(self, key: str) -> Optional[str]:
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+    
+    def put(self, key: str, result: str):
+        self._results[key] = result
+    
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._results)
+        }
+
+
 class MicrosoftAgent:
     """Microsoft Agent Framework を使用したエージェント"""
     
+    # 回答生成が時間切れになった場合に返すツール出力の最大トークン数
+    FALLBACK_ANSWER_TOKENS = 1000
+    
     def __init__(
         self,
         openai_client: AzureOpenAI,
@@ -212,21 +332,176 @@ class MicrosoftAgent:
         
         # ツールマップを作成
         self.tool_map = {tool.name: tool for tool in tools}
+        
+        # 履歴の圧縮設定（しきい値を超えたら古いツール出力を要約版に置き換える）
+        self.history_max_tokens = int(os.getenv("AGENT_HISTORY_MAX_TOKENS", "6000"))
+        self.compacted_tool_tokens = int(os.getenv("AGENT_COMPACTED_TOOL_TOKENS", "200"))
+        
+        # 1ターン内の複数ツール呼び出しの並列実行設定
+        self.tool_timeout = float(os.getenv("AGENT_TOOL_TIMEOUT_SECONDS", "30"))
+        # リクエストの期限のうち最終回答の生成に残しておく時間
+        self.answer_reserve = float(os.getenv("AGENT_ANSWER_RESERVE_SECONDS", "15"))
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "4")),
+            thread_name_prefix="agent-tool"
+        )
     
-    def _execute_tool(self, tool_name: str, arguments: Dict[str, Any]) -> str:
-        """ツールを実行"""
+    def _execute_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Tuple[str, bool]:
+        """ツールを実行し、結果と成功可否を返す"""
         if tool_name not in self.tool_map:
-            return f"ツール '{tool_name}' が見つかりません。"
+            return f"ツール '{tool_name}' が見つかりません。", False
         
         tool = self.tool_map[tool_name]
         try:
-            return tool.execute(**arguments)
+            return tool.execute(**arguments), True
+        except ToolError as e:
+            self.logger.warning(f"ツール実行失敗 ({tool_name}): {str(e)}")
+            return str(e), False
         except Exception as e:
             self.logger.error(f"ツール実行エラー ({tool_name}): {str(e)}")
-            return f"ツール実行中にエラーが発生しました: {str(e)}"
+            return f"ツール実行中にエラーが発生しました: {str(e)}", False
+    
+    def _execute_tool_calls(self, tool_calls: List[Any], memo: "ToolResultMemo") -> List[str]:
+        """
+        1ターン分のツール呼び出しを並列実行し、呼び出し順に結果を返す
+        
+        同じツール・同じ引数（正規化後）の呼び出しは実行済みの結果を再利用し、
+        同一ターン内の重複も1回だけ実行する。
+        ツール全体の所要時間は最も遅いツールで決まり、
+        タイムアウト（リクエストの期限が近ければ残り時間に合わせて短くする）した
+        ツールはエラー文字列を結果とする。
+        """
+        started = time.monotonic()
+        budget = self._tool_budget()
+        responses: List[Optional[str]] = [None] * len(tool_calls)
+        pending: Dict[str, Tuple[str, Any, List[int]]] = {}
+        
+        for i, tool_call in enumerate(tool_calls):
+            function_name = tool_call.function.name
+            try:
+                function_args = json.loads(tool_call.function.arguments or "{}")
+            except json.JSONDecodeError as e:
+                self.logger.warning(f"ツール引数の解析エラー ({function_name}): {str(e)}")
+                responses[i] = f"ツール引数が不正です: {str(e)}"
+                continue
+            
+            key = memo.key(function_name, function_args)
+            if key in pending:
+                memo.hits += 1
+                pending[key][2].append(i)
+                continue
+            
+            cached = memo.get(key)
+            if cached is not None:
+                self.logger.info(f"ツール結果を再利用: {function_name}({function_args})")
+                responses[i] = cached
+            else:
+                self.logger.info(f"ツール呼び出し: {function_name}({function_args})")
+                future = submit_with_context(self._executor, self._execute_tool, function_name, function_args)
+                pending[key] = (function_name, future, [i])
+        
+        for key, (function_name, future, indices) in pending.items():
+            remaining = budget - (time.monotonic() - started)
+            try:
+                content, ok = future.result(timeout=max(0.0, remaining))
+            except FutureTimeoutError:
+                future.cancel()
+                self.logger.warning(f"ツールがタイムアウトしました: {function_name} ({budget:.1f}秒)")
+                degrade(f"tool_timeout:{function_name}")
+                content, ok = f"ツールがタイムアウトしました（{budget:.1f}秒）", False
+            
+            # 成功した結果だけを保存する（失敗は次のターンで再試行できるようにする）
+            if ok:
+                memo.put(key, content)
+            for i in indices:
+                responses[i] = content
+        
+        return responses
+    
+    def _tool_budget(self) -> float:
+        """ツール実行に使える時間（リクエストの残り時間から回答生成分を除いた時間とtool_timeoutの小さい方）"""
+        deadline = current_deadline()
+        if deadline is None:
+            return self.tool_timeout
+        return max(0.0, min(self.tool_timeout, deadline.remaining() - self.answer_reserve))
+    
+    def _evidence_answer(self, messages: List[Dict[str, Any]]) -> Optional[str]:
+        """LLMで回答する時間がない場合の回答（新しいツール出力から順に抜粋、ツール出力がなければNone）"""
+        evidence = [message["content"] for message in reversed(messages) if message["role"] == "tool"]
+        if not evidence:
+            return None
+        excerpt = compact_tool_output("\n\n".join(evidence), self.FALLBACK_ANSWER_TOKENS)
+        return f"時間内に回答を生成できなかったため、見つかった関連情報を示します。\n\n{excerpt}"
+    
+    @staticmethod
+    def _message_tokens(message: Dict[str, Any]) -> int:
+        """メッセージ1件のトークン数（ツール呼び出しの引数を含む）"""
+        tokens = count_tokens(message.get("content") or "")
+        for tool_call in message.get("tool_calls") or []:
+            tokens += count_tokens(tool_call["function"]["arguments"] or "")
+        return tokens
+    
+    def _compact_history(self, messages: List[Dict[str, Any]], compacted: set) -> int:
+        """
+        履歴がしきい値を超えていれば、古いツール出力から順に圧縮する
+        
+        直前のターンのツール出力はモデルがまだ参照するため圧縮しない。
+        
+        Returns:
+            圧縮後の履歴のトークン数
+        """
+        total = sum(self._message_tokens(message) for message in messages)
+        if total <= self.history_max_tokens:
+            return total
+        
+        # 直前のアシスタントメッセージ以降（最新ターンのツール出力）は対象外
+        last_assistant = max(
+            (i for i, message in enumerate(messages) if message["role"] == "assistant"),
+            default=len(messages)
+        )
+        for i in range(last_assistant):
+            message = messages[i]
+            if message["role"] != "tool" or i in compacted:
+                continue
+            
+            before = self._message_tokens(message)
+            message["content"] = compact_tool_output(message["content"], self.compacted_tool_tokens)
+            compacted.add(i)
+            total -= before - self._message_tokens(message)
+            if total <= self.history_max_tokens:
+                break
+        
+        return total
+    
+    @staticmethod
+    def _run_result(
+        success: bool,
+        iteration: int,
+        memo: ToolResultMemo,
+        token_usage: List[Dict[str, Any]],
+        **fields
+    ) -> Dict[str, Any]:
+        """実行結果（回答またはエラーと実行の統計）"""
+        return {
+            "success": success,
+            **fields,
+            "iterations": iteration,
+            "tool_cache": memo.stats(),
+            "token_usage": token_usage,
+            "degraded": degraded_reasons()
+        }
     
     def run(self, user_message: str, max_iterations: int = 5) -> Dict[str, Any]:
-        """エージェントを実行"""
+        """
+        エージェントを実行
+        
+        リクエストの期限（未設定なら REQUEST_DEADLINE_SECONDS）の中で処理し、
+        期限が迫ったらツールを呼ばずにそれまでの検索結果で回答する。
+        """
+        with deadline_scope() as deadline:
+            return self._run(user_message, max_iterations, deadline)
+    
+    def _run(self, user_message: str, max_iterations: int, deadline: Deadline) -> Dict[str, Any]:
         messages = [
             {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": user_message}
@@ -237,28 +512,56 @@ class MicrosoftAgent:
         
         iteration = 0
         
+        # 実行中のツール結果メモ（同じ検索の繰り返しを省く）
+        memo = ToolResultMemo()
+        
+        # イテレーションごとのプロンプトトークン数と圧縮済みツール出力の位置
+        token_usage: List[Dict[str, Any]] = []
+        compacted: set = set()
+        
         try:
             while iteration < max_iterations:
                 iteration += 1
                 
-                # OpenAI APIを呼び出し
-                response = self.client.chat.completions.create(
-                    model=self.deployment_name,
-                    messages=messages,
-                    tools=tool_definitions if tool_definitions else None,
-                    tool_choice="auto" if tool_definitions else None,
-                    temperature=0.7
-                )
+                # 期限が迫っていれば、これ以上ツールを呼ばせずに集めた情報で回答させる
+                final_turn = iteration > 1 and deadline.remaining() < self.answer_reserve
+                if final_turn:
+                    self.logger.warning(f"期限が近いため検索を打ち切って回答します（残り{deadline.remaining():.1f}秒）")
+                    degrade("early_answer")
+                
+                # 履歴の肥大化で後半のターンほど遅くならないよう古いツール出力を圧縮
+                history_tokens = self._compact_history(messages, compacted)
+                
+                # OpenAI APIを呼び出し（タイムアウトはリクエストの残り時間）
+                try:
+                    response = self.client.chat.completions.create(
+                        model=self.deployment_name,
+                        messages=messages,
+                        tools=tool_definitions if tool_definitions else None,
+                        tool_choice=("none" if final_turn else "auto") if tool_definitions else None,
+                        temperature=0.7
+                    )
+                except (DeadlineExceeded, APITimeoutError) as e:
+                    answer = self._evidence_answer(messages)
+                    if answer is None:
+                        raise
+                    self.logger.warning(f"回答生成が時間切れのため検索結果を返します: {str(e)}")
+                    degrade("answer_fallback")
+                    return self._run_result(True, iteration, memo, token_usage, answer=answer)
                 
                 assistant_message = response.choices[0].message
                 
+                usage = getattr(response, "usage", None)
+                token_usage.append({
+                    "iteration": iteration,
+                    "history_tokens": history_tokens,
+                    "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                    "compacted_messages": len(compacted)
+                })
+                
                 # ツール呼び出しがない場合は終了
                 if not assistant_message.tool_calls:
-                    return {
-                        "success": True,
-                        "answer": assistant_message.content,
-                        "iterations": iteration
-                    }
+                    return self._run_result(True, iteration, memo, token_usage, answer=assistant_message.content)
                 
                 # アシスタントメッセージを履歴に追加
                 messages.append({
@@ -277,17 +580,11 @@ class MicrosoftAgent:
                     ]
                 })
                 
-                # 各ツール呼び出しを実行
-                for tool_call in assistant_message.tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    
-                    self.logger.info(f"ツール呼び出し: {function_name}({function_args})")
-                    
-                    # ツールを実行
-                    function_response = self._execute_tool(function_name, function_args)
-                    
-                    # ツール実行結果を履歴に追加
+                # 各ツール呼び出しを並列実行し、呼び出し順に履歴へ追加
+                for tool_call, function_response in zip(
+                    assistant_message.tool_calls,
+                    self._execute_tool_calls(assistant_message.tool_calls, memo)
+                ):
                     messages.append({
                         "role": "tool",
                         "tool_call_id": tool_call.id,
@@ -295,19 +592,11 @@ class MicrosoftAgent:
                     })
             
             # 最大イテレーション到達
-            return {
-                "success": False,
-                "error": "最大イテレーション数に到達しました",
-                "iterations": iteration
-            }
+            return self._run_result(False, iteration, memo, token_usage, error="最大イテレーション数に到達しました")
             
         except Exception as e:
             self.logger.error(f"エージェント実行エラー: {str(e)}", exc_info=True)
-            return {
-                "success": False,
-                "error": str(e),
-                "iterations": iteration
-            }
+            return self._run_result(False, iteration, memo, token_usage, error=str(e))
 
 
 class AzureAgentRAG:
@@ -316,12 +605,8 @@ class AzureAgentRAG:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         
-        # Azure OpenAI クライアント
-        self.openai_client = AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-        )
+        # Azure OpenAI クライアント（クォータに合わせた流量制御・429の再試行付き）
+        self.openai_client = create_openai_client()
         
         self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4")
         self.embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002")
@@ -387,7 +672,13 @@ class AzureAgentRAG:
     def load_documents_from_texts(self, texts: List[str], metadata: Optional[List[Dict]] = None) -> bool:
         """テキストからドキュメントをロード"""
         try:
-            self.document_store.add_documents(texts, metadata)
+            failed = self.document_store.add_documents(texts, metadata)
+            if failed:
+                self.logger.error(
+                    f"{len(texts) - len(failed)}/{len(texts)}個のドキュメントをロードしました"
+                    f"（失敗: {failed}）"
+                )
+                return False
             self.logger.info(f"{len(texts)}個のドキュメントをロードしました")
             return True
         except Exception as e:
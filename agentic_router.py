@@ -4,21 +4,70 @@ Router Agent パターン - 真のエージェンティックRAG実装
 """
 
 import os
+import asyncio
+import bisect
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable, AsyncIterator
 import json
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
 from enum import Enum
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI, APITimeoutError
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from azure.storage.blob import BlobServiceClient
 import faiss
 import numpy as np
 
+from rate_limited_openai import create_openai_client, create_async_openai_client, stream_usage_options
+from embedding_batches import embed_texts
+from tokenizer import count_tokens, truncate_to_tokens, split_to_tokens
+from request_deadline import (
+    DeadlineExceeded,
+    deadline_scope,
+    current_deadline,
+    degrade,
+    degraded_reasons,
+    remaining_seconds,
+    submit_with_context,
+    timeout_kwargs,
+)
+
 
 logger = logging.getLogger(__name__)
 
+# インデックススナップショットの形式バージョン（互換性のない変更時に上げる）
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILES = ["manifest.json", "documents.json", "vectors.npy", "index.faiss"]
+# 置き換え中の以前のスナップショットの退避先（保存先 + この接尾辞）
+SNAPSHOT_PREVIOUS_SUFFIX = ".previous"
+# 意図分類の学習済み重心（スナップショットに同梱、以前のスナップショットにはない）
+INTENT_CENTROIDS_FILE = "intent_centroids.npz"
+
+# FAISSインデックス種別
+INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+# 元のベクトルを復元できない（量子化で失われる）インデックス種別
+LOSSY_INDEX_TYPES = ["ivf_pq"]
+# IVF系インデックスの学習に必要な最小ベクトル数（これ未満ではFlatのまま）
+IVF_MIN_TRAIN_SIZE = 1000
+IVF_PQ_MIN_TRAIN_SIZE = 10000
+
+# レイテンシヒストグラムのバケット上限（ミリ秒、1ms〜約110秒を1.25倍刻み）
+LATENCY_BUCKETS_MS = [1.25 ** i for i in range(53)]
+
 
 class QueryIntent(Enum):
     """質問の意図タイプ"""
@@ -31,93 +80,1019 @@ class QueryIntent(Enum):
     UNKNOWN = "unknown"
 
 
+def normalize_query(text: str) -> str:
+    """キャッシュキー用にクエリを正規化（全角半角の統一・空白の整理）"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class StageTimings:
+    """
+    1リクエスト内の処理段階ごとの所要時間（ミリ秒）
+    
+    ツールは並列に実行されるため、各段階の合計は全体の所要時間（total）と一致しない。
+    同じ段階を複数回計測した場合は合算する。
+    """
+    
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def measure(self, stage: str):
+        """with文のブロックの所要時間をstageとして記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, (time.perf_counter() - started) * 1000)
+    
+    def add(self, stage: str, elapsed_ms: float):
+        with self._lock:
+            self._stages[stage] = self._stages.get(stage, 0.0) + elapsed_ms
+    
+    def finish(self) -> Dict[str, float]:
+        """リクエスト開始からの経過時間をtotalとして加え、各段階の所要時間を返す"""
+        with self._lock:
+            stages = dict(self._stages)
+        stages["total"] = (time.perf_counter() - self._started) * 1000
+        return {stage: round(elapsed, 2) for stage, elapsed in stages.items()}
+
+
+class LatencyHistogram:
+    """
+    対数間隔のバケットで所要時間を集計するヒストグラム
+    
+    サンプル数に関わらずメモリ使用量は一定。
+    パーセンタイルはバケット内を線形補間して求める（誤差はバケット幅の範囲内）。
+    """
+    
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)  # 最後は上限超え
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+    
+    def record(self, elapsed_ms: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.sum_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+    
+    def percentile(self, p: float) -> float:
+        """pパーセンタイル（0〜100）の推定値（ミリ秒）"""
+        if self.count == 0:
+            return 0.0
+        
+        rank = p / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = LATENCY_BUCKETS_MS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+                estimate = lower + (upper - lower) * (rank - cumulative) / count
+                return min(estimate, self.max_ms)
+            cumulative += count
+        return self.max_ms
+    
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 2),
+            "p95_ms": round(self.percentile(95), 2),
+            "p99_ms": round(self.percentile(99), 2),
+            "max_ms": round(self.max_ms, 2)
+        }
+
+
+class RouterMetrics:
+    """リクエストごとの段階別所要時間を意図別・ツール別のヒストグラムに集計"""
+    
+    def __init__(self):
+        self._intents: Dict[str, Dict[str, LatencyHistogram]] = {}
+        self._tools: Dict[str, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+    
+    def record(self, intent: str, timings: Dict[str, float]):
+        """1リクエスト分の段階別所要時間を記録（tool.<name>はツール別にも集計）"""
+        with self._lock:
+            stages = self._intents.setdefault(intent, {})
+            for stage, elapsed_ms in timings.items():
+                stages.setdefault(stage, LatencyHistogram()).record(elapsed_ms)
+                if stage.startswith("tool."):
+                    self._tools.setdefault(stage[len("tool."):], LatencyHistogram()).record(elapsed_ms)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """意図別（段階ごと）とツール別のパーセンタイル"""
+        with self._lock:
+            return {
+                "intents": {
+                    intent: {stage: histogram.summary() for stage, histogram in stages.items()}
+                    for intent, stages in self._intents.items()
+                },
+                "tools": {tool: histogram.summary() for tool, histogram in self._tools.items()}
+            }
+
+
+class EmbeddingCache:
+    """
+    クエリEmbeddingのLRU/TTLキャッシュ
+    
+    キーは（Embeddingデプロイ名, 正規化したクエリ）。件数とメモリ量の両方で上限を設ける。
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float, max_bytes: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, deployment: str, query: str) -> Optional[np.ndarray]:
+        """キャッシュ済みのEmbeddingを取得（期限切れ・未登録ならNone）"""
+        key = (deployment, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, deployment: str, query: str, vector: np.ndarray):
+        """Embeddingを登録（上限を超えたら古いものから削除）"""
+        if self.max_entries <= 0 or vector.nbytes > self.max_bytes:
+            return
+        
+        vector.setflags(write=False)
+        key = (deployment, normalize_query(query))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), vector)
+            self._bytes += vector.nbytes
+            
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def _remove(self, key: Tuple[str, str]):
+        """エントリを削除（ロック内で呼び出す）"""
+        _, vector = self._entries.pop(key)
+        self._bytes -= vector.nbytes
+    
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率などの統計情報"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+class StoredDocument:
+    """ストア内のドキュメント（ベクトルはDocumentStore側の配列で一括保持）"""
+    
+    __slots__ = ("id", "content", "metadata")
+    
+    def __init__(self, id: int, content: str, metadata: Dict[str, Any]):
+        self.id = id
+        self.content = content
+        self.metadata = metadata
+
+
+class ReadWriteLock:
+    """
+    読み取りは同時に、書き込みは単独で行うためのロック
+    
+    書き込み待ちがある間は新しい読み取りを待たせ、書き込みが待たされ続けないようにする。
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+    
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+def resolve_snapshot_dir(path: str) -> str:
+    """
+    読み込むスナップショットのディレクトリ
+    
+    保存の途中で停止して path がない場合は、退避された以前のスナップショットを使う。
+    """
+    previous = path + SNAPSHOT_PREVIOUS_SUFFIX
+    if not os.path.exists(os.path.join(path, "manifest.json")) and os.path.exists(os.path.join(previous, "manifest.json")):
+        return previous
+    return path
+
+
 class DocumentStore:
     """ドキュメントのベクトルストア管理（FAISSベース）"""
     
-    def __init__(self, openai_client: AzureOpenAI, embedding_deployment: str):
+    def __init__(
+        self,
+        openai_client: AzureOpenAI,
+        embedding_deployment: str,
+        async_client: Optional[AsyncAzureOpenAI] = None
+    ):
         self.client = openai_client
+        self.async_client = async_client  # クエリEmbeddingの非同期取得用（オプション）
         self.embedding_deployment = embedding_deployment
-        self.documents: List[Dict[str, Any]] = []
-        self.index: Optional[faiss.IndexFlatL2] = None
+        self.documents: List[StoredDocument] = []
+        self.index: Optional[faiss.Index] = None
+        self.index_type = "flat"  # 現在のインデックスの種別
+        self.trained_size = 0  # IVF系インデックスの学習時のベクトル数（IVF以外は0）
         self.dimension = 1536
+        self.version = 0  # ドキュメント内容が変わるたびに増える（回答キャッシュの無効化に使用）
+        
+        # 再構築用のベクトルは通常FAISSインデックスから復元する。
+        # 復元できない種別（IVF-PQ）の間だけ、全ドキュメントのベクトルを連続配列で別に保持する（float16で半分のメモリ）
+        self.vector_dtype = np.dtype(os.getenv("ROUTER_VECTOR_DTYPE", "float32"))
+        if self.vector_dtype not in (np.float32, np.float16):
+            raise ValueError(f"Unsupported vector dtype: {self.vector_dtype} (expected float32 or float16)")
+        self._vectors: Optional[np.ndarray] = None
+        
+        # バッチEmbedding設定（1リクエストあたりの件数・トークン上限と並列数）
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        self.embedding_batch_max_tokens = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+        self.embedding_max_workers = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+        
+        # クエリEmbeddingキャッシュ（ROUTER_QUERY_CACHE_SIZE=0で無効）
+        self.query_cache = EmbeddingCache(
+            max_entries=int(os.getenv("ROUTER_QUERY_CACHE_SIZE", "10000")),
+            ttl_seconds=float(os.getenv("ROUTER_QUERY_CACHE_TTL_SECONDS", "3600")),
+            max_bytes=int(float(os.getenv("ROUTER_QUERY_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        )
+        
+        # インデックス種別の設定
+        # auto: コーパスがしきい値を超えたらANN（ROUTER_ANN_INDEX_TYPE）に切り替える
+        self.index_type_setting = os.getenv("ROUTER_INDEX_TYPE", "auto").lower()
+        self.ann_index_type = os.getenv("ROUTER_ANN_INDEX_TYPE", "hnsw").lower()
+        self.ann_threshold = int(os.getenv("ROUTER_ANN_THRESHOLD", "100000"))
+        self.ivf_nlist = int(os.getenv("ROUTER_IVF_NLIST", "0"))  # 0はコーパスサイズから自動決定
+        self.ivf_nprobe = int(os.getenv("ROUTER_IVF_NPROBE", "16"))
+        # 学習時の何倍までドキュメントが増えたらIVFを学習し直すか（0で再学習しない）
+        self.ivf_retrain_factor = float(os.getenv("ROUTER_IVF_RETRAIN_FACTOR", "4"))
+        self.pq_m = int(os.getenv("ROUTER_PQ_M", "64"))
+        self.hnsw_m = int(os.getenv("ROUTER_HNSW_M", "32"))
+        self.hnsw_ef_construction = int(os.getenv("ROUTER_HNSW_EF_CONSTRUCTION", "64"))
+        self.hnsw_ef_search = int(os.getenv("ROUTER_HNSW_EF_SEARCH", "64"))
+        self.train_sample_size = int(os.getenv("ROUTER_TRAIN_SAMPLE_SIZE", "100000"))
+        
+        for index_type in (self.index_type_setting, self.ann_index_type):
+            if index_type != "auto" and index_type not in INDEX_TYPES:
+                raise ValueError(f"Unknown index type: {index_type} (expected one of {INDEX_TYPES})")
+        
+        # ドキュメント・インデックスの参照の更新と読み出しの排他制御
+        self._lock = threading.Lock()
+        # インデックスへの追記（書き込み）と検索（読み取り）の排他制御。検索同士は並行して行える
+        self._index_lock = ReadWriteLock()
+        # 再構築は同時に1つだけ
+        self._rebuild_lock = threading.Lock()
+        self._rebuild_thread: Optional[threading.Thread] = None
+    
+    def _embed_texts(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """テキストをバッチ単位でEmbedding化（失敗したバッチのテキストはNone）"""
+        return embed_texts(
+            self.client,
+            self.embedding_deployment,
+            texts,
+            self.embedding_batch_size,
+            self.embedding_batch_max_tokens,
+            self.embedding_max_workers
+        )
+    
+    def _target_index_type(self, n: int) -> str:
+        """コーパスサイズに応じて使用すべきインデックス種別を決定"""
+        index_type = self.index_type_setting
+        if index_type == "auto":
+            index_type = self.ann_index_type if n >= self.ann_threshold else "flat"
+        
+        # 学習データが足りないうちは厳密検索で代用
+        if index_type == "ivf_flat" and n < IVF_MIN_TRAIN_SIZE:
+            return "flat"
+        if index_type == "ivf_pq" and n < IVF_PQ_MIN_TRAIN_SIZE:
+            return "flat"
+        return index_type
+    
+    def _needs_rebuild(self, n: int) -> bool:
+        """
+        インデックスの作り直しが必要か。ロック内で呼び出す
+        
+        コーパスサイズで種別が変わる場合に加え、IVF系は学習時の ivf_retrain_factor 倍まで
+        増えたら学習し直す（リスト数が小さいままだと1リストが長くなり、検索が遅くなるため）。
+        """
+        if self._target_index_type(n) != self.index_type:
+            return True
+        return (
+            self.index_type in ("ivf_flat", "ivf_pq")
+            and self.ivf_retrain_factor > 0
+            and self.trained_size > 0
+            and n >= self.trained_size * self.ivf_retrain_factor
+        )
+    
+    def _create_index(self, index_type: str, n: int) -> faiss.Index:
+        """インデックス種別に応じた空のFAISSインデックスを作成"""
+        if index_type == "flat":
+            return faiss.IndexFlatL2(self.dimension)
+        
+        if index_type == "hnsw":
+            index = faiss.index_factory(self.dimension, f"HNSW{self.hnsw_m},Flat")
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+            return index
+        
+        # IVF: リスト数は指定がなければ約4√n（各リストに最低39件の学習点を確保）
+        nlist = self.ivf_nlist or int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n // 39))
+        
+        if index_type == "ivf_flat":
+            return faiss.index_factory(self.dimension, f"IVF{nlist},Flat")
+        
+        # PQのサブベクトル数は次元数を割り切れる値にする
+        m = self.pq_m
+        while self.dimension % m:
+            m -= 1
+        return faiss.index_factory(self.dimension, f"IVF{nlist},PQ{m}")
+    
+    def _apply_search_params(self, index: faiss.Index, index_type: str):
+        """検索時パラメータ（nprobe / efSearch）を設定し、IVF-Flatはベクトルを復元できるようにする"""
+        if index_type in ("ivf_flat", "ivf_pq"):
+            ivf = faiss.extract_index_ivf(index)
+            ivf.nprobe = self.ivf_nprobe
+            if index_type not in LOSSY_INDEX_TYPES and ivf.direct_map.no():
+                ivf.make_direct_map()
+        elif index_type == "hnsw":
+            index.hnsw.efSearch = self.hnsw_ef_search
+    
+    def _build_index(self, index_type: str, vectors: np.ndarray) -> faiss.Index:
+        """ベクトルからインデックスを構築（必要ならサンプルで学習）"""
+        index = self._create_index(index_type, len(vectors))
+        
+        if not index.is_trained:
+            sample = vectors
+            if len(vectors) > self.train_sample_size:
+                rng = np.random.default_rng(0)
+                sample = vectors[rng.choice(len(vectors), self.train_sample_size, replace=False)]
+            index.train(sample)
+        
+        if len(vectors):
+            index.add(vectors)
+        
+        self._apply_search_params(index, index_type)
+        return index
+    
+    def _append_vectors(self, vectors: np.ndarray):
+        """別に保持しているベクトル配列に追記（容量は1.5倍ずつ拡張）。ロック内で呼び出す"""
+        if self._vectors is None:
+            return
+        count = len(self.documents)
+        required = count + len(vectors)
+        
+        if required > len(self._vectors):
+            capacity = max(required, int(len(self._vectors) * 1.5))
+            grown = np.empty((capacity, self.dimension), dtype=self.vector_dtype)
+            grown[:count] = self._vectors[:count]
+            self._vectors = grown
         
-    def add_documents(self, texts: List[str], metadata: Optional[List[Dict]] = None):
-        """ドキュメントを追加"""
+        self._vectors[count:required] = vectors
+    
+    def _stored_vectors(self, start: int, end: int) -> np.ndarray:
+        """start〜end件目のベクトルをfloat32で取得（インデックスから復元できない種別は別に保持した配列から）。ロック内で呼び出す"""
+        if self._vectors is not None:
+            return np.ascontiguousarray(self._vectors[start:end], dtype='float32')
+        if self.index is None or end <= start:
+            return np.empty((0, self.dimension), dtype='float32')
+        return self.index.reconstruct_n(start, end - start)
+    
+    def add_documents(self, texts: List[str], metadata: Optional[List[Dict]] = None) -> List[int]:
+        """
+        ドキュメントを追加
+        
+        Embeddingに失敗したバッチがあっても成功分はインデックスに追加する。
+        
+        Returns:
+            Embeddingに失敗したテキストのインデックス（texts内の位置）
+        """
         if not texts:
+            return []
+        
+        # Embeddingsを生成（バッチ単位）
+        embeddings = self._embed_texts(texts)
+        
+        # Embeddingに成功したテキストだけを対象にする
+        failed = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        succeeded = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        
+        if failed:
+            logger.warning(f"Embedding failed for {len(failed)}/{len(texts)} texts")
+        
+        if not succeeded:
+            return failed
+        
+        # 新しいベクトルだけをインデックスに追加（既存分は再投入しない）
+        embeddings_array = np.array([embeddings[i] for i in succeeded], dtype='float32')
+        del embeddings
+        
+        with self._lock:
+            if self.index is None:
+                # 学習が必要な種別はまずFlatで作成し、下で再構築する
+                index_type = self._target_index_type(len(succeeded))
+                if index_type not in ("flat", "hnsw"):
+                    index_type = "flat"
+                self.index = self._build_index(index_type, np.empty((0, self.dimension), dtype='float32'))
+                self.index_type = index_type
+            
+            self._append_vectors(embeddings_array)
+            self.version += 1
+            for i in succeeded:
+                meta = metadata[i] if metadata and i < len(metadata) else {}
+                self.documents.append(StoredDocument(len(self.documents), texts[i], meta))
+            
+            with self._index_lock.write():
+                self.index.add(embeddings_array)
+            needs_rebuild = self._needs_rebuild(len(self.documents))
+        
+        logger.info(f"Indexed {len(succeeded)} new documents (total {len(self.documents)})")
+        
+        # 種別の切り替えやIVFの再学習はバックグラウンドで行い、追加したリクエストを待たせない
+        if needs_rebuild:
+            self._schedule_rebuild()
+        
+        return failed
+    
+    def _schedule_rebuild(self):
+        """バックグラウンドでインデックスを再構築（再構築中なら何もしない。完了後の追加で改めて判定される）"""
+        if self._rebuild_lock.locked():
             return
         
-        # Embeddingsを生成
-        embeddings = []
-        for text in texts:
-            response = self.client.embeddings.create(
-                input=text,
-                model=self.embedding_deployment
+        def run():
+            if not self._rebuild_lock.acquire(blocking=False):
+                return
+            try:
+                self._rebuild()
+            except Exception as e:
+                logger.error(f"Background index rebuild failed: {str(e)}")
+            finally:
+                self._rebuild_lock.release()
+        
+        self._rebuild_thread = threading.Thread(target=run, name="router-index-rebuild", daemon=True)
+        self._rebuild_thread.start()
+    
+    def rebuild_index(self, index_type: Optional[str] = None):
+        """
+        保存済みのEmbeddingからFAISSインデックスを作り直す
+        
+        通常の追加は差分のみで行うため、インデックス種別の変更や
+        不整合の解消など、明示的に必要な場合にのみ呼び出す。
+        新しいインデックスを構築してから差し替えるので、構築中も検索は継続できる。
+        
+        Args:
+            index_type: 構築するインデックス種別（省略時はコーパスサイズから決定）
+        """
+        if index_type is not None and index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type: {index_type} (expected one of {INDEX_TYPES})")
+        
+        with self._rebuild_lock:
+            self._rebuild(index_type)
+    
+    def _rebuild(self, index_type: Optional[str] = None):
+        """rebuild_index の本体。_rebuild_lock を取得して呼び出す"""
+        with self._lock:
+            count = len(self.documents)
+            vectors = self._stored_vectors(0, count)
+        
+        index_type = index_type or self._target_index_type(count)
+        index = self._build_index(index_type, vectors)
+        
+        with self._lock:
+            # 構築中に追加されたドキュメントを反映
+            added = self._stored_vectors(count, len(self.documents))
+            if len(added):
+                index.add(added)
+            
+            # 新しいインデックスから復元できない場合だけベクトルを別に保持する
+            if index_type not in LOSSY_INDEX_TYPES:
+                self._vectors = None
+            elif self._vectors is None:
+                self._vectors = np.concatenate([vectors, added]).astype(self.vector_dtype, copy=False)
+            self.index = index
+            self.index_type = index_type
+            self.trained_size = count if index_type in ("ivf_flat", "ivf_pq") else 0
+        del vectors
+        
+        logger.info(f"Rebuilt {index_type} index with {index.ntotal} documents")
+        
+    def save_snapshot(self, path: str):
+        """
+        インデックスとドキュメントをスナップショットとして保存
+        
+        一時ディレクトリに書き出してから置き換える。以前のスナップショットは置き換えが済むまで
+        退避先（path + ".previous"）に残すので、途中で失敗・停止しても load_snapshot はどちらかを読める。
+        vectors.npy はインデックスから復元できない種別（IVF-PQ）の場合だけ中身を持ち、それ以外は空。
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".snapshot-", dir=parent)
+        
+        try:
+            # インデックスはメモリ上に複製せず、ロック中に直接ファイルへ書き出す（ドキュメントと件数を揃える）
+            with self._lock:
+                documents = list(self.documents)
+                if self._vectors is not None:
+                    vectors = self._vectors[:len(documents)].copy()
+                else:
+                    vectors = np.empty((0, self.dimension), dtype=self.vector_dtype)
+                faiss.write_index(
+                    self.index if self.index is not None else faiss.IndexFlatL2(self.dimension),
+                    os.path.join(tmp_dir, "index.faiss")
+                )
+                index_type = self.index_type
+                trained_size = self.trained_size
+            
+            manifest = {
+                "version": SNAPSHOT_VERSION,
+                "embedding_model": self.embedding_deployment,
+                "dimension": self.dimension,
+                "index_type": index_type,
+                "trained_size": trained_size,
+                "count": len(documents),
+                "created_at": datetime.utcnow().isoformat()
+            }
+            with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            
+            with open(os.path.join(tmp_dir, "documents.json"), "w", encoding="utf-8") as f:
+                json.dump(
+                    [{"content": doc.content, "metadata": doc.metadata} for doc in documents],
+                    f,
+                    ensure_ascii=False
+                )
+            
+            np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+            
+            # 以前のスナップショットは新しいものに置き換わってから削除する
+            previous = path + SNAPSHOT_PREVIOUS_SUFFIX
+            if os.path.exists(path):
+                if os.path.exists(previous):
+                    shutil.rmtree(previous)
+                os.replace(path, previous)
+            os.replace(tmp_dir, path)
+            shutil.rmtree(previous, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        
+        logger.info(f"Saved snapshot of {len(documents)} documents to {path}")
+    
+    def load_snapshot(self, path: str) -> bool:
+        """
+        スナップショットからインデックスとドキュメントを復元
+        
+        形式バージョン・Embeddingモデル・次元数が一致しない場合は読み込まない。
+        
+        Returns:
+            復元できた場合はTrue
+        """
+        path = resolve_snapshot_dir(path)
+        manifest_path = os.path.join(path, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return False
+        
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"Snapshot version mismatch: {manifest.get('version')} (expected {SNAPSHOT_VERSION})")
+            return False
+        if manifest.get("embedding_model") != self.embedding_deployment:
+            logger.warning(
+                f"Snapshot embedding model mismatch: {manifest.get('embedding_model')} "
+                f"(expected {self.embedding_deployment})"
             )
-            embeddings.append(response.data[0].embedding)
-        
-        # ドキュメント情報を保存
-        for i, text in enumerate(texts):
-            meta = metadata[i] if metadata and i < len(metadata) else {}
-            self.documents.append({
-                "id": len(self.documents),
-                "content": text,
-                "metadata": meta,
-                "embedding": embeddings[i]
-            })
+            return False
+        if manifest.get("dimension") != self.dimension:
+            logger.warning(f"Snapshot dimension mismatch: {manifest.get('dimension')} (expected {self.dimension})")
+            return False
         
-        # FAISSインデックスを再構築
-        embeddings_array = np.array([doc["embedding"] for doc in self.documents]).astype('float32')
+        with open(os.path.join(path, "documents.json"), encoding="utf-8") as f:
+            stored_docs = json.load(f)
+        vectors = np.load(os.path.join(path, "vectors.npy"))
+        index = faiss.read_index(os.path.join(path, "index.faiss"))
+        index_type = manifest.get("index_type", "flat")
+        self._apply_search_params(index, index_type)
         
-        if self.index is None:
-            self.index = faiss.IndexFlatL2(self.dimension)
-        else:
-            self.index.reset()
+        # インデックスから復元できる種別ではベクトルを別に保持しない
+        # （以前の形式のスナップショットでは全件入っているが使わない）
+        stored_vectors = vectors.astype(self.vector_dtype, copy=False) if index_type in LOSSY_INDEX_TYPES else None
+        
+        counts_match = len(stored_docs) == index.ntotal == manifest.get("count")
+        if stored_vectors is not None and len(stored_vectors) != len(stored_docs):
+            counts_match = False
+        if not counts_match:
+            logger.warning("Snapshot is inconsistent (document, vector and index counts differ)")
+            return False
+        
+        documents = [
+            StoredDocument(i, doc["content"], doc.get("metadata", {}))
+            for i, doc in enumerate(stored_docs)
+        ]
         
-        self.index.add(embeddings_array)
-        logger.info(f"Indexed {len(self.documents)} documents")
+        with self._lock:
+            self.documents = documents
+            self.version += 1
+            self._vectors = stored_vectors
+            self.index = index
+            self.index_type = index_type
+            # 学習時の件数がない以前の形式では保存時の件数を使う
+            if index_type in ("ivf_flat", "ivf_pq"):
+                self.trained_size = manifest.get("trained_size") or len(documents)
+            else:
+                self.trained_size = 0
         
+        logger.info(f"Loaded snapshot of {len(documents)} documents from {path}")
+        return True
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """クエリのEmbeddingを取得（キャッシュにあればAPIを呼ばない）"""
+        vector = self.query_cache.get(self.embedding_deployment, query)
+        if vector is not None:
+            return vector
+        
+        # 正規化後のテキストを埋め込み、表記揺れのあるクエリでも同じベクトルを共有する
+        response = self.client.embeddings.create(
+            input=normalize_query(query),
+            model=self.embedding_deployment
+        )
+        vector = np.array(response.data[0].embedding, dtype='float32')
+        self.query_cache.put(self.embedding_deployment, query, vector)
+        return vector
+    
+    async def aembed_query(self, query: str) -> np.ndarray:
+        """embed_queryの非同期版（非同期クライアントがなければスレッドで実行）"""
+        vector = self.query_cache.get(self.embedding_deployment, query)
+        if vector is not None:
+            return vector
+        
+        if self.async_client is None:
+            return await asyncio.to_thread(self.embed_query, query)
+        
+        response = await self.async_client.embeddings.create(
+            input=normalize_query(query),
+            model=self.embedding_deployment
+        )
+        vector = np.array(response.data[0].embedding, dtype='float32')
+        self.query_cache.put(self.embedding_deployment, query, vector)
+        return vector
+    
+    def embed_queries(self, queries: List[str]) -> List[np.ndarray]:
+        """複数クエリのEmbeddingを取得（キャッシュにないものは1回のAPI呼び出しでまとめて取得）"""
+        vectors = [self.query_cache.get(self.embedding_deployment, query) for query in queries]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            response = self.client.embeddings.create(
+                input=[normalize_query(queries[i]) for i in missing],
+                model=self.embedding_deployment
+            )
+            self._store_query_embeddings(queries, missing, response, vectors)
+        return vectors
+    
+    async def aembed_queries(self, queries: List[str]) -> List[np.ndarray]:
+        """embed_queriesの非同期版"""
+        if self.async_client is None:
+            return await asyncio.to_thread(self.embed_queries, queries)
+        
+        vectors = [self.query_cache.get(self.embedding_deployment, query) for query in queries]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            response = await self.async_client.embeddings.create(
+                input=[normalize_query(queries[i]) for i in missing],
+                model=self.embedding_deployment
+            )
+            self._store_query_embeddings(queries, missing, response, vectors)
+        return vectors
+    
+    def _store_query_embeddings(
+        self,
+        queries: List[str],
+        missing: List[int],
+        response,
+        vectors: List[Optional[np.ndarray]]
+    ):
+        """まとめて取得したEmbeddingをvectorsに埋め、キャッシュに登録"""
+        # レスポンスのindexはmissing内の位置
+        for item in response.data:
+            i = missing[item.index]
+            vectors[i] = np.array(item.embedding, dtype='float32')
+            self.query_cache.put(self.embedding_deployment, queries[i], vectors[i])
+    
     def search(self, query: str, k: int = 5, threshold: Optional[float] = None) -> List[Dict[str, Any]]:
         """類似ドキュメントを検索"""
         if not self.documents or self.index is None:
             return []
         
-        # クエリのembeddingを生成
-        response = self.client.embeddings.create(
-            input=query,
-            model=self.embedding_deployment
-        )
-        query_embedding = np.array([response.data[0].embedding]).astype('float32')
+        # クエリのembeddingを取得
+        return self.search_by_vector(self.embed_query(query), k=k, threshold=threshold)
+    
+    async def asearch(self, query: str, k: int = 5, threshold: Optional[float] = None) -> List[Dict[str, Any]]:
+        """searchの非同期版（FAISS検索はイベントループを塞がないようスレッドで実行）"""
+        if not self.documents or self.index is None:
+            return []
+        
+        query_vector = await self.aembed_query(query)
+        return await asyncio.to_thread(self.search_by_vector, query_vector, k, threshold)
+    
+    def search_by_vector(
+        self,
+        query_vector: np.ndarray,
+        k: int = 5,
+        threshold: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """Embedding済みのクエリベクトルで類似ドキュメントを検索"""
+        if not self.documents or self.index is None:
+            return []
+        
+        query_embedding = np.asarray(query_vector, dtype='float32').reshape(1, -1)
+        
+        # ストア全体のロックは参照の取得だけにし、検索中も追加・差し替えを止めない
+        with self._lock:
+            index = self.index
+            documents = self.documents
         
-        # 類似検索
-        k = min(k, len(self.documents))
-        distances, indices = self.index.search(query_embedding, k)
+        # 類似検索（同じインデックスへの追記とだけ排他）
+        with self._index_lock.read():
+            k = min(k, index.ntotal)
+            distances, indices = index.search(query_embedding, k)
         
         results = []
         for dist, idx in zip(distances[0], indices[0]):
-            if idx < len(self.documents):
-                doc = self.documents[idx].copy()
-                doc['score'] = float(dist)
-                
+            if 0 <= idx < len(documents):
                 # スコアがthresholdを超える場合はスキップ
                 if threshold and dist > threshold:
                     continue
-                    
-                results.append(doc)
+                
+                doc = documents[idx]
+                results.append({
+                    "id": doc.id,
+                    "content": doc.content,
+                    "metadata": doc.metadata,
+                    "score": float(dist)
+                })
         
         return results
 
 
-class IntentClassifier:
-    """質問の意図を分類"""
+class RetrievalContext:
+    """
+    1リクエスト内で複数ツールが共有する検索コンテキスト
     
-    def __init__(self, openai_client: AzureOpenAI, deployment_name: str):
-        self.client = openai_client
-        self.deployment_name = deployment_name
+    クエリのEmbeddingと検索はそれぞれ1回だけ行い、
+    各ツールには必要な件数分だけ結果を切り出して渡す。
+    """
     
-    def classify(self, query: str) -> QueryIntent:
-        """質問の意図を分類"""
+    def __init__(
+        self,
+        document_store: DocumentStore,
+        query: str,
+        k: int,
+        timings: Optional[StageTimings] = None
+    ):
+        self.document_store = document_store
+        self.query = query
+        self.k = k
+        self.timings = timings or StageTimings()  # Embedding・検索の所要時間を記録
+        self._lock = threading.RLock()
+        self._embedding: Optional[np.ndarray] = None
+        self._results: Optional[List[Dict[str, Any]]] = None
+        self._results_k = 0
+        # 非同期パイプライン用（同一イベントループ内のタスク間で共有）
+        self._async_embedding_lock = asyncio.Lock()
+        self._async_search_lock = asyncio.Lock()
+    
+    def query_embedding(self) -> np.ndarray:
+        """クエリのEmbeddingを取得（初回のみ計算）"""
+        with self._lock:
+            if self._embedding is None:
+                with self.timings.measure("embedding"):
+                    self._embedding = self.document_store.embed_query(self.query)
+            return self._embedding
+    
+    def search(self, k: int) -> List[Dict[str, Any]]:
+        """上位k件の検索結果を取得（初回は必要件数の最大値で検索）"""
+        with self._lock:
+            if self._results is None or k > self._results_k:
+                self._results_k = max(k, self.k)
+                query_vector = self.query_embedding()
+                with self.timings.measure("search"):
+                    self._results = self.document_store.search_by_vector(
+                        query_vector, k=self._results_k
+                    )
+            return self._results[:k]
+    
+    async def aquery_embedding(self) -> np.ndarray:
+        """query_embeddingの非同期版"""
+        async with self._async_embedding_lock:
+            if self._embedding is None:
+                with self.timings.measure("embedding"):
+                    self._embedding = await self.document_store.aembed_query(self.query)
+            return self._embedding
+    
+    async def asearch(self, k: int) -> List[Dict[str, Any]]:
+        """searchの非同期版"""
+        async with self._async_search_lock:
+            if self._results is None or k > self._results_k:
+                results_k = max(k, self.k)
+                query_vector = await self.aquery_embedding()
+                with self.timings.measure("search"):
+                    self._results = await asyncio.to_thread(
+                        self.document_store.search_by_vector, query_vector, results_k
+                    )
+                self._results_k = results_k
+            return self._results[:k]
+
+
+class LocalIntentClassifier:
+    """
+    LLMを呼ばずに意図を判定するローカル分類器
+    
+    1. キーワードルール: 明らかな表現（「要約」「違い」など）にのみ反応する
+    2. 最近傍セントロイド: LLMが付けたラベルでクエリEmbeddingの重心を学習し、
+       十分なサンプルがあり、かつ他の意図との差が明確な場合のみ判定する
+    
+    学習した重心はスナップショットに保存し、再起動後も引き継ぐ。
+    """
+    
+    # 1つの意図だけに一致した場合にのみ採用する（複数一致はLLMに任せる）
+    KEYWORD_RULES = [
+        (QueryIntent.SUMMARIZATION, re.compile(r"要約|まとめて|まとめる|概要を|summari[sz]e|summary|tl;?dr", re.IGNORECASE)),
+        (QueryIntent.COMPARISON, re.compile(r"違い|比較|どちらが|どっちが|差異|compare|comparison|difference|\bvs\.?\b|versus", re.IGNORECASE)),
+        (QueryIntent.ANALYSIS, re.compile(r"なぜ|分析|考察|評価して|どう思う|\bwhy\b|analy[sz]e|evaluate", re.IGNORECASE)),
+        (QueryIntent.MULTI_HOP, re.compile(r"調べてから|その上で|それを使って|その情報を使って", re.IGNORECASE)),
+        (QueryIntent.FACTUAL_SEARCH, re.compile(
+            r"とは何|とは[？?]|いつ(?!も)|どこで|どこに|誰が|誰の|何年|何日|何人|何個|いくら|価格は|値段は|"
+            r"\bwhat is\b|\bwho (is|was)\b|\bwhen (is|was|did)\b|\bwhere (is|was)\b|\bhow (much|many)\b",
+            re.IGNORECASE
+        )),
+    ]
+    
+    def __init__(self):
+        self.min_samples = int(os.getenv("ROUTER_INTENT_MIN_SAMPLES", "20"))
+        self.min_similarity = float(os.getenv("ROUTER_INTENT_MIN_SIMILARITY", "0.85"))
+        self.min_margin = float(os.getenv("ROUTER_INTENT_MIN_MARGIN", "0.03"))
+        self._sums: Dict[QueryIntent, np.ndarray] = {}
+        self._counts: Dict[QueryIntent, int] = {}
+        self._lock = threading.Lock()
+    
+    def classify_by_rules(self, query: str) -> Optional[QueryIntent]:
+        """キーワードルールで判定（該当なし・曖昧ならNone）"""
+        matched = [intent for intent, pattern in self.KEYWORD_RULES if pattern.search(query)]
+        return matched[0] if len(matched) == 1 else None
+    
+    def classify_by_centroid(self, query_embedding: np.ndarray) -> Optional[QueryIntent]:
+        """学習済みの重心との類似度で判定（確信度が低ければNone）"""
+        with self._lock:
+            trained = [
+                (intent, self._sums[intent] / np.linalg.norm(self._sums[intent]))
+                for intent, count in self._counts.items()
+                if count >= self.min_samples
+            ]
+        
+        if len(trained) < 2:
+            return None
+        
+        vector = query_embedding / np.linalg.norm(query_embedding)
+        scored = sorted(
+            ((float(np.dot(centroid, vector)), intent) for intent, centroid in trained),
+            key=lambda x: x[0],
+            reverse=True
+        )
+        best_score, best_intent = scored[0]
         
-        system_prompt = """あなたは質問の意図を分類するエキスパートです。
+        if best_score < self.min_similarity or best_score - scored[1][0] < self.min_margin:
+            return None
+        return best_intent
+    
+    def learn(self, query_embedding: np.ndarray, intent: QueryIntent):
+        """LLMが付けたラベルで重心を更新"""
+        vector = query_embedding / np.linalg.norm(query_embedding)
+        with self._lock:
+            if intent in self._sums:
+                self._sums[intent] = self._sums[intent] + vector
+            else:
+                self._sums[intent] = vector.astype('float32')
+            self._counts[intent] = self._counts.get(intent, 0) + 1
+    
+    def sample_counts(self) -> Dict[str, int]:
+        """意図ごとの学習サンプル数"""
+        with self._lock:
+            return {intent.value: count for intent, count in self._counts.items()}
+    
+    def save(self, path: str, embedding_model: str):
+        """学習した重心をファイルに保存（一時ファイルに書いてから置き換える）"""
+        with self._lock:
+            intents = list(self._counts)
+            sums = [self._sums[intent] for intent in intents]
+            counts = [self._counts[intent] for intent in intents]
+        
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                embedding_model=np.array(embedding_model),
+                intents=np.array([intent.value for intent in intents], dtype=str),
+                sums=np.array(sums, dtype='float32'),
+                counts=np.array(counts, dtype=np.int64)
+            )
+        os.replace(tmp_path, path)
+    
+    def load(self, path: str, embedding_model: str) -> bool:
+        """
+        保存した重心を読み込む
+        
+        Embeddingモデルが異なる場合は読み込まない。
+        
+        Returns:
+            読み込めた場合はTrue
+        """
+        if not os.path.exists(path):
+            return False
+        
+        with np.load(path, allow_pickle=False) as data:
+            if str(data["embedding_model"]) != embedding_model:
+                logger.warning(
+                    f"Intent centroids embedding model mismatch: {data['embedding_model']} "
+                    f"(expected {embedding_model})"
+                )
+                return False
+            intents = [QueryIntent(value) for value in data["intents"]]
+            sums = dict(zip(intents, data["sums"]))
+            counts = dict(zip(intents, (int(count) for count in data["counts"])))
+        
+        with self._lock:
+            self._sums = sums
+            self._counts = counts
+        
+        logger.info(f"Loaded intent centroids: {self.sample_counts()}")
+        return True
+
+
+class IntentClassifier:
+    """質問の意図を分類（ローカル分類器で判定できない場合のみLLMを使用）"""
+    
+    TIERS = ["rules", "centroid", "llm"]
+    
+    SYSTEM_PROMPT = """あなたは質問の意図を分類するエキスパートです。
 以下の質問を分析し、最も適切なカテゴリを1つ選んでください：
 
 1. factual_search: 特定の事実や情報を探している（「〜とは何ですか」「〜の価格は」）
@@ -129,37 +1104,166 @@ class IntentClassifier:
 7. unknown: 上記に当てはまらない
 
 JSON形式で回答してください：{"intent": "カテゴリ名", "reasoning": "理由"}"""
-
-        try:
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"質問: {query}"}
-                ],
-                temperature=0.1,
-                response_format={"type": "json_object"}
-            )
-            
-            result = json.loads(response.choices[0].message.content)
-            intent_str = result.get("intent", "unknown")
-            reasoning = result.get("reasoning", "")
+    
+    def __init__(
+        self,
+        openai_client: AzureOpenAI,
+        deployment_name: str,
+        async_client: Optional[AsyncAzureOpenAI] = None
+    ):
+        self.client = openai_client
+        self.async_client = async_client
+        self.deployment_name = deployment_name
+        self.local = LocalIntentClassifier()
+        self.local_enabled = os.getenv("ROUTER_LOCAL_INTENT", "true").lower() == "true"
+        self._tier_counts = {tier: 0 for tier in self.TIERS}
+        self._lock = threading.Lock()
+    
+    def classify(self, query: str) -> QueryIntent:
+        """質問の意図を分類"""
+        intent, _ = self.classify_with_tier(query)
+        return intent
+    
+    def classify_with_tier(
+        self,
+        query: str,
+        query_embedding: Optional[Callable[[], np.ndarray]] = None
+    ) -> Tuple[QueryIntent, str]:
+        """
+        質問の意図を分類し、判定した階層（rules / centroid / llm）とともに返す
+        
+        Args:
+            query: 質問
+            query_embedding: クエリEmbeddingを返す関数（セントロイド判定と学習に使用）
+        """
+        intent = None
+        tier = "llm"
+        embedding = None
+        
+        if self.local_enabled:
+            intent = self.local.classify_by_rules(query)
+            tier = "rules"
             
-            logger.info(f"Intent classified: {intent_str} - {reasoning}")
+            if intent is None and query_embedding is not None:
+                try:
+                    embedding = query_embedding()
+                    intent = self.local.classify_by_centroid(embedding)
+                    tier = "centroid"
+                except Exception as e:
+                    logger.warning(f"Local intent classification skipped: {str(e)}")
+        
+        if intent is None:
+            tier = "llm"
+            intent = self._learn_from_llm(self._classify_with_llm(query), embedding)
+        
+        self._record_tier(tier)
+        return intent, tier
+    
+    async def aclassify_with_tier(
+        self,
+        query: str,
+        query_embedding: Optional[Callable[[], Awaitable[np.ndarray]]] = None
+    ) -> Tuple[QueryIntent, str]:
+        """classify_with_tierの非同期版"""
+        intent = None
+        tier = "llm"
+        embedding = None
+        
+        if self.local_enabled:
+            intent = self.local.classify_by_rules(query)
+            tier = "rules"
             
-            try:
-                return QueryIntent(intent_str)
-            except ValueError:
-                return QueryIntent.UNKNOWN
-                
+            if intent is None and query_embedding is not None:
+                try:
+                    embedding = await query_embedding()
+                    intent = self.local.classify_by_centroid(embedding)
+                    tier = "centroid"
+                except Exception as e:
+                    logger.warning(f"Local intent classification skipped: {str(e)}")
+        
+        if intent is None:
+            tier = "llm"
+            intent = self._learn_from_llm(await self._aclassify_with_llm(query), embedding)
+        
+        self._record_tier(tier)
+        return intent, tier
+    
+    def _learn_from_llm(self, intent: Optional[QueryIntent], embedding: Optional[np.ndarray]) -> QueryIntent:
+        """LLMのラベルでローカル分類器を学習（LLMが失敗した場合はUNKNOWN）"""
+        if intent is None:
+            return QueryIntent.UNKNOWN
+        if embedding is not None:
+            self.local.learn(embedding, intent)
+        return intent
+    
+    def _record_tier(self, tier: str):
+        with self._lock:
+            self._tier_counts[tier] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """各階層で判定したクエリの件数と割合"""
+        with self._lock:
+            counts = dict(self._tier_counts)
+        total = sum(counts.values())
+        return {
+            "counts": counts,
+            "fractions": {tier: (count / total if total else 0.0) for tier, count in counts.items()},
+            "centroid_samples": self.local.sample_counts()
+        }
+    
+    def _llm_request(self, query: str) -> Dict[str, Any]:
+        """意図分類のリクエストパラメータ"""
+        return {
+            "model": self.deployment_name,
+            "messages": [
+                {"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "user", "content": f"質問: {query}"}
+            ],
+            "temperature": 0.1,
+            "response_format": {"type": "json_object"}
+        }
+    
+    def _parse_llm_response(self, content: str) -> QueryIntent:
+        """LLMの応答（JSON）から意図を取り出す"""
+        result = json.loads(content)
+        intent_str = result.get("intent", "unknown")
+        reasoning = result.get("reasoning", "")
+        
+        logger.info(f"Intent classified: {intent_str} - {reasoning}")
+        
+        try:
+            return QueryIntent(intent_str)
+        except ValueError:
+            return QueryIntent.UNKNOWN
+    
+    def _classify_with_llm(self, query: str) -> Optional[QueryIntent]:
+        """LLMで質問の意図を分類（API呼び出しに失敗した場合はNone）"""
+        try:
+            response = self.client.chat.completions.create(**self._llm_request(query))
+            return self._parse_llm_response(response.choices[0].message.content)
         except Exception as e:
             logger.error(f"Intent classification error: {str(e)}")
-            return QueryIntent.UNKNOWN
+            return None
+    
+    async def _aclassify_with_llm(self, query: str) -> Optional[QueryIntent]:
+        """_classify_with_llmの非同期版"""
+        if self.async_client is None:
+            return await asyncio.to_thread(self._classify_with_llm, query)
+        
+        try:
+            response = await self.async_client.chat.completions.create(**self._llm_request(query))
+            return self._parse_llm_response(response.choices[0].message.content)
+        except Exception as e:
+            logger.error(f"Intent classification error: {str(e)}")
+            return None
 
 
 class KnowledgeTool:
     """ナレッジ検索ツールの基底クラス"""
     
+    # ツールがDocumentStoreから取得するドキュメント数（検索しない場合は0）
+    retrieval_k = 0
+    
     def __init__(self, name: str, description: str):
         self.name = name
         self.description = description
@@ -167,11 +1271,17 @@ class KnowledgeTool:
     def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
         """ツールを実行"""
         raise NotImplementedError
+    
+    async def aexecute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """ツールを非同期で実行（非同期実装がないツールはスレッドで同期版を実行）"""
+        return await asyncio.to_thread(self.execute, query, context)
 
 
 class SemanticSearchTool(KnowledgeTool):
     """意味的検索ツール"""
     
+    retrieval_k = 3
+    
     def __init__(self, document_store: DocumentStore):
         super().__init__(
             name="semantic_search",
@@ -181,9 +1291,33 @@ class SemanticSearchTool(KnowledgeTool):
     
     def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
         """意味検索を実行"""
-        k = context.get("k", 3) if context else 3
-        results = self.document_store.search(query, k=k)
+        context = context or {}
+        k = context.get("k", self.retrieval_k)
+        
+        # リクエスト内で共有する検索結果があれば再利用
+        retrieval = context.get("retrieval")
+        if retrieval:
+            results = retrieval.search(k)
+        else:
+            results = self.document_store.search(query, k=k)
+        
+        return self._format_results(results)
+    
+    async def aexecute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """意味検索を非同期で実行"""
+        context = context or {}
+        k = context.get("k", self.retrieval_k)
+        
+        retrieval = context.get("retrieval")
+        if retrieval:
+            results = await retrieval.asearch(k)
+        else:
+            results = await self.document_store.asearch(query, k=k)
         
+        return self._format_results(results)
+    
+    def _format_results(self, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """検索結果をツール結果の形式に整形"""
         if not results:
             return {
                 "success": False,
@@ -208,12 +1342,17 @@ class SemanticSearchTool(KnowledgeTool):
 class KeywordSearchTool(KnowledgeTool):
     """キーワード検索ツール（Azure AI Search使用）"""
     
-    def __init__(self, search_client: Optional[SearchClient]):
+    def __init__(
+        self,
+        search_client: Optional[SearchClient],
+        async_search_client: Optional[AsyncSearchClient] = None
+    ):
         super().__init__(
             name="keyword_search",
             description="キーワードベースでドキュメントを検索します（正確な用語検索に最適）。"
         )
         self.search_client = search_client
+        self.async_search_client = async_search_client
     
     def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
         """キーワード検索を実行"""
@@ -228,66 +1367,301 @@ class KeywordSearchTool(KnowledgeTool):
             results = self.search_client.search(
                 search_text=query,
                 top=top,
-                include_total_count=True
+                include_total_count=True,
+                **timeout_kwargs()
             )
             
-            documents = []
-            for result in results:
-                documents.append({
-                    "content": result.get('content', str(result)),
-                    "metadata": {k: v for k, v in result.items() if k != 'content'}
-                })
+            return self._format_results([self._to_document(result) for result in results])
             
-            if not documents:
+        except Exception as e:
+            logger.error(f"Keyword search error: {str(e)}")
+            return {
+                "success": False,
+                "message": f"検索エラー: {str(e)}"
+            }
+    
+    async def aexecute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """キーワード検索を非同期で実行"""
+        if not self.async_search_client:
+            return await super().aexecute(query, context)
+        
+        try:
+            top = context.get("top", 3) if context else 3
+            results = await self.async_search_client.search(
+                search_text=query,
+                top=top,
+                include_total_count=True,
+                **timeout_kwargs()
+            )
+            
+            return self._format_results([self._to_document(result) async for result in results])
+            
+        except Exception as e:
+            logger.error(f"Keyword search error: {str(e)}")
+            return {
+                "success": False,
+                "message": f"検索エラー: {str(e)}"
+            }
+    
+    @staticmethod
+    def _to_document(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "content": result.get('content', str(result)),
+            "metadata": {k: v for k, v in result.items() if k != 'content'}
+        }
+    
+    def _format_results(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """検索結果をツール結果の形式に整形"""
+        if not documents:
+            return {
+                "success": False,
+                "message": "該当するドキュメントが見つかりませんでした。"
+            }
+        
+        return {
+            "success": True,
+            "message": f"{len(documents)}件のドキュメントを見つけました。",
+            "documents": documents
+        }
+
+
+class SummarizationTool(KnowledgeTool):
+    """
+    要約ツール（map-reduce）
+    
+    検索されたドキュメントを1つのプロンプトに収まる単位に分割して並列に要約し（map）、
+    部分要約がプロンプトに収まるまで階層的にまとめてから最終要約を作る（reduce）。
+    全体が1つのプロンプトに収まる場合は1回の呼び出しで要約する。
+    部分要約は内容のハッシュをキーにキャッシュし、同じドキュメントは再要約しない。
+    """
+    
+    FINAL_PROMPT = "以下のテキストを簡潔に要約してください。重要なポイントを3-5個の箇条書きにまとめてください。"
+    MAP_PROMPT = "以下のテキストの要点を、後で他の部分と統合できるよう事実を落とさず簡潔にまとめてください。"
+    REDUCE_PROMPT = "以下は同じ資料群の部分要約です。重複を除いて1つの要約に統合してください。"
+    
+    def __init__(
+        self,
+        openai_client: AzureOpenAI,
+        deployment_name: str,
+        document_store: Optional[DocumentStore] = None,
+        async_client: Optional[AsyncAzureOpenAI] = None,
+        map_deployment_name: Optional[str] = None
+    ):
+        super().__init__(
+            name="summarization",
+            description="検索したドキュメントや長いテキストを簡潔に要約します。"
+        )
+        self.client = openai_client
+        self.async_client = async_client
+        self.deployment_name = deployment_name
+        # map/reduceの部分要約に使うデプロイメント（未指定なら最終要約と同じ）
+        self.map_deployment_name = map_deployment_name or deployment_name
+        self.document_store = document_store
+        
+        # 要約対象のドキュメント数・1プロンプトあたりのトークン数・並列数
+        self.retrieval_k = int(os.getenv("ROUTER_SUMMARY_DOCUMENTS", "8"))
+        self.chunk_tokens = int(os.getenv("ROUTER_SUMMARY_CHUNK_TOKENS", "3000"))
+        self.max_workers = int(os.getenv("ROUTER_SUMMARY_WORKERS", "4"))
+        
+        # 部分要約のキャッシュ（内容のハッシュ → 要約）
+        self.cache_size = int(os.getenv("ROUTER_SUMMARY_CACHE_SIZE", "2048"))
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="router-summary"
+        )
+    
+    def _request(self, deployment: str, system_prompt: str, text: str) -> Dict[str, Any]:
+        """要約のリクエストパラメータ"""
+        return {
+            "model": deployment,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": text}
+            ],
+            "temperature": 0.3
+        }
+    
+    def _cache_key(self, deployment: str, system_prompt: str, text: str) -> str:
+        return hashlib.sha256(f"{deployment}\0{system_prompt}\0{text}".encode("utf-8")).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[str]:
+        with self._cache_lock:
+            summary = self._cache.get(key)
+            if summary is not None:
+                self._cache.move_to_end(key)
+            return summary
+    
+    def _cache_put(self, key: str, summary: str):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = summary
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _source_texts(self, query: str, context: Dict[str, Any]) -> List[str]:
+        """要約対象のテキスト（指定テキストがなければ検索結果。どちらもなければ空）"""
+        if context.get("text"):
+            return [context["text"]]
+        
+        retrieval = context.get("retrieval")
+        if retrieval:
+            documents = retrieval.search(self.retrieval_k)
+        elif self.document_store:
+            documents = self.document_store.search(query, k=self.retrieval_k)
+        else:
+            documents = []
+        return [doc["content"] for doc in documents]
+    
+    async def _asource_texts(self, query: str, context: Dict[str, Any]) -> List[str]:
+        """_source_textsの非同期版"""
+        if context.get("text"):
+            return [context["text"]]
+        
+        retrieval = context.get("retrieval")
+        if retrieval:
+            documents = await retrieval.asearch(self.retrieval_k)
+        elif self.document_store:
+            documents = await self.document_store.asearch(query, k=self.retrieval_k)
+        else:
+            documents = []
+        return [doc["content"] for doc in documents]
+    
+    def _chunks(self, texts: List[str]) -> List[str]:
+        """各テキストを1プロンプトに収まる単位に分割"""
+        return [chunk for text in texts for chunk in split_to_tokens(text, self.chunk_tokens)]
+    
+    def _groups(self, summaries: List[str]) -> List[str]:
+        """部分要約を1プロンプトに収まるグループにまとめる"""
+        groups: List[List[str]] = []
+        group_tokens = 0
+        for summary in summaries:
+            tokens = count_tokens(summary)
+            if not groups or group_tokens + tokens > self.chunk_tokens:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(summary)
+            group_tokens += tokens
+        return ["\n\n".join(group) for group in groups]
+    
+    def _final_text(self, pieces: List[str]) -> str:
+        """最終要約の入力（1プロンプトに収まるよう切り詰める）"""
+        return truncate_to_tokens("\n\n".join(pieces), self.chunk_tokens)
+    
+    def _partial(self, system_prompt: str, text: str) -> str:
+        """map・reduceの部分要約（部分要約用のデプロイメントで実行し、結果をキャッシュする）"""
+        key = self._cache_key(self.map_deployment_name, system_prompt, text)
+        summary = self._cache_get(key)
+        if summary is None:
+            summary = self._complete(self.map_deployment_name, system_prompt, text)
+            self._cache_put(key, summary)
+        return summary
+    
+    async def _apartial(self, system_prompt: str, text: str, semaphore: asyncio.Semaphore) -> str:
+        """_partialの非同期版"""
+        key = self._cache_key(self.map_deployment_name, system_prompt, text)
+        summary = self._cache_get(key)
+        if summary is None:
+            summary = await self._acomplete(self.map_deployment_name, system_prompt, text, semaphore)
+            self._cache_put(key, summary)
+        return summary
+    
+    def _complete(self, deployment: str, system_prompt: str, text: str) -> str:
+        """1回分の要約"""
+        response = self.client.chat.completions.create(**self._request(deployment, system_prompt, text))
+        return response.choices[0].message.content
+    
+    async def _acomplete(self, deployment: str, system_prompt: str, text: str, semaphore: asyncio.Semaphore) -> str:
+        """_completeの非同期版（同時実行数はsemaphoreで制限）"""
+        async with semaphore:
+            response = await self.async_client.chat.completions.create(**self._request(deployment, system_prompt, text))
+        return response.choices[0].message.content
+    
+    def _summarize(self, texts: List[str]) -> Tuple[str, int]:
+        """map-reduceで要約し、（要約, reduceの段数）を返す"""
+        pieces = self._chunks(texts)
+        levels = 0
+        prompt = self.MAP_PROMPT
+        while len(pieces) > 1 and count_tokens("\n\n".join(pieces)) > self.chunk_tokens:
+            futures = [submit_with_context(self._executor, self._partial, prompt, piece) for piece in pieces]
+            grouped = self._groups([future.result() for future in futures])
+            progressed = len(grouped) < len(pieces)
+            pieces = grouped
+            prompt = self.REDUCE_PROMPT
+            levels += 1
+            if not progressed:
+                # 部分要約が大きすぎてまとめられない場合は打ち切る
+                break
+        
+        return self._complete(self.deployment_name, self.FINAL_PROMPT, self._final_text(pieces)), levels
+    
+    async def _asummarize(self, texts: List[str]) -> Tuple[str, int]:
+        """_summarizeの非同期版"""
+        semaphore = asyncio.Semaphore(self.max_workers)
+        pieces = self._chunks(texts)
+        levels = 0
+        prompt = self.MAP_PROMPT
+        while len(pieces) > 1 and count_tokens("\n\n".join(pieces)) > self.chunk_tokens:
+            grouped = self._groups(list(await asyncio.gather(
+                *[self._apartial(prompt, piece, semaphore) for piece in pieces]
+            )))
+            progressed = len(grouped) < len(pieces)
+            pieces = grouped
+            prompt = self.REDUCE_PROMPT
+            levels += 1
+            if not progressed:
+                break
+        
+        return await self._acomplete(self.deployment_name, self.FINAL_PROMPT, self._final_text(pieces), semaphore), levels
+    
+    def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """要約を実行"""
+        try:
+            texts = self._source_texts(query, context or {})
+            if not texts:
                 return {
                     "success": False,
-                    "message": "該当するドキュメントが見つかりませんでした。"
+                    "message": "要約するドキュメントが見つかりませんでした"
                 }
+            summary, levels = self._summarize(texts)
             
             return {
                 "success": True,
-                "message": f"{len(documents)}件のドキュメントを見つけました。",
-                "documents": documents
+                "summary": summary,
+                "sources": len(texts),
+                "reduce_levels": levels
             }
             
         except Exception as e:
-            logger.error(f"Keyword search error: {str(e)}")
+            logger.error(f"Summarization error: {str(e)}")
             return {
                 "success": False,
-                "message": f"検索エラー: {str(e)}"
+                "message": f"要約エラー: {str(e)}"
             }
-
-
-class SummarizationTool(KnowledgeTool):
-    """要約ツール"""
-    
-    def __init__(self, openai_client: AzureOpenAI, deployment_name: str):
-        super().__init__(
-            name="summarization",
-            description="長いテキストを簡潔に要約します。"
-        )
-        self.client = openai_client
-        self.deployment_name = deployment_name
     
-    def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
-        """要約を実行"""
-        text_to_summarize = context.get("text", query) if context else query
+    async def aexecute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """要約を非同期で実行"""
+        if self.async_client is None:
+            return await super().aexecute(query, context)
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {"role": "system", "content": "以下のテキストを簡潔に要約してください。重要なポイントを3-5個の箇条書きにまとめてください。"},
-                    {"role": "user", "content": text_to_summarize}
-                ],
-                temperature=0.3
-            )
-            
-            summary = response.choices[0].message.content
+            texts = await self._asource_texts(query, context or {})
+            if not texts:
+                return {
+                    "success": False,
+                    "message": "要約するドキュメントが見つかりませんでした"
+                }
+            summary, levels = await self._asummarize(texts)
             
             return {
                 "success": True,
-                "summary": summary
+                "summary": summary,
+                "sources": len(texts),
+                "reduce_levels": levels
             }
             
         except Exception as e:
@@ -301,19 +1675,44 @@ class SummarizationTool(KnowledgeTool):
 class ComparisonTool(KnowledgeTool):
     """比較分析ツール"""
     
-    def __init__(self, openai_client: AzureOpenAI, deployment_name: str, document_store: DocumentStore):
+    retrieval_k = 5
+    
+    def __init__(
+        self,
+        openai_client: AzureOpenAI,
+        deployment_name: str,
+        document_store: DocumentStore,
+        async_client: Optional[AsyncAzureOpenAI] = None
+    ):
         super().__init__(
             name="comparison",
             description="複数の項目を比較分析します。"
         )
         self.client = openai_client
+        self.async_client = async_client
         self.deployment_name = deployment_name
         self.document_store = document_store
     
+    def _request(self, query: str, search_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """検索結果を元にした比較分析のリクエストパラメータ"""
+        context_text = "\n\n".join([doc["content"] for doc in search_results])
+        return {
+            "model": self.deployment_name,
+            "messages": [
+                {"role": "system", "content": "以下の情報を基に、ユーザーの質問に答えてください。比較分析を行い、違いや共通点を明確にしてください。"},
+                {"role": "user", "content": f"情報:\n{context_text}\n\n質問: {query}"}
+            ],
+            "temperature": 0.5
+        }
+    
     def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
         """比較を実行"""
-        # まず関連ドキュメントを検索
-        search_results = self.document_store.search(query, k=5)
+        # まず関連ドキュメントを検索（共有の検索結果があれば再利用）
+        retrieval = context.get("retrieval") if context else None
+        if retrieval:
+            search_results = retrieval.search(self.retrieval_k)
+        else:
+            search_results = self.document_store.search(query, k=self.retrieval_k)
         
         if not search_results:
             return {
@@ -322,17 +1721,8 @@ class ComparisonTool(KnowledgeTool):
             }
         
         # 検索結果を元に比較分析
-        context_text = "\n\n".join([doc["content"] for doc in search_results])
-        
         try:
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {"role": "system", "content": "以下の情報を基に、ユーザーの質問に答えてください。比較分析を行い、違いや共通点を明確にしてください。"},
-                    {"role": "user", "content": f"情報:\n{context_text}\n\n質問: {query}"}
-                ],
-                temperature=0.5
-            )
+            response = self.client.chat.completions.create(**self._request(query, search_results))
             
             comparison = response.choices[0].message.content
             
@@ -348,6 +1738,510 @@ class ComparisonTool(KnowledgeTool):
                 "success": False,
                 "message": f"比較エラー: {str(e)}"
             }
+    
+    async def aexecute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """比較を非同期で実行"""
+        if self.async_client is None:
+            return await super().aexecute(query, context)
+        
+        retrieval = context.get("retrieval") if context else None
+        if retrieval:
+            search_results = await retrieval.asearch(self.retrieval_k)
+        else:
+            search_results = await self.document_store.asearch(query, k=self.retrieval_k)
+        
+        if not search_results:
+            return {
+                "success": False,
+                "message": "比較するための情報が見つかりませんでした。"
+            }
+        
+        try:
+            response = await self.async_client.chat.completions.create(**self._request(query, search_results))
+            
+            return {
+                "success": True,
+                "comparison": response.choices[0].message.content,
+                "sources": len(search_results)
+            }
+            
+        except Exception as e:
+            logger.error(f"Comparison error: {str(e)}")
+            return {
+                "success": False,
+                "message": f"比較エラー: {str(e)}"
+            }
+
+
+class MultiHopTool(KnowledgeTool):
+    """
+    複数ステップ推論のための反復検索ツール
+    
+    各ホップで「これまでの情報で質問に答えられるか」の判定と、不足時の追加検索クエリの生成を
+    1回のLLM呼び出しで行う。追加クエリのEmbeddingは1回のAPI呼び出しでまとめて取得する。
+    情報が十分と判定された時点、ホップ数の上限、または期限のいずれかで打ち切る。
+    """
+    
+    SYSTEM_PROMPT = """あなたは複数ステップの調査を計画するアシスタントです。
+質問と、これまでに検索した情報を読み、質問に答えるのに情報が十分か判定してください。
+不足している場合は、これまでの情報から分かったことを踏まえて、次に検索すべき具体的な検索クエリを最大{max_queries}個挙げてください。
+検索済みのクエリは繰り返さないでください。
+
+JSON形式で回答してください：{{"sufficient": true または false, "follow_up_queries": ["検索クエリ"], "reasoning": "理由"}}"""
+    
+    # 判定用プロンプトに含めるドキュメント1件あたりの最大トークン数
+    EVIDENCE_SNIPPET_TOKENS = 300
+    
+    def __init__(
+        self,
+        openai_client: AzureOpenAI,
+        deployment_name: str,
+        document_store: DocumentStore,
+        async_client: Optional[AsyncAzureOpenAI] = None
+    ):
+        super().__init__(
+            name="multi_hop",
+            description="途中で分かったことを基に追加検索を繰り返し、複数の情報をつなげて答えます。"
+        )
+        self.client = openai_client
+        self.async_client = async_client
+        self.deployment_name = deployment_name
+        self.document_store = document_store
+        
+        # 1回の検索で取得する件数・追加検索の回数・1ホップあたりのクエリ数・期限
+        self.retrieval_k = int(os.getenv("ROUTER_MULTI_HOP_K", "3"))
+        self.max_hops = int(os.getenv("ROUTER_MULTI_HOP_MAX_HOPS", "3"))
+        self.max_queries = int(os.getenv("ROUTER_MULTI_HOP_MAX_QUERIES", "3"))
+        self.deadline_seconds = float(os.getenv("ROUTER_MULTI_HOP_DEADLINE_SECONDS", "20"))
+    
+    def _request(
+        self,
+        query: str,
+        searched: List[str],
+        evidence: List[Dict[str, Any]],
+        timeout: float
+    ) -> Dict[str, Any]:
+        """充足判定と追加クエリ生成のリクエストパラメータ"""
+        evidence_text = "\n\n".join(
+            f"[{i + 1}] {truncate_to_tokens(doc['content'], self.EVIDENCE_SNIPPET_TOKENS)}"
+            for i, doc in enumerate(evidence)
+        ) or "（なし）"
+        searched_text = "\n".join(f"- {q}" for q in searched)
+        return {
+            "model": self.deployment_name,
+            "messages": [
+                {"role": "system", "content": self.SYSTEM_PROMPT.format(max_queries=self.max_queries)},
+                {"role": "user", "content": f"質問: {query}\n\n検索済みのクエリ:\n{searched_text}\n\n情報:\n{evidence_text}"}
+            ],
+            "temperature": 0.1,
+            "response_format": {"type": "json_object"},
+            "timeout": timeout
+        }
+    
+    def _parse_plan(self, content: str, searched: List[str]) -> Tuple[bool, List[str]]:
+        """（十分か, 未検索の追加クエリ）を取り出す"""
+        plan = json.loads(content)
+        logger.info(f"Multi-hop plan: {plan.get('reasoning', '')}")
+        
+        seen = {normalize_query(q) for q in searched}
+        queries = []
+        for q in plan.get("follow_up_queries") or []:
+            if isinstance(q, str) and q.strip() and normalize_query(q) not in seen:
+                seen.add(normalize_query(q))
+                queries.append(q.strip())
+        return bool(plan.get("sufficient")), queries[:self.max_queries]
+    
+    @staticmethod
+    def _merge(evidence: List[Dict[str, Any]], seen_ids: set, results: List[Dict[str, Any]]):
+        """新しいドキュメントだけをevidenceに追加"""
+        for doc in results:
+            if doc["id"] not in seen_ids:
+                seen_ids.add(doc["id"])
+                evidence.append(doc)
+    
+    def _result(
+        self,
+        evidence: List[Dict[str, Any]],
+        searched: List[str],
+        hops: int,
+        stop_reason: str
+    ) -> Dict[str, Any]:
+        logger.info(f"Multi-hop finished after {hops} hops ({stop_reason}), {len(evidence)} documents")
+        if not evidence:
+            return {
+                "success": False,
+                "message": "関連するドキュメントが見つかりませんでした。",
+                "documents": []
+            }
+        return {
+            "success": True,
+            "message": f"{hops}回の追加検索で{len(evidence)}件のドキュメントを見つけました。",
+            "documents": [
+                {
+                    "content": doc["content"],
+                    "metadata": doc.get("metadata", {}),
+                    "score": doc.get("score", 0)
+                }
+                for doc in evidence
+            ],
+            "queries": searched,
+            "hops": hops,
+            "stop_reason": stop_reason
+        }
+    
+    def execute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """反復検索を実行"""
+        deadline = time.monotonic() + remaining_seconds(self.deadline_seconds)
+        
+        # 最初の検索は共有の検索結果を再利用
+        retrieval = context.get("retrieval") if context else None
+        if retrieval:
+            initial = retrieval.search(self.retrieval_k)
+        else:
+            initial = self.document_store.search(query, k=self.retrieval_k)
+        
+        evidence: List[Dict[str, Any]] = []
+        seen_ids: set = set()
+        self._merge(evidence, seen_ids, initial)
+        searched = [query]
+        
+        hops = 0
+        while True:
+            if hops >= self.max_hops:
+                return self._result(evidence, searched, hops, "hop_budget")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self._result(evidence, searched, hops, "deadline")
+            
+            try:
+                response = self.client.chat.completions.create(**self._request(query, searched, evidence, remaining))
+                sufficient, follow_ups = self._parse_plan(response.choices[0].message.content, searched)
+            except Exception as e:
+                logger.error(f"Multi-hop planning error: {str(e)}")
+                return self._result(evidence, searched, hops, "error")
+            
+            if sufficient:
+                return self._result(evidence, searched, hops, "sufficient")
+            if not follow_ups:
+                return self._result(evidence, searched, hops, "no_follow_up")
+            
+            # 追加クエリはまとめてEmbeddingし、それぞれ検索
+            try:
+                vectors = self.document_store.embed_queries(follow_ups)
+            except Exception as e:
+                logger.error(f"Multi-hop embedding error: {str(e)}")
+                return self._result(evidence, searched, hops, "error")
+            for vector in vectors:
+                self._merge(evidence, seen_ids, self.document_store.search_by_vector(vector, k=self.retrieval_k))
+            searched.extend(follow_ups)
+            hops += 1
+    
+    async def aexecute(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+        """反復検索を非同期で実行"""
+        if self.async_client is None:
+            return await super().aexecute(query, context)
+        
+        deadline = time.monotonic() + remaining_seconds(self.deadline_seconds)
+        
+        retrieval = context.get("retrieval") if context else None
+        if retrieval:
+            initial = await retrieval.asearch(self.retrieval_k)
+        else:
+            initial = await self.document_store.asearch(query, k=self.retrieval_k)
+        
+        evidence: List[Dict[str, Any]] = []
+        seen_ids: set = set()
+        self._merge(evidence, seen_ids, initial)
+        searched = [query]
+        
+        hops = 0
+        while True:
+            if hops >= self.max_hops:
+                return self._result(evidence, searched, hops, "hop_budget")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return self._result(evidence, searched, hops, "deadline")
+            
+            try:
+                response = await self.async_client.chat.completions.create(
+                    **self._request(query, searched, evidence, remaining)
+                )
+                sufficient, follow_ups = self._parse_plan(response.choices[0].message.content, searched)
+            except Exception as e:
+                logger.error(f"Multi-hop planning error: {str(e)}")
+                return self._result(evidence, searched, hops, "error")
+            
+            if sufficient:
+                return self._result(evidence, searched, hops, "sufficient")
+            if not follow_ups:
+                return self._result(evidence, searched, hops, "no_follow_up")
+            
+            try:
+                vectors = await self.document_store.aembed_queries(follow_ups)
+            except Exception as e:
+                logger.error(f"Multi-hop embedding error: {str(e)}")
+                return self._result(evidence, searched, hops, "error")
+            for results in await asyncio.gather(*[
+                asyncio.to_thread(self.document_store.search_by_vector, vector, self.retrieval_k)
+                for vector in vectors
+            ]):
+                self._merge(evidence, seen_ids, results)
+            searched.extend(follow_ups)
+            hops += 1
+
+
+class ContextBuilder:
+    """
+    ツール結果からトークン予算内で回答生成用のコンテキストを組み立てる
+    
+    要約・比較分析などの加工済み結果を優先し、ドキュメントは各ツールの
+    順位を交互に取り出して重複を除きながら詰める。予算に収まらない
+    スニペットは切り詰め、それ以降は含めない。
+    """
+    
+    DEFAULT_BUDGETS = {
+        QueryIntent.FACTUAL_SEARCH: 2000,
+        QueryIntent.SEMANTIC_SEARCH: 3000,
+        QueryIntent.SUMMARIZATION: 4000,
+        QueryIntent.COMPARISON: 3000,
+        QueryIntent.ANALYSIS: 4000,
+        QueryIntent.MULTI_HOP: 4000,
+        QueryIntent.UNKNOWN: 2000,
+    }
+    
+    # これより小さい残り予算では切り詰めたスニペットを入れない
+    MIN_SNIPPET_TOKENS = 50
+    
+    # ツール結果の種類（結果のキー）ごとの見出し。documents は "[<ツール名>の結果]" で箇条書きにする
+    SECTION_TITLES = {
+        "summary": "要約",
+        "comparison": "比較分析",
+    }
+    
+    def __init__(self):
+        # ROUTER_CONTEXT_BUDGET_<INTENT>（例: ROUTER_CONTEXT_BUDGET_SUMMARIZATION）で上書き可能
+        self.budgets = {
+            intent: int(os.getenv(f"ROUTER_CONTEXT_BUDGET_{intent.name}", str(budget)))
+            for intent, budget in self.DEFAULT_BUDGETS.items()
+        }
+    
+    def _snippets(self, tool_results: List[Dict[str, Any]]) -> List[Tuple[int, Tuple[str, str], str]]:
+        """（ツール結果の位置, セクション（ツール名, 種類）, 本文）を優先順に並べる"""
+        derived = []
+        ranked_docs: List[List[Tuple[int, Tuple[str, str], str]]] = []
+        
+        for position, tr in enumerate(tool_results):
+            result = tr["result"]
+            if not result.get("success"):
+                continue
+            
+            if "documents" in result:
+                section = (tr["tool"], "documents")
+                ranked_docs.append([(position, section, doc["content"]) for doc in result["documents"]])
+            else:
+                for kind in self.SECTION_TITLES:
+                    if kind in result:
+                        derived.append((position, (tr["tool"], kind), result[kind]))
+                        break
+        
+        # 各ツールの1位、2位…の順に交互に並べ、同じ内容は1回だけ使う
+        snippets = list(derived)
+        seen = set()
+        for rank in range(max((len(docs) for docs in ranked_docs), default=0)):
+            for docs in ranked_docs:
+                if rank < len(docs) and docs[rank][2] not in seen:
+                    seen.add(docs[rank][2])
+                    snippets.append(docs[rank])
+        
+        return snippets
+    
+    def _format_section(self, section: Tuple[str, str], contents: List[str]) -> str:
+        """セクションを見出し付きで整形（ドキュメントは箇条書き）"""
+        tool_name, kind = section
+        if kind == "documents":
+            body = "\n".join(f"- {content}" for content in contents)
+            return f"[{tool_name}の結果]\n{body}"
+        return f"[{self.SECTION_TITLES[kind]}]\n" + "\n".join(contents)
+    
+    def build(self, intent: QueryIntent, tool_results: List[Dict[str, Any]]) -> Tuple[str, int]:
+        """
+        コンテキストを組み立てる
+        
+        Returns:
+            （コンテキスト文字列, トークン数）。使える情報がなければ（"", 0）
+        """
+        budget = self.budgets.get(intent, self.DEFAULT_BUDGETS[QueryIntent.UNKNOWN])
+        remaining = budget
+        selected: Dict[int, Tuple[Tuple[str, str], List[str]]] = {}
+        
+        for position, section, content in self._snippets(tool_results):
+            tokens = count_tokens(content)
+            if tokens > remaining:
+                if remaining < self.MIN_SNIPPET_TOKENS:
+                    break
+                content = truncate_to_tokens(content, remaining)
+                tokens = remaining
+            
+            selected.setdefault(position, (section, []))[1].append(content)
+            remaining -= tokens
+            if remaining <= 0:
+                break
+        
+        # ツール結果の順にまとめて整形
+        context_parts = [self._format_section(*selected[position]) for position in sorted(selected)]
+        
+        context_text = "\n\n".join(context_parts)
+        return context_text, count_tokens(context_text) if context_text else 0
+
+
+class ModelTiers:
+    """
+    コンポーネントごとに使うデプロイメント（small / large）の割り当てと使用状況
+    
+    意図分類や部分要約など出力の短い処理は小さく速いモデル、最終回答は大きいモデルを使う。
+    AZURE_OPENAI_SMALL_DEPLOYMENT_NAME が未設定なら全て同じデプロイメントになる。
+    """
+    
+    TIERS = ["small", "large"]
+    
+    # コンポーネントの既定の階層（ROUTER_TIER_<COMPONENT>=small/large で上書き可能）
+    DEFAULT_COMPONENT_TIERS = {
+        "classification": "small",  # 意図分類
+        "summary_map": "small",  # 要約のmap/reduce
+        "summary": "small",  # 要約ツールの最終要約
+        "multi_hop": "small",  # 複数ステップ推論の充足判定・追加クエリ生成
+        "comparison": "large",  # 比較分析
+        "answer": "large",  # 最終回答
+    }
+    
+    def __init__(self, large_deployment: str):
+        small_deployment = os.getenv("AZURE_OPENAI_SMALL_DEPLOYMENT_NAME") or large_deployment
+        self.deployments = {"small": small_deployment, "large": large_deployment}
+        
+        self.component_tiers = {}
+        for component, tier in self.DEFAULT_COMPONENT_TIERS.items():
+            tier = os.getenv(f"ROUTER_TIER_{component.upper()}", tier).lower()
+            if tier not in self.TIERS:
+                raise ValueError(f"Unknown model tier for {component}: {tier} (expected one of {self.TIERS})")
+            self.component_tiers[component] = tier
+        
+        self._usage: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+    
+    def deployment(self, component: str) -> str:
+        """コンポーネントが使うデプロイメント名"""
+        return self.deployments[self.component_tiers[component]]
+    
+    def record(self, deployment: str, elapsed_ms: float, usage):
+        """チャット呼び出し1回分の所要時間とトークン数を記録"""
+        with self._lock:
+            entry = self._usage.setdefault(deployment, {
+                "latency": LatencyHistogram(),
+                "prompt_tokens": 0,
+                "completion_tokens": 0
+            })
+            entry["latency"].record(elapsed_ms)
+            if usage is not None:
+                entry["prompt_tokens"] += usage.prompt_tokens or 0
+                entry["completion_tokens"] += usage.completion_tokens or 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """階層ごとのデプロイメント・担当コンポーネント・レイテンシ・トークン使用量"""
+        with self._lock:
+            usage = {
+                deployment: {
+                    "latency": entry["latency"].summary(),
+                    "prompt_tokens": entry["prompt_tokens"],
+                    "completion_tokens": entry["completion_tokens"]
+                }
+                for deployment, entry in self._usage.items()
+            }
+        
+        # small と large が同じデプロイメントの場合は同じ使用状況を指す
+        return {
+            tier: {
+                "deployment": deployment,
+                "components": [c for c, t in self.component_tiers.items() if t == tier],
+                "usage": usage.get(deployment, {})
+            }
+            for tier, deployment in self.deployments.items()
+        }
+    
+    def track(self, client):
+        """チャット呼び出しの所要時間とトークン数を記録するようクライアントを包む"""
+        if client is None:
+            return None
+        return _TrackedClient(client, self)
+
+
+class _TrackedCompletions:
+    """
+    ストリーミングの場合は最後のチャンクで使用量を返させ（stream_usage_options）、
+    ストリームを読み終えた時点で全体の所要時間と使用量を記録する。
+    """
+    
+    def __init__(self, completions, tiers: ModelTiers):
+        self._completions = completions
+        self._tiers = tiers
+    
+    @staticmethod
+    def _with_stream_usage(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        if kwargs.get("stream") and "stream_options" not in kwargs:
+            return {**kwargs, **stream_usage_options()}
+        return kwargs
+    
+    def create(self, **kwargs):
+        kwargs = self._with_stream_usage(kwargs)
+        started = time.perf_counter()
+        response = self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._track_stream(response, kwargs["model"], started)
+        self._tiers.record(kwargs["model"], (time.perf_counter() - started) * 1000, getattr(response, "usage", None))
+        return response
+    
+    def _track_stream(self, stream, model: str, started: float):
+        usage = None
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                yield chunk
+        finally:
+            self._tiers.record(model, (time.perf_counter() - started) * 1000, usage)
+
+
+class _AsyncTrackedCompletions(_TrackedCompletions):
+    async def create(self, **kwargs):
+        kwargs = self._with_stream_usage(kwargs)
+        started = time.perf_counter()
+        response = await self._completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._atrack_stream(response, kwargs["model"], started)
+        self._tiers.record(kwargs["model"], (time.perf_counter() - started) * 1000, getattr(response, "usage", None))
+        return response
+    
+    async def _atrack_stream(self, stream, model: str, started: float):
+        usage = None
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None) or usage
+                yield chunk
+        finally:
+            self._tiers.record(model, (time.perf_counter() - started) * 1000, usage)
+
+
+class _TrackedClient:
+    """chat.completions.create だけを計測し、それ以外は元のクライアントに委ねる"""
+    
+    def __init__(self, client, tiers: ModelTiers):
+        self._client = client
+        completions_class = (
+            _AsyncTrackedCompletions if asyncio.iscoroutinefunction(client.chat.completions.create)
+            else _TrackedCompletions
+        )
+        self.chat = SimpleNamespace(completions=completions_class(client.chat.completions, tiers))
+    
+    def __getattr__(self, name):
+        return getattr(self._client, name)
 
 
 class RouterAgent:
@@ -355,29 +2249,48 @@ class RouterAgent:
     Router Agent - 質問の意図に応じて最適なツールを選択・実行
     """
     
+    # 回答生成が時間切れになった場合に返す情報の最大トークン数
+    FALLBACK_ANSWER_TOKENS = 1000
+    
     def __init__(
         self,
         openai_client: AzureOpenAI,
         deployment_name: str,
         document_store: DocumentStore,
-        search_client: Optional[SearchClient] = None
+        search_client: Optional[SearchClient] = None,
+        async_client: Optional[AsyncAzureOpenAI] = None,
+        async_search_client: Optional[AsyncSearchClient] = None
     ):
+        # コンポーネントごとのデプロイメント（deployment_nameは最終回答などに使う大きいモデル）
+        self.model_tiers = ModelTiers(deployment_name)
+        openai_client = self.model_tiers.track(openai_client)
+        async_client = self.model_tiers.track(async_client)
+        
         self.client = openai_client
-        self.deployment_name = deployment_name
+        self.async_client = async_client
+        self.deployment_name = self.model_tiers.deployment("answer")
         self.document_store = document_store
+        tiers = self.model_tiers
         
         # 意図分類器
-        self.intent_classifier = IntentClassifier(openai_client, deployment_name)
+        self.intent_classifier = IntentClassifier(openai_client, tiers.deployment("classification"), async_client)
+        
+        # 回答生成用コンテキストの組み立て（意図ごとのトークン予算）
+        self.context_builder = ContextBuilder()
         
         # ツール群を初期化
         self.tools: Dict[str, KnowledgeTool] = {
             "semantic_search": SemanticSearchTool(document_store),
-            "summarization": SummarizationTool(openai_client, deployment_name),
-            "comparison": ComparisonTool(openai_client, deployment_name, document_store),
+            "summarization": SummarizationTool(
+                openai_client, tiers.deployment("summary"), document_store, async_client,
+                map_deployment_name=tiers.deployment("summary_map")
+            ),
+            "comparison": ComparisonTool(openai_client, tiers.deployment("comparison"), document_store, async_client),
+            "multi_hop": MultiHopTool(openai_client, tiers.deployment("multi_hop"), document_store, async_client),
         }
         
         if search_client:
-            self.tools["keyword_search"] = KeywordSearchTool(search_client)
+            self.tools["keyword_search"] = KeywordSearchTool(search_client, async_search_client)
         
         # 意図とツールのマッピング
         self.intent_to_tools = {
@@ -386,83 +2299,394 @@ class RouterAgent:
             QueryIntent.SUMMARIZATION: ["semantic_search", "summarization"],
             QueryIntent.COMPARISON: ["comparison"],
             QueryIntent.ANALYSIS: ["semantic_search"],
-            QueryIntent.MULTI_HOP: ["semantic_search", "comparison"],
+            QueryIntent.MULTI_HOP: ["multi_hop"],
             QueryIntent.UNKNOWN: ["semantic_search"],
         }
+        
+        # ツールの並列実行設定
+        self.tool_timeout = float(os.getenv("ROUTER_TOOL_TIMEOUT_SECONDS", "30"))
+        # リクエストの期限のうち最終回答の生成に残しておく時間
+        self.answer_reserve = float(os.getenv("ROUTER_ANSWER_RESERVE_SECONDS", "15"))
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("ROUTER_TOOL_WORKERS", "8")),
+            thread_name_prefix="router-tool"
+        )
+        
+        # 意図分類と並行して意味検索を先行実行する（投機的検索）
+        # ツール実行のスレッドを奪わないよう専用の小さいプールで実行し、空きがなければ先行実行しない
+        self.speculative_retrieval = os.getenv("ROUTER_SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+        prefetch_workers = max(1, int(os.getenv("ROUTER_PREFETCH_WORKERS", "2")))
+        self._prefetch_executor = ThreadPoolExecutor(
+            max_workers=prefetch_workers,
+            thread_name_prefix="router-prefetch"
+        )
+        self._prefetch_slots = threading.BoundedSemaphore(prefetch_workers)
+        
+        # 段階別所要時間の集計（意図別・ツール別のパーセンタイル）
+        self.metrics = RouterMetrics()
+    
+    def _prefetch(self, retrieval: RetrievalContext):
+        """投機的検索を実行（失敗してもツール実行時に再検索される）"""
+        try:
+            retrieval.search(retrieval.k)
+        except Exception as e:
+            logger.warning(f"Speculative retrieval failed: {str(e)}")
+        finally:
+            self._prefetch_slots.release()
+    
+    async def _aprefetch(self, retrieval: RetrievalContext):
+        """_prefetchの非同期版"""
+        try:
+            await retrieval.asearch(retrieval.k)
+        except Exception as e:
+            logger.warning(f"Speculative retrieval failed: {str(e)}")
+    
+    def _tool_budget(self) -> float:
+        """ツール実行に使える時間（リクエストの残り時間から回答生成分を除いた時間とtool_timeoutの小さい方）"""
+        deadline = current_deadline()
+        if deadline is None:
+            return self.tool_timeout
+        return max(0.0, min(self.tool_timeout, deadline.remaining() - self.answer_reserve))
+    
+    def _tool_timeout_result(self, tool_name: str, budget: float) -> Dict[str, Any]:
+        """タイムアウトしたツールの結果"""
+        logger.warning(f"Tool timed out: {tool_name} ({budget:.1f}s)")
+        degrade(f"tool_timeout:{tool_name}")
+        return {
+            "success": False,
+            "message": f"ツールがタイムアウトしました（{budget:.1f}秒）"
+        }
+    
+    def _run_tool(self, tool_name: str, query: str, context: Dict[str, Any]) -> Tuple[Dict[str, Any], float]:
+        """ツールを1つ実行し、結果と所要時間（ミリ秒）を返す（例外は失敗結果にする）"""
+        logger.info(f"Executing tool: {tool_name}")
+        started = time.perf_counter()
+        try:
+            result = self.tools[tool_name].execute(query, context)
+        except Exception as e:
+            logger.error(f"Tool execution error ({tool_name}): {str(e)}")
+            result = {
+                "success": False,
+                "message": f"ツール実行エラー: {str(e)}"
+            }
+        return result, (time.perf_counter() - started) * 1000
+    
+    def _execute_tools(
+        self,
+        query: str,
+        tool_names: List[str],
+        context: Dict[str, Any],
+        timings: StageTimings
+    ) -> List[Dict[str, Any]]:
+        """
+        選択されたツールを並列実行し、選択順に結果を返す
+        
+        タイムアウト（リクエストの期限が近ければ残り時間に合わせて短くする）したツールや
+        例外を送出したツールは失敗結果として扱う。
+        各ツールの所要時間は tool.<ツール名> としてtimingsに記録する。
+        """
+        started = time.monotonic()
+        budget = self._tool_budget()
+        futures = []
+        for tool_name in tool_names:
+            if tool_name in self.tools:
+                futures.append((tool_name, submit_with_context(self._executor, self._run_tool, tool_name, query, context)))
+        
+        tool_results = []
+        for tool_name, future in futures:
+            remaining = budget - (time.monotonic() - started)
+            try:
+                result, elapsed_ms = future.result(timeout=max(0.0, remaining))
+            except FutureTimeoutError:
+                future.cancel()
+                result = self._tool_timeout_result(tool_name, budget)
+                elapsed_ms = (time.monotonic() - started) * 1000
+            
+            timings.add(f"tool.{tool_name}", elapsed_ms)
+            tool_results.append({
+                "tool": tool_name,
+                "result": result
+            })
+        
+        return tool_results
+    
+    async def _aexecute_tools(
+        self,
+        query: str,
+        tool_names: List[str],
+        context: Dict[str, Any],
+        timings: StageTimings
+    ) -> List[Dict[str, Any]]:
+        """_execute_toolsの非同期版（各ツールを同じイベントループ上で並行実行）"""
+        return list(await asyncio.gather(
+            *[self._arun_tool(tool_name, query, context, timings) for tool_name in tool_names if tool_name in self.tools]
+        ))
+    
+    async def _arun_tool(
+        self,
+        tool_name: str,
+        query: str,
+        context: Dict[str, Any],
+        timings: StageTimings
+    ) -> Dict[str, Any]:
+        """ツールを1つ非同期で実行（タイムアウト・例外は失敗結果にする）"""
+        logger.info(f"Executing tool: {tool_name}")
+        budget = self._tool_budget()
+        try:
+            with timings.measure(f"tool.{tool_name}"):
+                result = await asyncio.wait_for(
+                    self.tools[tool_name].aexecute(query, context),
+                    timeout=budget
+                )
+        except asyncio.TimeoutError:
+            result = self._tool_timeout_result(tool_name, budget)
+        except Exception as e:
+            logger.error(f"Tool execution error ({tool_name}): {str(e)}")
+            result = {
+                "success": False,
+                "message": f"ツール実行エラー: {str(e)}"
+            }
+        
+        return {
+            "tool": tool_name,
+            "result": result
+        }
+    
+    def _retrieval_k(self, tool_names: Optional[List[str]] = None) -> int:
+        """ツールが必要とする検索件数の最大値（tool_names省略時は全ツール）"""
+        if tool_names is None:
+            tools = self.tools.values()
+        else:
+            tools = [self.tools[name] for name in tool_names if name in self.tools]
+        return max([tool.retrieval_k for tool in tools], default=0)
     
     def route(self, query: str) -> Dict[str, Any]:
         """
         質問を分析し、最適なツールにルーティングして回答を生成
+        
+        リクエストの期限（未設定なら REQUEST_DEADLINE_SECONDS）の中で処理し、
+        時間が足りない場合は遅いツールを打ち切り、集まった情報で回答する。
         """
+        with deadline_scope():
+            return self._route(query)
+    
+    def _route(self, query: str) -> Dict[str, Any]:
         logger.info(f"=== Router Agent Started ===")
         logger.info(f"Query: {query}")
         
-        # Step 1: 意図を分類
-        intent = self.intent_classifier.classify(query)
-        logger.info(f"Classified intent: {intent.value}")
+        # ほぼ全ての意図で意味検索を使うため、分類の完了を待たずに検索を始める
+        # 件数はどのツールが選ばれても足りるよう全ツールの最大値にする
+        timings = StageTimings()
+        retrieval = RetrievalContext(self.document_store, query, k=0, timings=timings)
+        speculative = (
+            self.speculative_retrieval
+            and bool(self.document_store.documents)
+            and self._prefetch_slots.acquire(blocking=False)
+        )
+        if speculative:
+            retrieval.k = self._retrieval_k()
+            submit_with_context(self._prefetch_executor, self._prefetch, retrieval)
+        
+        # Step 1: 意図を分類（ローカル分類器はクエリEmbeddingを検索と共有する）
+        with timings.measure("classification"):
+            intent, intent_tier = self.intent_classifier.classify_with_tier(
+                query,
+                query_embedding=retrieval.query_embedding if self.document_store.documents else None
+            )
+        logger.info(f"Classified intent: {intent.value} (by {intent_tier})")
         
         # Step 2: 適切なツールを選択
         tool_names = self.intent_to_tools.get(intent, ["semantic_search"])
         logger.info(f"Selected tools: {tool_names}")
         
         # Step 3: ツールを実行
-        tool_results = []
-        for tool_name in tool_names:
-            if tool_name in self.tools:
-                tool = self.tools[tool_name]
-                logger.info(f"Executing tool: {tool_name}")
-                
-                result = tool.execute(query)
-                tool_results.append({
-                    "tool": tool_name,
-                    "result": result
-                })
+        # 検索は選択されたツールが必要とする最大件数で1回だけ行い、結果を共有する
+        # （投機的検索を開始済みならその結果を再利用）
+        if not speculative:
+            retrieval.k = self._retrieval_k(tool_names)
+        
+        # 独立したツールは並列に実行（所要時間は最も遅いツールで決まる）
+        tool_results = self._execute_tools(query, tool_names, {"retrieval": retrieval}, timings)
         
         # Step 4: 結果を統合して最終回答を生成
-        final_answer = self._generate_final_answer(query, intent, tool_results)
+        with timings.measure("generation"):
+            final_answer, token_usage = self._generate_final_answer(query, intent, tool_results)
         
         logger.info(f"=== Router Agent Completed ===")
         
+        return self._route_result(
+            query, intent, intent_tier, tool_names, tool_results, final_answer, token_usage,
+            self._finish_timings(intent, timings)
+        )
+    
+    async def aroute(self, query: str) -> Dict[str, Any]:
+        """routeの非同期版（Embedding・検索・LLM呼び出しでイベントループを塞がない）"""
+        with deadline_scope():
+            return await self._aroute(query)
+    
+    async def _aroute(self, query: str) -> Dict[str, Any]:
+        logger.info(f"=== Router Agent Started (async) ===")
+        logger.info(f"Query: {query}")
+        
+        timings = StageTimings()
+        retrieval = RetrievalContext(self.document_store, query, k=0, timings=timings)
+        speculative = self.speculative_retrieval and bool(self.document_store.documents)
+        prefetch = None
+        if speculative:
+            retrieval.k = self._retrieval_k()
+            prefetch = asyncio.create_task(self._aprefetch(retrieval))
+        
+        try:
+            with timings.measure("classification"):
+                intent, intent_tier = await self.intent_classifier.aclassify_with_tier(
+                    query,
+                    query_embedding=retrieval.aquery_embedding if self.document_store.documents else None
+                )
+            logger.info(f"Classified intent: {intent.value} (by {intent_tier})")
+            
+            tool_names = self.intent_to_tools.get(intent, ["semantic_search"])
+            logger.info(f"Selected tools: {tool_names}")
+            
+            if not speculative:
+                retrieval.k = self._retrieval_k(tool_names)
+            
+            tool_results = await self._aexecute_tools(query, tool_names, {"retrieval": retrieval}, timings)
+        finally:
+            # 投機的検索のタスクを放置しない（例外は_aprefetch内で処理済み）
+            if prefetch is not None:
+                await prefetch
+        
+        with timings.measure("generation"):
+            final_answer, token_usage = await self._agenerate_final_answer(query, intent, tool_results)
+        
+        logger.info(f"=== Router Agent Completed (async) ===")
+        
+        return self._route_result(
+            query, intent, intent_tier, tool_names, tool_results, final_answer, token_usage,
+            self._finish_timings(intent, timings)
+        )
+    
+    async def astream_route(self, query: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        arouteのストリーミング版
+        
+        処理の進捗をイベントとして順に返す:
+            intent: 意図分類の結果
+            tool:   ツールが1つ完了するたび（完了順）
+            token:  最終回答の断片（生成され次第）
+            done:   ルーティング結果（answerは連結済みの全文）
+        """
+        with deadline_scope():
+            async for event in self._astream_route(query):
+                yield event
+    
+    async def _astream_route(self, query: str) -> AsyncIterator[Dict[str, Any]]:
+        logger.info(f"=== Router Agent Started (stream) ===")
+        logger.info(f"Query: {query}")
+        
+        timings = StageTimings()
+        retrieval = RetrievalContext(self.document_store, query, k=0, timings=timings)
+        speculative = self.speculative_retrieval and bool(self.document_store.documents)
+        prefetch = None
+        if speculative:
+            retrieval.k = self._retrieval_k()
+            prefetch = asyncio.create_task(self._aprefetch(retrieval))
+        
+        tasks = []
+        try:
+            with timings.measure("classification"):
+                intent, intent_tier = await self.intent_classifier.aclassify_with_tier(
+                    query,
+                    query_embedding=retrieval.aquery_embedding if self.document_store.documents else None
+                )
+            tool_names = self.intent_to_tools.get(intent, ["semantic_search"])
+            logger.info(f"Classified intent: {intent.value} (by {intent_tier}), tools: {tool_names}")
+            
+            yield {
+                "event": "intent",
+                "intent": intent.value,
+                "intent_tier": intent_tier,
+                "tools": tool_names
+            }
+            
+            if not speculative:
+                retrieval.k = self._retrieval_k(tool_names)
+            
+            context = {"retrieval": retrieval}
+            tasks = [
+                asyncio.create_task(self._arun_tool(tool_name, query, context, timings))
+                for tool_name in tool_names if tool_name in self.tools
+            ]
+            for completed in asyncio.as_completed(tasks):
+                tool_result = await completed
+                yield {
+                    "event": "tool",
+                    "tool": tool_result["tool"],
+                    "success": tool_result["result"].get("success", False)
+                }
+            # 回答生成のコンテキストはツールの選択順で組み立てる
+            tool_results = [task.result() for task in tasks]
+        finally:
+            # クライアント切断などで中断された場合も残りのタスクを片付ける
+            for task in tasks:
+                task.cancel()
+            if prefetch is not None:
+                await prefetch
+        
+        token_usage: Dict[str, int] = {}
+        chunks = []
+        generation_started = time.perf_counter()
+        async for chunk in self._astream_final_answer(query, intent, tool_results, token_usage):
+            if not chunks:
+                # 最初の断片が届くまでの時間（体感の待ち時間）
+                timings.add("first_token", (time.perf_counter() - generation_started) * 1000)
+            chunks.append(chunk)
+            yield {"event": "token", "content": chunk}
+        timings.add("generation", (time.perf_counter() - generation_started) * 1000)
+        
+        logger.info(f"=== Router Agent Completed (stream) ===")
+        
+        yield {
+            "event": "done",
+            **self._route_result(
+                query, intent, intent_tier, tool_names, tool_results, "".join(chunks), token_usage,
+                self._finish_timings(intent, timings)
+            )
+        }
+    
+    def _finish_timings(self, intent: QueryIntent, timings: StageTimings) -> Dict[str, float]:
+        """リクエストの段階別所要時間を確定してメトリクスに記録"""
+        stages = timings.finish()
+        self.metrics.record(intent.value, stages)
+        logger.info(f"Stage timings (ms): {stages}")
+        return stages
+    
+    @staticmethod
+    def _route_result(
+        query: str,
+        intent: QueryIntent,
+        intent_tier: str,
+        tool_names: List[str],
+        tool_results: List[Dict[str, Any]],
+        final_answer: str,
+        token_usage: Dict[str, int],
+        timings: Dict[str, float]
+    ) -> Dict[str, Any]:
         return {
             "success": True,
             "query": query,
             "intent": intent.value,
+            "intent_tier": intent_tier,
             "tools_used": tool_names,
             "tool_results": tool_results,
-            "answer": final_answer
+            "answer": final_answer,
+            "token_usage": token_usage,
+            "timings": timings,
+            "degraded": degraded_reasons()
         }
     
-    def _generate_final_answer(
-        self,
-        query: str,
-        intent: QueryIntent,
-        tool_results: List[Dict[str, Any]]
-    ) -> str:
-        """ツール実行結果を統合して最終回答を生成"""
-        
-        # ツール結果を整形
-        context_parts = []
-        for tr in tool_results:
-            tool_name = tr["tool"]
-            result = tr["result"]
-            
-            if result.get("success"):
-                if "documents" in result:
-                    docs_text = "\n".join([
-                        f"- {doc['content']}" 
-                        for doc in result["documents"][:3]
-                    ])
-                    context_parts.append(f"[{tool_name}の結果]\n{docs_text}")
-                elif "summary" in result:
-                    context_parts.append(f"[要約]\n{result['summary']}")
-                elif "comparison" in result:
-                    context_parts.append(f"[比較分析]\n{result['comparison']}")
-        
-        if not context_parts:
-            return "申し訳ございません。関連する情報が見つかりませんでした。"
-        
-        context_text = "\n\n".join(context_parts)
-        
+    def _final_answer_request(self, query: str, intent: QueryIntent, context_text: str) -> Dict[str, Any]:
+        """最終回答生成のリクエストパラメータ"""
         # 意図に応じたシステムプロンプト
         system_prompts = {
             QueryIntent.FACTUAL_SEARCH: "以下の情報を基に、ユーザーの質問に正確に答えてください。",
@@ -478,21 +2702,343 @@ class RouterAgent:
             "以下の情報を基に、ユーザーの質問に答えてください。"
         )
         
+        return {
+            "model": self.deployment_name,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"情報:\n{context_text}\n\n質問: {query}"}
+            ],
+            "temperature": 0.7
+        }
+    
+    def _fallback_answer(self, context_text: str, error: Exception) -> str:
+        """
+        回答生成に失敗した場合の回答
+        
+        期限切れ・タイムアウトの場合は、エラーにせず集めた情報の抜粋を返す。
+        """
+        if not isinstance(error, (DeadlineExceeded, APITimeoutError)):
+            return f"回答生成中にエラーが発生しました: {str(error)}"
+        
+        degrade("answer_fallback")
+        return (
+            "時間内に回答を生成できなかったため、見つかった関連情報を示します。\n\n"
+            f"{truncate_to_tokens(context_text, self.FALLBACK_ANSWER_TOKENS)}"
+        )
+    
+    @staticmethod
+    def _record_usage(response, token_usage: Dict[str, int]):
+        """APIが返したトークン数をtoken_usageに記録"""
+        if response.usage:
+            token_usage["prompt_tokens"] = response.usage.prompt_tokens
+            token_usage["completion_tokens"] = response.usage.completion_tokens
+    
+    def _generate_final_answer(
+        self,
+        query: str,
+        intent: QueryIntent,
+        tool_results: List[Dict[str, Any]]
+    ) -> Tuple[str, Dict[str, int]]:
+        """
+        ツール実行結果を統合して最終回答を生成
+        
+        Returns:
+            （回答, トークン使用量）。使用量にはコンテキストのトークン数と
+            APIが返したプロンプト・生成トークン数が含まれる
+        """
+        
+        # ツール結果をトークン予算内で整形
+        context_text, context_tokens = self.context_builder.build(intent, tool_results)
+        token_usage = {"context_tokens": context_tokens}
+        
+        if not context_text:
+            return "申し訳ございません。関連する情報が見つかりませんでした。", token_usage
+        
         try:
             response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"情報:\n{context_text}\n\n質問: {query}"}
-                ],
-                temperature=0.7
+                **self._final_answer_request(query, intent, context_text)
+            )
+            self._record_usage(response, token_usage)
+            
+            return response.choices[0].message.content, token_usage
+            
+        except Exception as e:
+            logger.error(f"Answer generation error: {str(e)}")
+            return self._fallback_answer(context_text, e), token_usage
+    
+    async def _agenerate_final_answer(
+        self,
+        query: str,
+        intent: QueryIntent,
+        tool_results: List[Dict[str, Any]]
+    ) -> Tuple[str, Dict[str, int]]:
+        """_generate_final_answerの非同期版"""
+        if self.async_client is None:
+            return await asyncio.to_thread(self._generate_final_answer, query, intent, tool_results)
+        
+        context_text, context_tokens = self.context_builder.build(intent, tool_results)
+        token_usage = {"context_tokens": context_tokens}
+        
+        if not context_text:
+            return "申し訳ございません。関連する情報が見つかりませんでした。", token_usage
+        
+        try:
+            response = await self.async_client.chat.completions.create(
+                **self._final_answer_request(query, intent, context_text)
             )
+            self._record_usage(response, token_usage)
             
-            return response.choices[0].message.content
+            return response.choices[0].message.content, token_usage
             
         except Exception as e:
             logger.error(f"Answer generation error: {str(e)}")
-            return f"回答生成中にエラーが発生しました: {str(e)}"
+            return self._fallback_answer(context_text, e), token_usage
+    
+    async def _astream_final_answer(
+        self,
+        query: str,
+        intent: QueryIntent,
+        tool_results: List[Dict[str, Any]],
+        token_usage: Dict[str, int]
+    ) -> AsyncIterator[str]:
+        """
+        最終回答を生成され次第、断片ごとに返す（トークン使用量はtoken_usageに書き込む）
+        
+        非同期クライアントがなければ回答全体を1つの断片として返す。
+        """
+        if self.async_client is None:
+            answer, usage = await self._agenerate_final_answer(query, intent, tool_results)
+            token_usage.update(usage)
+            yield answer
+            return
+        
+        context_text, context_tokens = self.context_builder.build(intent, tool_results)
+        token_usage["context_tokens"] = context_tokens
+        
+        if not context_text:
+            yield "申し訳ございません。関連する情報が見つかりませんでした。"
+            return
+        
+        streamed = False
+        try:
+            stream = await self.async_client.chat.completions.create(
+                **self._final_answer_request(query, intent, context_text),
+                stream=True
+            )
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    self._record_usage(chunk, token_usage)
+                # Azureはコンテンツフィルター結果のみのチャンク（choicesが空）を返すことがある
+                if chunk.choices and chunk.choices[0].delta.content:
+                    streamed = True
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            logger.error(f"Answer generation error: {str(e)}")
+            if streamed and isinstance(e, (DeadlineExceeded, APITimeoutError)):
+                # 途中まで返した回答はそのまま打ち切る
+                degrade("answer_truncated")
+                return
+            yield self._fallback_answer(context_text, e)
+
+
+class SemanticAnswerCache:
+    """
+    クエリEmbeddingの類似度で引く回答キャッシュ
+    
+    類似度がしきい値以上の過去の質問があれば、その回答を返す。
+    各エントリは登録時のDocumentStoreのバージョンを持ち、
+    ドキュメントが更新された後は使われない。
+    """
+    
+    def __init__(self, max_entries: int, ttl_seconds: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        size = max(max_entries, 0)
+        # スロットごとの状態を配列で持ち、検索時の有効判定を1回のベクトル演算で行う
+        self._keys: Optional[np.ndarray] = None  # 正規化済みクエリベクトル
+        self._versions = np.full(size, -1, dtype=np.int64)  # 登録時のバージョン（-1は空き）
+        self._created_at = np.zeros(size, dtype=np.float64)
+        self._last_used = np.zeros(size, dtype=np.float64)
+        self._results: List[Optional[Dict[str, Any]]] = [None] * size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+    
+    def get(self, query_embedding: np.ndarray, version: int) -> Optional[Tuple[Dict[str, Any], float]]:
+        """類似した質問の回答と類似度を取得（該当なしならNone）"""
+        vector = query_embedding / np.linalg.norm(query_embedding)
+        now = time.monotonic()
+        
+        with self._lock:
+            if self._keys is None:
+                self.misses += 1
+                return None
+            
+            similarities = self._keys @ vector
+            # 空き・別バージョン・期限切れのスロットを除外
+            valid = (self._versions == version) & (now - self._created_at <= self.ttl_seconds)
+            similarities[~valid] = -np.inf
+            
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            
+            self._last_used[best] = now
+            self.hits += 1
+            return self._results[best], float(similarities[best])
+    
+    def put(self, query_embedding: np.ndarray, version: int, result: Dict[str, Any]):
+        """回答を登録（満杯なら最も長く使われていないエントリを置き換える）"""
+        if not self.enabled:
+            return
+        
+        vector = query_embedding / np.linalg.norm(query_embedding)
+        now = time.monotonic()
+        
+        with self._lock:
+            if self._keys is None:
+                self._keys = np.zeros((self.max_entries, len(vector)), dtype='float32')
+            
+            # 空きスロットは最終使用時刻を-infとみなして優先する
+            index = int(np.argmin(np.where(self._versions < 0, -np.inf, self._last_used)))
+            
+            self._keys[index] = vector
+            self._versions[index] = version
+            self._created_at[index] = now
+            self._last_used[index] = now
+            self._results[index] = result
+    
+    def invalidate(self):
+        """全エントリを破棄"""
+        with self._lock:
+            self._versions[:] = -1
+            self._results = [None] * len(self._results)
+            if self._keys is not None:
+                self._keys[:] = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率などの統計情報"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": int(np.count_nonzero(self._versions >= 0)),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+class SingleFlight:
+    """
+    同じキーの同時実行を1回にまとめる（single-flight）
+    
+    最初の呼び出し（リーダー）だけが関数を実行し、実行中に同じキーで来た呼び出しは
+    その完了を待って同じ結果を受け取る。完了後の呼び出しは改めて実行する。
+    待つ呼び出しは自分のリクエストの期限までしか待たず、間に合わなければ自分で実行する。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Dict[str, Any]] = {}
+        self._async_calls: Dict[str, asyncio.Task] = {}
+        self.executions = 0
+        self.shared = 0
+    
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """fnを実行（または実行中の結果を待つ）し、（結果, 共有したか）を返す"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event()}
+                self._calls[key] = call
+                self.executions += 1
+            else:
+                self.shared += 1
+        
+        if not leader:
+            if not call["done"].wait(remaining_seconds()):
+                return self._run_after_wait_timeout(key, fn), False
+            if "error" in call:
+                raise call["error"]
+            return call["result"], True
+        
+        try:
+            call["result"] = fn()
+            return call["result"], False
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+    
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        doの非同期版（同じイベントループ上の呼び出しをまとめる）
+        
+        fnは呼び出し元から切り離したタスクで実行するため、リーダーがキャンセルされても
+        （クライアントの切断など）実行は続き、待っている他の呼び出しは結果を受け取れる。
+        """
+        with self._lock:
+            task = self._async_calls.get(key)
+            leader = task is None
+            if leader:
+                task = asyncio.get_running_loop().create_task(self._arun(key, fn))
+                # 待つ呼び出しが全てキャンセルされた場合に未回収の例外として警告されないようにする
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                self._async_calls[key] = task
+                self.executions += 1
+            else:
+                self.shared += 1
+        
+        # キャンセルされるのは待っている呼び出しだけで、共有の実行は止めない
+        if leader:
+            return await asyncio.shield(task), False
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), remaining_seconds()), True
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            return await self._arun_after_wait_timeout(key, fn), False
+    
+    @staticmethod
+    def _wait_timed_out(key: str):
+        logger.warning(f"Coalesced request did not finish before the deadline, running it separately: {key}")
+        degrade("coalesce_wait_timeout")
+    
+    def _run_after_wait_timeout(self, key: str, fn: Callable[[], Any]) -> Any:
+        """期限までにリーダーの実行が終わらなかった場合に自分で実行する"""
+        self._wait_timed_out(key)
+        return fn()
+    
+    async def _arun_after_wait_timeout(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """_run_after_wait_timeoutの非同期版"""
+        self._wait_timed_out(key)
+        return await fn()
+    
+    async def _arun(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return await fn()
+        finally:
+            with self._lock:
+                del self._async_calls[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.executions + self.shared
+            return {
+                "executions": self.executions,
+                "shared": self.shared,
+                "shared_rate": self.shared / total if total else 0.0
+            }
 
 
 class AzureRouterRAG:
@@ -501,53 +3047,313 @@ class AzureRouterRAG:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
         
-        # Azure OpenAI クライアント
-        self.openai_client = AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-        )
+        # Azure OpenAI クライアント（クォータに合わせた流量制御・429の再試行付き）
+        self.openai_client = create_openai_client()
+        
+        # 非同期パイプライン（aquery）用の Azure OpenAI クライアント（同期版とクォータを共有）
+        self.async_openai_client = create_async_openai_client()
         
         self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4")
         self.embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002")
         
         # ドキュメントストア
-        self.document_store = DocumentStore(self.openai_client, self.embedding_deployment)
+        self.document_store = DocumentStore(
+            self.openai_client, self.embedding_deployment, self.async_openai_client
+        )
         
         # Azure AI Search クライアント（オプション）
         self.search_client = None
+        self.async_search_client = None
         if os.getenv("AZURE_SEARCH_ENDPOINT") and os.getenv("AZURE_SEARCH_API_KEY"):
             try:
-                self.search_client = SearchClient(
-                    endpoint=os.getenv("AZURE_SEARCH_ENDPOINT"),
-                    index_name=os.getenv("AZURE_SEARCH_INDEX_NAME", "gptlike-index"),
-                    credential=AzureKeyCredential(os.getenv("AZURE_SEARCH_API_KEY"))
-                )
+                search_settings = {
+                    "endpoint": os.getenv("AZURE_SEARCH_ENDPOINT"),
+                    "index_name": os.getenv("AZURE_SEARCH_INDEX_NAME", "gptlike-index"),
+                    "credential": AzureKeyCredential(os.getenv("AZURE_SEARCH_API_KEY"))
+                }
+                self.search_client = SearchClient(**search_settings)
+                self.async_search_client = AsyncSearchClient(**search_settings)
             except Exception as e:
                 self.logger.warning(f"Azure AI Search初期化失敗: {str(e)}")
         
+        # Azure Blob Storage クライアント（スナップショット保存用、オプション）
+        self.blob_service_client = None
+        if os.getenv("AZURE_STORAGE_CONNECTION_STRING"):
+            try:
+                self.blob_service_client = BlobServiceClient.from_connection_string(
+                    os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+                )
+            except Exception as e:
+                self.logger.warning(f"Azure Blob Storage初期化失敗: {str(e)}")
+        
+        # インデックススナップショット設定
+        self.snapshot_container = os.getenv("ROUTER_SNAPSHOT_BLOB_CONTAINER")
+        self.snapshot_blob_prefix = os.getenv("ROUTER_SNAPSHOT_BLOB_PREFIX", "router-snapshot")
+        self.snapshot_path = os.getenv("ROUTER_SNAPSHOT_PATH") or (
+            os.path.join(tempfile.gettempdir(), "router-snapshot") if self.snapshot_container else None
+        )
+        self.snapshot_autosave = os.getenv("ROUTER_SNAPSHOT_AUTOSAVE", "false").lower() == "true"
+        
+        # 類似質問の回答キャッシュ（ROUTER_ANSWER_CACHE_SIZE=0で無効）
+        self.answer_cache = SemanticAnswerCache(
+            max_entries=int(os.getenv("ROUTER_ANSWER_CACHE_SIZE", "1024")),
+            ttl_seconds=float(os.getenv("ROUTER_ANSWER_CACHE_TTL_SECONDS", "600")),
+            threshold=float(os.getenv("ROUTER_ANSWER_CACHE_THRESHOLD", "0.97"))
+        )
+        
+        # 同じ質問の同時リクエストを1回の実行にまとめる
+        self.coalesce_requests = os.getenv("ROUTER_COALESCE_REQUESTS", "true").lower() == "true"
+        self.single_flight = SingleFlight()
+        
         # Router Agent を初期化
         self.agent = RouterAgent(
             openai_client=self.openai_client,
             deployment_name=self.deployment_name,
             document_store=self.document_store,
-            search_client=self.search_client
+            search_client=self.search_client,
+            async_client=self.async_openai_client,
+            async_search_client=self.async_search_client
         )
     
-    def load_documents_from_texts(self, texts: List[str], metadata: Optional[List[Dict]] = None) -> bool:
-        """テキストからドキュメントをロード"""
+    def _snapshot_container_client(self):
+        """スナップショット用のBlobコンテナクライアントを取得（未設定ならNone）"""
+        if not self.snapshot_container or not self.blob_service_client:
+            return None
+        return self.blob_service_client.get_container_client(self.snapshot_container)
+    
+    def save_snapshot(self) -> bool:
+        """インデックスと意図分類の重心のスナップショットをローカル（設定時はBlobにも）保存"""
+        if not self.snapshot_path:
+            self.logger.warning("スナップショットの保存先が設定されていません")
+            return False
+        
         try:
-            self.document_store.add_documents(texts, metadata)
-            self.logger.info(f"{len(texts)}個のドキュメントをロードしました")
+            self.document_store.save_snapshot(self.snapshot_path)
+            self.agent.intent_classifier.local.save(
+                os.path.join(self.snapshot_path, INTENT_CENTROIDS_FILE),
+                self.document_store.embedding_deployment
+            )
+            
+            container_client = self._snapshot_container_client()
+            if container_client:
+                for name in SNAPSHOT_FILES + [INTENT_CENTROIDS_FILE]:
+                    with open(os.path.join(self.snapshot_path, name), "rb") as f:
+                        container_client.upload_blob(
+                            f"{self.snapshot_blob_prefix}/{name}", f, overwrite=True
+                        )
             return True
+        except Exception as e:
+            self.logger.error(f"スナップショット保存エラー: {str(e)}")
+            return False
+    
+    def _load_snapshot_dir(self, path: str) -> bool:
+        """ディレクトリからドキュメントと意図分類の重心を読み込む"""
+        path = resolve_snapshot_dir(path)
+        self.agent.intent_classifier.local.load(
+            os.path.join(path, INTENT_CENTROIDS_FILE),
+            self.document_store.embedding_deployment
+        )
+        return self.document_store.load_snapshot(path)
+    
+    def restore_snapshot(self) -> bool:
+        """起動時にスナップショット（Blob設定時はBlobから取得）を復元"""
+        if not self.snapshot_path:
+            return False
+        
+        try:
+            container_client = self._snapshot_container_client()
+            if container_client:
+                download_dir = tempfile.mkdtemp(prefix="router-snapshot-")
+                try:
+                    for name in SNAPSHOT_FILES:
+                        with open(os.path.join(download_dir, name), "wb") as f:
+                            container_client.download_blob(
+                                f"{self.snapshot_blob_prefix}/{name}"
+                            ).readinto(f)
+                    try:
+                        with open(os.path.join(download_dir, INTENT_CENTROIDS_FILE), "wb") as f:
+                            container_client.download_blob(
+                                f"{self.snapshot_blob_prefix}/{INTENT_CENTROIDS_FILE}"
+                            ).readinto(f)
+                    except ResourceNotFoundError:
+                        # 重心を含まない以前のスナップショット
+                        os.remove(os.path.join(download_dir, INTENT_CENTROIDS_FILE))
+                    restored = self._load_snapshot_dir(download_dir)
+                finally:
+                    shutil.rmtree(download_dir, ignore_errors=True)
+            else:
+                restored = self._load_snapshot_dir(self.snapshot_path)
+            
+            if restored:
+                self.answer_cache.invalidate()
+                self.logger.info(f"スナップショットから{len(self.document_store.documents)}個のドキュメントを復元しました")
+            return restored
+        except Exception as e:
+            self.logger.warning(f"スナップショット復元失敗: {str(e)}")
+            return False
+    
+    def load_documents_from_texts(self, texts: List[str], metadata: Optional[List[Dict]] = None) -> Dict[str, Any]:
+        """
+        テキストからドキュメントをロード
+        
+        一部のEmbeddingに失敗しても成功分はインデックスに追加される。
+        
+        Returns:
+            success（全件成功したか）、loaded（追加した件数）、failed（失敗したテキストのインデックス）、message
+        """
+        try:
+            failed = self.document_store.add_documents(texts, metadata)
+            self.answer_cache.invalidate()
+            if self.snapshot_autosave and len(failed) < len(texts):
+                self.save_snapshot()
         except Exception as e:
             self.logger.error(f"ドキュメントロードエラー: {str(e)}")
+            return {
+                "success": False,
+                "loaded": 0,
+                "failed": list(range(len(texts))),
+                "message": f"ドキュメントロードエラー: {str(e)}"
+            }
+        
+        loaded = len(texts) - len(failed)
+        if failed:
+            message = f"{loaded}/{len(texts)}個のドキュメントをロードしました（失敗: {failed}）"
+            self.logger.error(message)
+        else:
+            message = f"{len(texts)}個のドキュメントをロードしました"
+            self.logger.info(message)
+        return {
+            "success": not failed,
+            "loaded": loaded,
+            "failed": failed,
+            "message": message
+        }
+    
+    def rebuild_index(self) -> bool:
+        """ベクトルインデックスを再構築"""
+        try:
+            self.document_store.rebuild_index()
+            return True
+        except Exception as e:
+            self.logger.error(f"インデックス再構築エラー: {str(e)}")
             return False
     
+    def _cached_answer(
+        self,
+        question: str,
+        query_embedding: np.ndarray,
+        version: int,
+        timings: StageTimings
+    ) -> Optional[Dict[str, Any]]:
+        """回答キャッシュを引き、ヒットすれば応答を返す（所要時間はcache_hitとして集計）"""
+        cached = self.answer_cache.get(query_embedding, version)
+        if not cached:
+            return None
+        result, similarity = cached
+        self.logger.info(f"回答キャッシュにヒットしました（類似度: {similarity:.3f}）")
+        stages = timings.finish()
+        self.agent.metrics.record("cache_hit", stages)
+        return {
+            **result,
+            "query": question,
+            "cached": True,
+            "cache_similarity": similarity,
+            "timings": stages
+        }
+    
+    def _coalesce_key(self, question: str) -> str:
+        """同時リクエストをまとめるキー（正規化した質問とドキュメントのバージョン）"""
+        return f"{self.document_store.version}:{normalize_query(question)}"
+    
+    def _shared_result(self, question: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        """他のリクエストの実行結果を自分の応答として返す"""
+        return {**result, "query": question, "coalesced": True}
+    
     def query(self, question: str) -> Dict[str, Any]:
-        """Router Agentに質問を投げる"""
+        """
+        Router Agentに質問を投げる（類似質問の回答がキャッシュにあれば再利用）
+        
+        同じ質問（正規化後）が実行中であれば、その結果を待って共有する。
+        """
+        # 待つ場合も自分のリクエストの期限までにする
+        with deadline_scope():
+            if not self.coalesce_requests:
+                return self._query(question)
+            
+            result, shared = self.single_flight.do(self._coalesce_key(question), lambda: self._query(question))
+            return self._shared_result(question, result) if shared else result
+    
+    def _query(self, question: str) -> Dict[str, Any]:
+        with deadline_scope():
+            return self._query_with_deadline(question)
+    
+    def _query_with_deadline(self, question: str) -> Dict[str, Any]:
         try:
+            query_embedding = None
+            version = self.document_store.version
+            
+            if self.answer_cache.enabled and self.document_store.documents:
+                try:
+                    timings = StageTimings()
+                    with timings.measure("embedding"):
+                        query_embedding = self.document_store.embed_query(question)
+                    cached = self._cached_answer(question, query_embedding, version, timings)
+                    if cached:
+                        return cached
+                except Exception as e:
+                    self.logger.warning(f"回答キャッシュ参照エラー: {str(e)}")
+                    query_embedding = None
+            
             result = self.agent.route(question)
+            
+            # 時間切れで省略した回答はキャッシュしない
+            if result.get("success") and not result.get("degraded") and query_embedding is not None:
+                self.answer_cache.put(query_embedding, version, result)
+            
+            return result
+        except Exception as e:
+            self.logger.error(f"クエリ実行エラー: {str(e)}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    async def aquery(self, question: str) -> Dict[str, Any]:
+        """queryの非同期版（AsyncAzureOpenAIとaioのSearchClientを使用）"""
+        with deadline_scope():
+            if not self.coalesce_requests:
+                return await self._aquery(question)
+            
+            result, shared = await self.single_flight.ado(self._coalesce_key(question), lambda: self._aquery(question))
+            return self._shared_result(question, result) if shared else result
+    
+    async def _aquery(self, question: str) -> Dict[str, Any]:
+        with deadline_scope():
+            return await self._aquery_with_deadline(question)
+    
+    async def _aquery_with_deadline(self, question: str) -> Dict[str, Any]:
+        try:
+            query_embedding = None
+            version = self.document_store.version
+            
+            if self.answer_cache.enabled and self.document_store.documents:
+                try:
+                    timings = StageTimings()
+                    with timings.measure("embedding"):
+                        query_embedding = await self.document_store.aembed_query(question)
+                    cached = self._cached_answer(question, query_embedding, version, timings)
+                    if cached:
+                        return cached
+                except Exception as e:
+                    self.logger.warning(f"回答キャッシュ参照エラー: {str(e)}")
+                    query_embedding = None
+            
+            result = await self.agent.aroute(question)
+            
+            # 時間切れで省略した回答はキャッシュしない
+            if result.get("success") and not result.get("degraded") and query_embedding is not None:
+                self.answer_cache.put(query_embedding, version, result)
+            
             return result
         except Exception as e:
             self.logger.error(f"クエリ実行エラー: {str(e)}")
@@ -555,6 +3361,56 @@ class AzureRouterRAG:
                 "success": False,
                 "error": str(e)
             }
+    
+    async def astream_query(self, question: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        aqueryのストリーミング版（イベントはRouterAgent.astream_routeを参照）
+        
+        回答キャッシュにヒットした場合は intent → token（全文）→ done の順に即座に返す。
+        エラー時は error イベントを返して終了する。
+        """
+        with deadline_scope():
+            async for event in self._astream_query(question):
+                yield event
+    
+    async def _astream_query(self, question: str) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            query_embedding = None
+            version = self.document_store.version
+            
+            if self.answer_cache.enabled and self.document_store.documents:
+                try:
+                    timings = StageTimings()
+                    with timings.measure("embedding"):
+                        query_embedding = await self.document_store.aembed_query(question)
+                    cached = self._cached_answer(question, query_embedding, version, timings)
+                    if cached:
+                        yield {
+                            "event": "intent",
+                            "intent": cached.get("intent"),
+                            "intent_tier": cached.get("intent_tier"),
+                            "tools": cached.get("tools_used", [])
+                        }
+                        yield {"event": "token", "content": cached.get("answer", "")}
+                        yield {"event": "done", **cached}
+                        return
+                except Exception as e:
+                    self.logger.warning(f"回答キャッシュ参照エラー: {str(e)}")
+                    query_embedding = None
+            
+            async for event in self.agent.astream_route(question):
+                if event["event"] == "done":
+                    result = {k: v for k, v in event.items() if k != "event"}
+                    if result.get("success") and not result.get("degraded") and query_embedding is not None:
+                        self.answer_cache.put(query_embedding, version, result)
+                yield event
+        except Exception as e:
+            self.logger.error(f"クエリ実行エラー: {str(e)}")
+            yield {
+                "event": "error",
+                "success": False,
+                "error": str(e)
+            }
 
 
 # シングルトンインスタンス
@@ -566,4 +3422,6 @@ def get_router_agent() -> AzureRouterRAG:
     global _router_agent_instance
     if _router_agent_instance is None:
         _router_agent_instance = AzureRouterRAG()
+        # 保存済みスナップショットがあれば復元（Embeddingの再計算を避ける）
+        _router_agent_instance.restore_snapshot()
     return _router_agent_instance
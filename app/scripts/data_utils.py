@@ -3,6 +3,7 @@ import ast
 import html
 import json
 import os
+import random
 import re
 import ssl
 import subprocess
@@ -53,6 +54,8 @@ FILE_FORMAT_DICT = {
     }
 
 RETRY_COUNT = 5
+RETRY_BACKOFF_BASE_SECONDS = 2
+RETRY_BACKOFF_MAX_SECONDS = 60
 
 SENTENCE_ENDINGS = [".", "!", "?"]
 WORDS_BREAKS = list(reversed([",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]))
@@ -735,6 +738,25 @@ def merge_chunks_serially(chunked_content_list: List[str], num_tokens: int, cont
     if total_size > 0:
         yield current_chunk, total_size
 
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retrying: the server's retry-after if present, else jittered exponential backoff."""
+    # Walk the exception chain so wrapped SDK / HTTP errors still expose their response headers
+    while error is not None:
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+        if headers:
+            try:
+                if headers.get("retry-after-ms"):
+                    return float(headers["retry-after-ms"]) / 1000
+                if headers.get("retry-after"):
+                    return float(headers["retry-after"])
+            except ValueError:
+                pass
+        error = error.__cause__
+
+    return random.uniform(0, min(RETRY_BACKOFF_MAX_SECONDS, RETRY_BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
 def get_payload_and_headers_cohere(
     text, aad_token) -> Tuple[Dict, Dict]:
     oai_headers =  {
@@ -766,7 +788,8 @@ def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None,
             else:
                 api_key = embedding_model_key if embedding_model_key else os.getenv("AZURE_OPENAI_API_KEY")
             
-            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key)
+            # Retries are handled by the caller (see get_retry_delay)
+            client = AzureOpenAI(api_version=api_version, azure_endpoint=base_url, api_key=api_key, max_retries=0)
             if FLAG_AOAI == "V2":
                 embeddings = client.embeddings.create(model=deployment_id, input=text)
             elif FLAG_AOAI == "V3":   
@@ -793,7 +816,7 @@ def get_embedding(text, embedding_model_endpoint=None, embedding_model_key=None,
         
 
     except Exception as e:
-        raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}")
+        raise Exception(f"Error getting embeddings with endpoint={endpoint} with error={e}") from e
 
 
 def chunk_content_helper(
@@ -895,7 +918,7 @@ def chunk_content(
                             break
                         except Exception as e:
                             print(f"Error getting embedding for chunk with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-                            time.sleep(30)
+                            time.sleep(get_retry_delay(e, i))
                     if doc.contentVector is None:
                         raise Exception(f"Error getting embedding for chunk={chunk}")
                     
@@ -986,7 +1009,7 @@ def get_caption(image_path, captioning_model_endpoint, captioning_model_key):
             break
         except Exception as e:
             print(f"Error getting caption with error={e}, retrying, current at {i + 1} retry, {RETRY_COUNT - (i + 1)} retries left")
-            time.sleep(15)
+            time.sleep(get_retry_delay(e, i))
 
     if response.status_code != 200:
         raise Exception(f"Error getting caption with status_code={response.status_code}")
@@ -3,10 +3,14 @@ Entra ID (Azure AD) 認証とトークン検証
 """
 
 import os
+import hashlib
 import logging
-from typing import Optional, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
 import jwt
-from jwt import PyJWKClient
+from jwt import PyJWK, PyJWKClient
 import azure.functions as func
 
 logger = logging.getLogger(__name__)
@@ -20,12 +24,131 @@ JWKS_URI = f"https://login.microsoftonline.com/{TENANT_ID}/discovery/v2.0/keys"
 # 認証を有効にするかどうか
 AUTH_ENABLED = os.getenv("ENABLE_ENTRA_AUTH", "false").lower() == "true"
 
+# 署名鍵（JWKS）をバックグラウンドで再取得する間隔と、未知のkidで再取得する最短間隔（秒）
+JWKS_REFRESH_SECONDS = float(os.getenv("ENTRA_JWKS_REFRESH_SECONDS", "3600"))
+JWKS_MIN_REFETCH_SECONDS = float(os.getenv("ENTRA_JWKS_MIN_REFETCH_SECONDS", "30"))
+
+# 検証済みトークンのキャッシュ件数（0で無効）
+TOKEN_CACHE_SIZE = int(os.getenv("ENTRA_TOKEN_CACHE_SIZE", "1024"))
+
 
 class AuthenticationError(Exception):
     """認証エラー"""
     pass
 
 
+# JWKSクライアント（プロセス内で共有し、署名鍵はメモリ上のキャッシュから引く）
+_jwks_client: Optional[PyJWKClient] = None
+_jwks_lock = threading.Lock()
+_jwks_last_refetch = 0.0
+
+# 検証済みトークンのペイロード（トークンのハッシュ → (ペイロード, 有効期限)）
+_token_cache: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def _refresh_jwks_periodically(client: PyJWKClient):
+    """署名鍵を定期的に再取得（リクエスト処理中に取得待ちが発生しないようにする）"""
+    while True:
+        time.sleep(JWKS_REFRESH_SECONDS)
+        try:
+            client.get_jwk_set(refresh=True)
+            logger.debug("JWKS refreshed")
+        except Exception as e:
+            # 失敗してもキャッシュの有効期限までは既存の鍵で検証を続ける
+            logger.warning(f"JWKS refresh failed: {str(e)}")
+
+
+def get_jwks_client() -> PyJWKClient:
+    """JWKSクライアントを取得（シングルトン、初回にバックグラウンド更新を開始）"""
+    global _jwks_client
+    with _jwks_lock:
+        if _jwks_client is None:
+            # キャッシュはバックグラウンド更新が失敗し続けた場合にだけ期限切れになる
+            _jwks_client = PyJWKClient(JWKS_URI, lifespan=JWKS_REFRESH_SECONDS * 2)
+            threading.Thread(
+                target=_refresh_jwks_periodically,
+                args=(_jwks_client,),
+                name="entra-jwks-refresh",
+                daemon=True
+            ).start()
+        return _jwks_client
+
+
+def _find_signing_key(signing_keys: List[PyJWK], kid: str) -> Optional[PyJWK]:
+    for signing_key in signing_keys:
+        if signing_key.key_id == kid:
+            return signing_key
+    return None
+
+
+def get_signing_key(token: str) -> PyJWK:
+    """
+    トークンのkidに対応する署名鍵を取得
+    
+    キャッシュにないkidは鍵のローテーションとみなしてJWKSを再取得する
+    （不正なkidで取得が繰り返されないよう、再取得はJWKS_MIN_REFETCH_SECONDSに1回まで）。
+    """
+    global _jwks_last_refetch
+    kid = jwt.get_unverified_header(token).get("kid")
+    if not kid:
+        raise AuthenticationError("Token header has no kid")
+    
+    client = get_jwks_client()
+    signing_key = _find_signing_key(client.get_signing_keys(), kid)
+    if signing_key is None:
+        # ロックは最終取得時刻の確認・更新だけに使い、取得中も他のリクエストの検証を止めない
+        with _jwks_lock:
+            now = time.monotonic()
+            refetch = now - _jwks_last_refetch >= JWKS_MIN_REFETCH_SECONDS
+            if refetch:
+                _jwks_last_refetch = now
+        if refetch:
+            logger.info(f"Unknown signing key id {kid}, refetching JWKS")
+            signing_key = _find_signing_key(client.get_signing_keys(refresh=True), kid)
+        else:
+            signing_key = _find_signing_key(client.get_signing_keys(), kid)
+    
+    if signing_key is None:
+        raise AuthenticationError(f"Unable to find a signing key that matches: {kid}")
+    return signing_key
+
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _get_cached_payload(key: str) -> Optional[Dict[str, Any]]:
+    """有効期限内の検証済みペイロードを取得"""
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+        if entry is None:
+            return None
+        payload, expires_at = entry
+        if time.time() >= expires_at:
+            del _token_cache[key]
+            return None
+        _token_cache.move_to_end(key)
+        return dict(payload)
+
+
+def _cache_payload(key: str, payload: Dict[str, Any]):
+    """検証済みペイロードをトークンの有効期限（exp）まで保存"""
+    if TOKEN_CACHE_SIZE <= 0 or "exp" not in payload:
+        return
+    with _token_cache_lock:
+        _token_cache[key] = (dict(payload), float(payload["exp"]))
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def clear_token_cache():
+    """検証済みトークンのキャッシュを破棄"""
+    with _token_cache_lock:
+        _token_cache.clear()
+
+
 def get_token_from_request(req: func.HttpRequest) -> Optional[str]:
     """HTTPリクエストからBearerトークンを取得"""
     auth_header = req.headers.get('Authorization', '')
@@ -40,6 +163,8 @@ def verify_token(token: str) -> Dict[str, Any]:
     """
     Entra IDトークンを検証
     
+    検証済みのトークンは有効期限（exp）までキャッシュし、同じトークンの再検証を省く。
+    
     Args:
         token: JWTトークン
         
@@ -52,10 +177,14 @@ def verify_token(token: str) -> Dict[str, Any]:
     if not TENANT_ID or not CLIENT_ID:
         raise AuthenticationError("Entra ID configuration is missing (TENANT_ID or CLIENT_ID)")
     
+    cache_key = _token_cache_key(token)
+    payload = _get_cached_payload(cache_key)
+    if payload is not None:
+        return payload
+    
     try:
-        # JWKSクライアントを使用して公開鍵を取得
-        jwks_client = PyJWKClient(JWKS_URI)
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
+        # 共有のJWKSクライアントのキャッシュから公開鍵を取得
+        signing_key = get_signing_key(token)
         
         # トークンを検証・デコード
         payload = jwt.decode(
@@ -67,8 +196,11 @@ def verify_token(token: str) -> Dict[str, Any]:
         )
         
         logger.info(f"Token verified for user: {payload.get('preferred_username', 'unknown')}")
+        _cache_payload(cache_key, payload)
         return payload
         
+    except AuthenticationError:
+        raise
     except jwt.ExpiredSignatureError:
         raise AuthenticationError("Token has expired")
     except jwt.InvalidAudienceError:
@@ -0,0 +1,96 @@
+"""
+テキストのバッチEmbedding化
+
+- 件数・トークン上限に収まるようにテキストをバッチにまとめ、バッチ単位で並列にAPIを呼び出す
+- Embeddingモデルの入力上限を超えるテキストは上限まで切り詰めて送る
+  （そのまま送ると再試行しても必ず失敗するため。保存する本文は呼び出し側が元のまま持つ）
+- 失敗したバッチのテキストはNoneとして返し、成功分だけを使えるようにする
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Any
+
+from request_deadline import submit_with_context
+from tokenizer import count_tokens, truncate_to_tokens
+
+
+logger = logging.getLogger(__name__)
+
+# Embeddingモデルの1入力あたりの最大トークン数
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+
+
+def make_batches(token_counts: List[int], batch_size: int, batch_max_tokens: int) -> List[List[int]]:
+    """件数・トークン上限に収まるようにテキストのインデックスをバッチに分割"""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+
+    for i, tokens in enumerate(token_counts):
+        if current and (len(current) >= batch_size or current_tokens + tokens > batch_max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+
+        current.append(i)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def embed_texts(
+    client: Any,
+    deployment: str,
+    texts: List[str],
+    batch_size: int,
+    batch_max_tokens: int,
+    max_workers: int
+) -> List[Optional[List[float]]]:
+    """
+    テキストをバッチ単位でEmbedding化
+
+    結果は入力順に並び、失敗したバッチのテキストはNoneになる
+    """
+    inputs: List[str] = []
+    token_counts: List[int] = []
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if tokens > EMBEDDING_MAX_INPUT_TOKENS:
+            logger.warning(
+                f"Text {i} has {tokens} tokens, truncating to {EMBEDDING_MAX_INPUT_TOKENS} for embedding"
+            )
+            text = truncate_to_tokens(text, EMBEDDING_MAX_INPUT_TOKENS)
+            tokens = EMBEDDING_MAX_INPUT_TOKENS
+        inputs.append(text)
+        token_counts.append(tokens)
+
+    embeddings: List[Optional[List[float]]] = [None] * len(texts)
+    batches = make_batches(token_counts, batch_size, batch_max_tokens)
+
+    def embed_batch(batch: List[int]):
+        return client.embeddings.create(
+            input=[inputs[i] for i in batch],
+            model=deployment
+        )
+
+    workers = max(1, min(max_workers, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {submit_with_context(executor, embed_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.error(f"Embedding batch error ({len(batch)} texts): {str(e)}")
+                continue
+
+            # レスポンスのindexはバッチ内の位置
+            for item in response.data:
+                embeddings[batch[item.index]] = item.embedding
+
+    logger.info(f"Embedded {len(texts)} texts in {len(batches)} batches")
+    return embeddings
@@ -4,55 +4,85 @@ Azure Functions with Router Agent Pattern
 """
 
 import azure.functions as func
+import asyncio
 import logging
 import json
+import threading
 from datetime import datetime
+from typing import Any, Dict
+from azurefunctions.extensions.http.fastapi import Request, Response, StreamingResponse
 from agentic_router import get_router_agent
 
+# HTTPストリーミング拡張（azurefunctions-extensions-http-fastapi）を使うため、
+# 全てのHTTP関数はFastAPIのRequest/Response型で受け取り・返す
+# （アプリ設定 PYTHON_ENABLE_INIT_INDEXING=1 が必要）
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 # グローバルでエージェントを初期化（コールドスタート対策）
 _agent = None
+_agent_lock = threading.Lock()
 
 
-def get_initialized_agent():
-    """Router Agentを取得（遅延初期化）"""
+def _initialize_agent():
+    """Router Agentを初期化（同時に呼ばれても初期化は1回だけ）"""
     global _agent
-    if _agent is None:
-        logging.info("Router Agentを初期化しています...")
-        _agent = get_router_agent()
-        logging.info("Router Agentの初期化が完了しました")
+    with _agent_lock:
+        if _agent is None:
+            logging.info("Router Agentを初期化しています...")
+            _agent = get_router_agent()
+            logging.info("Router Agentの初期化が完了しました")
     return _agent
 
 
+async def get_initialized_agent():
+    """
+    Router Agentを取得（遅延初期化）
+    
+    初期化（スナップショットの復元・ダウンロードを含む）はスレッドで行い、
+    その間もイベントループで他のリクエストを処理できるようにする。
+    """
+    if _agent is not None:
+        return _agent
+    return await asyncio.to_thread(_initialize_agent)
+
+
+def json_response(body: Dict[str, Any], status_code: int = 200) -> Response:
+    """JSONレスポンスを作成"""
+    return Response(
+        json.dumps(body, ensure_ascii=False),
+        media_type="application/json",
+        status_code=status_code
+    )
+
+
 @app.route(route="chat", methods=["POST"])
-def chat_function(req: func.HttpRequest) -> func.HttpResponse:
+async def chat_function(req: Request) -> Response:
     """
     Router Agent チャットエンドポイント
     
     質問の意図を自動分類し、最適なツールを使って回答
+    （非同期パイプラインで実行し、待機中もワーカーを塞がない）
+    
+    include_timings: true を指定すると段階別の所要時間（ミリ秒）を返す
+    degraded: リクエストの期限に間に合わず省略・打ち切りした処理（通常は空）
     """
     logging.info('Router Agent Chat function が呼び出されました。')
     
     try:
-        req_body = req.get_json()
+        req_body = await req.json()
         message = req_body.get('message')
         
         if not message:
-            return func.HttpResponse(
-                json.dumps({
-                    "error": "メッセージが指定されていません",
-                    "usage": {
-                        "message": "質問内容を入力してください"
-                    }
-                }, ensure_ascii=False),
-                mimetype="application/json",
-                status_code=400
-            )
+            return json_response({
+                "error": "メッセージが指定されていません",
+                "usage": {
+                    "message": "質問内容を入力してください"
+                }
+            }, 400)
         
         # Router Agentを取得してクエリ実行
-        agent = get_initialized_agent()
-        result = agent.query(message)
+        agent = await get_initialized_agent()
+        result = await agent.aquery(message)
         
         if result.get("success"):
             response = {
@@ -60,9 +90,16 @@ def chat_function(req: func.HttpRequest) -> func.HttpResponse:
                 "message": message,
                 "answer": result.get("answer", ""),
                 "intent": result.get("intent", "unknown"),
+                "intent_tier": result.get("intent_tier"),
+                "cached": result.get("cached", False),
+                "coalesced": result.get("coalesced", False),
+                "degraded": result.get("degraded", []),
+                "token_usage": result.get("token_usage", {}),
                 "tools_used": result.get("tools_used", []),
                 "timestamp": datetime.utcnow().isoformat()
             }
+            if req_body.get('include_timings'):
+                response["timings"] = result.get("timings", {})
             status_code = 200
         else:
             response = {
@@ -73,166 +110,273 @@ def chat_function(req: func.HttpRequest) -> func.HttpResponse:
             }
             status_code = 500
         
-        return func.HttpResponse(
-            json.dumps(response, ensure_ascii=False),
-            mimetype="application/json",
-            status_code=status_code
-        )
+        return json_response(response, status_code)
     
     except ValueError:
-        return func.HttpResponse(
-            json.dumps({
-                "error": "無効なJSONフォーマット"
-            }, ensure_ascii=False),
-            mimetype="application/json",
-            status_code=400
-        )
+        return json_response({
+            "error": "無効なJSONフォーマット"
+        }, 400)
     except Exception as e:
         logging.error(f"Chat処理エラー: {str(e)}", exc_info=True)
-        return func.HttpResponse(
-            json.dumps({
-                "error": "サーバーエラーが発生しました",
-                "details": str(e)
-            }, ensure_ascii=False),
-            mimetype="application/json",
-            status_code=500
-        )
+        return json_response({
+            "error": "サーバーエラーが発生しました",
+            "details": str(e)
+        }, 500)
+
+
+@app.route(route="chat/stream", methods=["POST"])
+async def chat_stream_function(req: Request) -> Response:
+    """
+    Router Agent ストリーミングチャットエンドポイント
+    
+    NDJSON（1行1イベント）で以下を順に返す:
+        {"event": "intent", ...}  意図分類の結果と選択したツール
+        {"event": "tool", ...}    ツールの完了（完了順）
+        {"event": "token", ...}   回答の断片
+        {"event": "done", ...}    /api/chat と同じ形式の最終結果（include_timings も同様）
+        {"event": "error", ...}   エラー発生時
+    """
+    logging.info('Router Agent Chat stream function が呼び出されました。')
+    
+    try:
+        req_body = await req.json()
+    except ValueError:
+        return json_response({
+            "error": "無効なJSONフォーマット"
+        }, 400)
+    
+    message = req_body.get('message')
+    if not message:
+        return json_response({
+            "error": "メッセージが指定されていません",
+            "usage": {
+                "message": "質問内容を入力してください"
+            }
+        }, 400)
+    
+    agent = await get_initialized_agent()
+    
+    async def events():
+        async for event in agent.astream_query(message):
+            if event["event"] == "done":
+                event = {
+                    "event": "done",
+                    "status": "success",
+                    "message": message,
+                    "answer": event.get("answer", ""),
+                    "intent": event.get("intent", "unknown"),
+                    "intent_tier": event.get("intent_tier"),
+                    "cached": event.get("cached", False),
+                    "degraded": event.get("degraded", []),
+                    "token_usage": event.get("token_usage", {}),
+                    "tools_used": event.get("tools_used", []),
+                    "timestamp": datetime.utcnow().isoformat(),
+                    **({"timings": event.get("timings", {})} if req_body.get('include_timings') else {})
+                }
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 
 @app.route(route="documents/load", methods=["POST"])
-def load_documents_function(req: func.HttpRequest) -> func.HttpResponse:
+async def load_documents_function(req: Request) -> Response:
     """ドキュメントをロード"""
     logging.info('Document load function が呼び出されました。')
     
     try:
-        req_body = req.get_json()
-        agent = get_initialized_agent()
+        req_body = await req.json()
+        agent = await get_initialized_agent()
         
         # テキストから直接ロード
         texts = req_body.get('texts')
         metadata = req_body.get('metadata')
         
         if not texts or not isinstance(texts, list):
-            return func.HttpResponse(
-                json.dumps({
-                    "error": "textsが指定されていないか、配列ではありません",
-                    "usage": {
-                        "texts": ["ドキュメント1", "ドキュメント2"],
-                        "metadata": [{"source": "doc1"}, {"source": "doc2"}]
-                    }
-                }, ensure_ascii=False),
-                mimetype="application/json",
-                status_code=400
-            )
+            return json_response({
+                "error": "textsが指定されていないか、配列ではありません",
+                "usage": {
+                    "texts": ["ドキュメント1", "ドキュメント2"],
+                    "metadata": [{"source": "doc1"}, {"source": "doc2"}]
+                }
+            }, 400)
         
-        success = agent.load_documents_from_texts(texts, metadata)
+        result = await asyncio.to_thread(agent.load_documents_from_texts, texts, metadata)
         
-        if success:
-            return func.HttpResponse(
-                json.dumps({
-                    "status": "success",
-                    "message": f"{len(texts)}個のドキュメントをロードしました"
-                }, ensure_ascii=False),
-                mimetype="application/json",
-                status_code=200
-            )
+        if result["success"]:
+            return json_response({
+                "status": "success",
+                "message": result["message"],
+                "loaded": result["loaded"]
+            })
+        elif result["loaded"]:
+            # 一部だけ失敗（成功分はインデックスに追加済み）
+            return json_response({
+                "status": "partial",
+                "message": result["message"],
+                "loaded": result["loaded"],
+                "failed": result["failed"]
+            }, 207)
         else:
-            return func.HttpResponse(
-                json.dumps({
-                    "status": "error",
-                    "error": "ドキュメントのロードに失敗しました"
-                }, ensure_ascii=False),
-                mimetype="application/json",
-                status_code=500
-            )
+            return json_response({
+                "status": "error",
+                "error": "ドキュメントのロードに失敗しました",
+                "loaded": 0,
+                "failed": result["failed"]
+            }, 500)
     
     except ValueError:
-        return func.HttpResponse(
-            json.dumps({
-                "error": "無効なJSONフォーマット"
-            }, ensure_ascii=False),
-            mimetype="application/json",
-            status_code=400
-        )
+        return json_response({
+            "error": "無効なJSONフォーマット"
+        }, 400)
     except Exception as e:
         logging.error(f"Document load エラー: {str(e)}", exc_info=True)
-        return func.HttpResponse(
-            json.dumps({
-                "error": "サーバーエラーが発生しました",
-                "details": str(e)
-            }, ensure_ascii=False),
-            mimetype="application/json",
-            status_code=500
-        )
+        return json_response({
+            "error": "サーバーエラーが発生しました",
+            "details": str(e)
+        }, 500)
+
+
+@app.route(route="documents/rebuild", methods=["POST"])
+async def rebuild_index_function(req: Request) -> Response:
+    """ベクトルインデックスを再構築"""
+    logging.info('Index rebuild function が呼び出されました。')
+    
+    agent = await get_initialized_agent()
+    if await asyncio.to_thread(agent.rebuild_index):
+        return json_response({
+            "status": "success",
+            "message": f"{len(agent.document_store.documents)}個のドキュメントでインデックスを再構築しました"
+        })
+    
+    return json_response({
+        "status": "error",
+        "error": "インデックスの再構築に失敗しました"
+    }, 500)
+
+
+@app.route(route="documents/snapshot", methods=["POST"])
+async def save_snapshot_function(req: Request) -> Response:
+    """インデックスのスナップショットを保存（次回コールドスタート時に復元）"""
+    logging.info('Snapshot save function が呼び出されました。')
+    
+    agent = await get_initialized_agent()
+    if await asyncio.to_thread(agent.save_snapshot):
+        return json_response({
+            "status": "success",
+            "message": f"{len(agent.document_store.documents)}個のドキュメントのスナップショットを保存しました"
+        })
+    
+    return json_response({
+        "status": "error",
+        "error": "スナップショットの保存に失敗しました"
+    }, 500)
 
 
 @app.route(route="health", methods=["GET"])
-def health_check(req: func.HttpRequest) -> func.HttpResponse:
+async def health_check(req: Request) -> Response:
     """ヘルスチェック"""
-    return func.HttpResponse(
-        json.dumps({
-            "status": "healthy",
-            "service": "GPTlike Router Agent RAG",
-            "version": "3.0.0",
-            "agent_type": "Router Agent Pattern",
-            "timestamp": datetime.utcnow().isoformat()
-        }, ensure_ascii=False),
-        mimetype="application/json",
-        status_code=200
-    )
+    health = {
+        "status": "healthy",
+        "service": "GPTlike Router Agent RAG",
+        "version": "3.0.0",
+        "agent_type": "Router Agent Pattern",
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    
+    # 初期化済みの場合のみキャッシュ統計を含める（ヘルスチェックで初期化はしない）
+    if _agent is not None:
+        health["query_embedding_cache"] = _agent.document_store.query_cache.stats()
+        health["intent_classifier"] = _agent.agent.intent_classifier.stats()
+        health["answer_cache"] = _agent.answer_cache.stats()
+        health["request_coalescing"] = _agent.single_flight.stats()
+    
+    return json_response(health)
+
+
+@app.route(route="metrics", methods=["GET"])
+async def metrics_function(req: Request) -> Response:
+    """段階別レイテンシ（意図別・ツール別のp50/p95/p99）とモデル階層ごとの使用状況"""
+    metrics = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "intents": {},
+        "tools": {}
+    }
+    
+    # 初期化済みの場合のみ（メトリクス取得で初期化はしない）
+    if _agent is not None:
+        metrics.update(_agent.agent.metrics.snapshot())
+        metrics["model_tiers"] = _agent.agent.model_tiers.stats()
+    
+    return json_response(metrics)
 
 
 @app.route(route="info", methods=["GET"])
-def info_function(req: func.HttpRequest) -> func.HttpResponse:
+async def info_function(req: Request) -> Response:
     """API情報"""
-    return func.HttpResponse(
-        json.dumps({
-            "service": "GPTlike Router Agent RAG on Azure Functions",
-            "version": "3.0.0",
-            "agent_pattern": "Router Agent",
-            "description": "質問の意図を自動分類し、最適なツールを選択して回答するエージェンティックRAG",
-            "endpoints": {
-                "chat": {
-                    "path": "/api/chat",
-                    "method": "POST",
-                    "description": "Router Agentでチャット（意図自動分類）"
-                },
-                "documents_load": {
-                    "path": "/api/documents/load",
-                    "method": "POST",
-                    "description": "ドキュメントをロード"
-                },
-                "health": {
-                    "path": "/api/health",
-                    "method": "GET",
-                    "description": "ヘルスチェック"
-                },
-                "info": {
-                    "path": "/api/info",
-                    "method": "GET",
-                    "description": "API情報"
-                }
+    return json_response({
+        "service": "GPTlike Router Agent RAG on Azure Functions",
+        "version": "3.0.0",
+        "agent_pattern": "Router Agent",
+        "description": "質問の意図を自動分類し、最適なツールを選択して回答するエージェンティックRAG",
+        "endpoints": {
+            "chat": {
+                "path": "/api/chat",
+                "method": "POST",
+                "description": "Router Agentでチャット（意図自動分類）"
             },
-            "features": [
-                "Router Agent Pattern - 真のエージェンティックRAG",
-                "質問意図の自動分類（7種類）",
-                "複数の専門ツール（意味検索、キーワード検索、要約、比較）",
-                "意図に応じた最適なツール選択",
-                "Azure OpenAI統合",
-                "Azure AI Search対応",
-                "ベクトル検索（FAISS）",
-                "Entra ID認証対応"
-            ],
-            "supported_intents": [
-                "factual_search - 事実検索",
-                "semantic_search - 意味検索",
-                "summarization - 要約",
-                "comparison - 比較",
-                "analysis - 分析",
-                "multi_hop - 複数ステップ推論",
-                "unknown - その他"
-            ]
-        }, ensure_ascii=False),
-        mimetype="application/json",
-        status_code=200
-    )
+            "chat_stream": {
+                "path": "/api/chat/stream",
+                "method": "POST",
+                "description": "回答をNDJSONでストリーミング（意図・ツール進捗・回答トークン）"
+            },
+            "documents_load": {
+                "path": "/api/documents/load",
+                "method": "POST",
+                "description": "ドキュメントをロード"
+            },
+            "documents_rebuild": {
+                "path": "/api/documents/rebuild",
+                "method": "POST",
+                "description": "ベクトルインデックスを再構築"
+            },
+            "documents_snapshot": {
+                "path": "/api/documents/snapshot",
+                "method": "POST",
+                "description": "インデックスのスナップショットを保存"
+            },
+            "metrics": {
+                "path": "/api/metrics",
+                "method": "GET",
+                "description": "段階別レイテンシ（p50/p95/p99）"
+            },
+            "health": {
+                "path": "/api/health",
+                "method": "GET",
+                "description": "ヘルスチェック"
+            },
+            "info": {
+                "path": "/api/info",
+                "method": "GET",
+                "description": "API情報"
+            }
+        },
+        "features": [
+            "Router Agent Pattern - 真のエージェンティックRAG",
+            "質問意図の自動分類（7種類）",
+            "複数の専門ツール（意味検索、キーワード検索、要約、比較）",
+            "意図に応じた最適なツール選択",
+            "Azure OpenAI統合",
+            "Azure AI Search対応",
+            "ベクトル検索（FAISS）",
+            "Entra ID認証対応"
+        ],
+        "supported_intents": [
+            "factual_search - 事実検索",
+            "semantic_search - 意味検索",
+            "summarization - 要約",
+            "comparison - 比較",
+            "analysis - 分析",
+            "multi_hop - 複数ステップ推論",
+            "unknown - その他"
+        ]
+    })
@@ -0,0 +1,424 @@
+"""
+Azure OpenAI クライアントのレート制限対応ラッパー
+
+- デプロイメントのクォータ（TPM / RPM）に合わせたトークンバケットでクライアント側から流量を制御
+- 429 / 一時的なエラーは retry-after を尊重し、なければジッター付き指数バックオフで再試行
+- 同じモデルの複数デプロイメントに負荷を分散（429を返したデプロイメントは一定時間避ける）
+- リクエストの期限（request_deadline）が設定されていれば残り時間を各呼び出しのタイムアウトにし、
+  期限を超える待ち・再試行はせずにDeadlineExceededを送出
+
+SDKのクライアントと同じ `client.chat.completions.create(...)` / `client.embeddings.create(...)`
+の形で呼び出せるため、呼び出し側のコードは変えずに差し替えられる。
+"""
+
+import os
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+from openai import (
+    AzureOpenAI,
+    AsyncAzureOpenAI,
+    RateLimitError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+)
+
+from request_deadline import DeadlineExceeded, current_deadline
+from tokenizer import count_tokens
+
+
+logger = logging.getLogger(__name__)
+
+# 再試行する例外（429・接続エラー・タイムアウト・5xx）
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+# Azure OpenAIのRPMクォータは1000 TPMあたり6
+RPM_PER_1000_TPM = 6
+
+# 生成トークン数の上限が指定されていないチャット呼び出しで見込む生成トークン数
+DEFAULT_COMPLETION_TOKENS = 512
+
+
+def _estimate_chat_tokens(kwargs: Dict[str, Any]) -> int:
+    """チャット呼び出しが消費するトークン数の見積もり（プロンプト + 生成上限）"""
+    prompt_tokens = 0
+    for message in kwargs.get("messages", []):
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+        if isinstance(content, str):
+            prompt_tokens += count_tokens(content)
+    completion_tokens = kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion_tokens
+
+
+def _estimate_embedding_tokens(kwargs: Dict[str, Any]) -> int:
+    """Embedding呼び出しが消費するトークン数の見積もり"""
+    inputs = kwargs.get("input", [])
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    return sum(count_tokens(text) for text in inputs if isinstance(text, str))
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """エラー応答の retry-after-ms / retry-after ヘッダーから待ち時間（秒）を取得"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP日付形式のretry-afterは扱わない（バックオフにフォールバック）
+        pass
+    return None
+
+
+class TokenBucket:
+    """
+    1分あたりの上限に合わせて連続的に補充されるトークンバケット
+
+    reserveは先に消費を確定させて待ち時間を返すため、待っている間に
+    後続の呼び出しが割り込むことはない（残量が負になれば後続はさらに待つ）。
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0  # 1秒あたりの補充量
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.per_minute <= 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """amountを消費できるまでの待ち時間（消費はしない）"""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def reserve(self, amount: float, now: float) -> float:
+        """amountを消費し、実際に使えるまでの待ち時間を返す"""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount: float):
+        """見積もりと実際の消費量の差を戻す（負なら追加で消費）"""
+        if not self.unlimited:
+            self.tokens = min(self.per_minute, self.tokens + amount)
+
+
+class Deployment:
+    """1つのデプロイメントのクォータと状態"""
+
+    def __init__(self, name: str, tpm: int, rpm: int):
+        self.name = name
+        self.tokens = TokenBucket(tpm)
+        self.requests = TokenBucket(rpm)
+        self.cooldown_until = 0.0  # 429を受けた後、この時刻までは選ばない
+        self.calls = 0
+        self.throttled = 0
+
+    def delay(self, tokens: int, now: float) -> float:
+        return max(
+            self.cooldown_until - now,
+            self.tokens.delay(tokens, now),
+            self.requests.delay(1, now)
+        )
+
+
+class DeploymentPool:
+    """
+    論理モデル名（呼び出し側のmodel）を複数のデプロイメントに割り当てる
+
+    呼び出しごとに最も早く使えるデプロイメントを選び、その分のクォータを予約する。
+    """
+
+    def __init__(
+        self,
+        pools: Dict[str, List[str]],
+        default_tpm: int,
+        tpm_overrides: Dict[str, int],
+        max_retries: int,
+        backoff_base: float,
+        backoff_max: float
+    ):
+        self.pools = pools
+        self.default_tpm = default_tpm
+        self.tpm_overrides = tpm_overrides
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._deployments: Dict[str, Deployment] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "DeploymentPool":
+        """
+        環境変数から設定を読み込む
+
+        AZURE_OPENAI_DEPLOYMENT_POOL: 論理名=デプロイメント,デプロイメント;...
+            （例: gpt-4=gpt-4-a,gpt-4-b;text-embedding-ada-002=ada-a,ada-b）
+        AZURE_OPENAI_TPM: デプロイメントごとのTPMクォータ（0で制限なし）
+        AZURE_OPENAI_DEPLOYMENT_TPM: デプロイメント=TPM,...（個別のクォータ）
+        """
+        pools = {}
+        for entry in os.getenv("AZURE_OPENAI_DEPLOYMENT_POOL", "").split(";"):
+            if "=" in entry:
+                name, deployments = entry.split("=", 1)
+                pools[name.strip()] = [d.strip() for d in deployments.split(",") if d.strip()]
+
+        tpm_overrides = {}
+        for entry in os.getenv("AZURE_OPENAI_DEPLOYMENT_TPM", "").split(","):
+            if "=" in entry:
+                name, tpm = entry.split("=", 1)
+                tpm_overrides[name.strip()] = int(tpm)
+
+        return cls(
+            pools=pools,
+            default_tpm=int(os.getenv("AZURE_OPENAI_TPM", "0")),
+            tpm_overrides=tpm_overrides,
+            max_retries=int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "5")),
+            backoff_base=float(os.getenv("AZURE_OPENAI_BACKOFF_BASE_SECONDS", "1")),
+            backoff_max=float(os.getenv("AZURE_OPENAI_BACKOFF_MAX_SECONDS", "60"))
+        )
+
+    def _deployment(self, name: str) -> Deployment:
+        deployment = self._deployments.get(name)
+        if deployment is None:
+            tpm = self.tpm_overrides.get(name, self.default_tpm)
+            deployment = Deployment(name, tpm, max(1, tpm * RPM_PER_1000_TPM // 1000) if tpm > 0 else 0)
+            self._deployments[name] = deployment
+        return deployment
+
+    def acquire(self, model: str, tokens: int) -> Tuple[Deployment, float]:
+        """最も早く使えるデプロイメントを選んでクォータを予約し、（デプロイメント, 待ち時間）を返す"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [self._deployment(name) for name in self.pools.get(model, [model])]
+            # 同じ待ち時間なら呼び出し回数の少ないデプロイメントを選び、負荷を均す
+            deployment = min(candidates, key=lambda d: (d.delay(tokens, now), d.calls))
+            wait = max(
+                deployment.cooldown_until - now,
+                deployment.tokens.reserve(tokens, now),
+                deployment.requests.reserve(1, now)
+            )
+            deployment.calls += 1
+            return deployment, max(0.0, wait)
+
+    def settle(self, deployment: Deployment, estimated: int, actual: Optional[int]):
+        """実際の消費トークン数が分かったら見積もりとの差を精算"""
+        if actual is None:
+            return
+        with self._lock:
+            deployment.tokens.refund(estimated - actual)
+
+    def backoff(self, deployment: Deployment, error: Exception, attempt: int) -> float:
+        """
+        再試行前に待つ時間
+
+        429の場合はそのデプロイメントを待ち時間の間だけ避け、0を返す
+        （次のacquireで他のデプロイメントが選ばれるか、空くまで待つ）。
+        """
+        delay = _retry_after_seconds(error)
+        if delay is None:
+            # フルジッター付き指数バックオフ
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+        if isinstance(error, RateLimitError):
+            with self._lock:
+                deployment.throttled += 1
+                deployment.cooldown_until = max(deployment.cooldown_until, time.monotonic() + delay)
+            return 0.0
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        """デプロイメントごとの呼び出し数と429の回数"""
+        with self._lock:
+            return {
+                name: {"calls": d.calls, "throttled": d.throttled}
+                for name, d in self._deployments.items()
+            }
+
+
+def _deadline_kwargs(kwargs: Dict[str, Any], wait: float = 0.0) -> Dict[str, Any]:
+    """
+    リクエストの期限に合わせてtimeoutを設定した呼び出し引数を返す
+
+    wait秒待った後に呼び出す前提で、期限までに呼び出せなければDeadlineExceededを送出する。
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return kwargs
+    remaining = deadline.remaining() - wait
+    if remaining <= 0:
+        raise DeadlineExceeded(f"リクエストの期限（{deadline.seconds}秒）までに呼び出せません")
+    timeout = kwargs.get("timeout")
+    if isinstance(timeout, (int, float)):
+        remaining = min(remaining, timeout)
+    return {**kwargs, "timeout": remaining}
+
+
+class _Endpoint:
+    """chat.completions / embeddings の create をレート制限付きで呼び出す"""
+
+    def __init__(self, pool: DeploymentPool, create, estimate):
+        self.pool = pool
+        self._create = create
+        self._estimate = estimate
+
+    def _prepare(self, kwargs: Dict[str, Any], estimated: int) -> Tuple[Deployment, float, Dict[str, Any]]:
+        """クォータを予約し、（デプロイメント, 待ち時間, 呼び出し引数）を返す"""
+        deployment, wait = self.pool.acquire(kwargs["model"], estimated)
+        try:
+            call_kwargs = _deadline_kwargs(kwargs, wait)
+        except DeadlineExceeded:
+            # 呼び出さないので予約したクォータを戻す
+            self.pool.settle(deployment, estimated, 0)
+            raise
+        return deployment, wait, {**call_kwargs, "model": deployment.name}
+
+    def _retry_delay(self, deployment: Deployment, error: Exception, attempt: int) -> float:
+        """再試行前の待ち時間（再試行しない場合はerrorを送出）"""
+        if attempt >= self.pool.max_retries:
+            raise error
+        delay = self.pool.backoff(deployment, error, attempt)
+        deadline = current_deadline()
+        if deadline is not None and delay >= deadline.remaining():
+            raise DeadlineExceeded(f"リクエストの期限（{deadline.seconds}秒）までに再試行できません") from error
+        logger.warning(f"Azure OpenAI call failed on {deployment.name} ({type(error).__name__}), retrying (attempt {attempt + 1})")
+        return delay
+
+    def create(self, **kwargs):
+        estimated = self._estimate(kwargs)
+
+        for attempt in range(self.pool.max_retries + 1):
+            deployment, wait, call_kwargs = self._prepare(kwargs, estimated)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                response = self._create(**call_kwargs)
+            except RETRYABLE_ERRORS as e:
+                # 応答を得られなかった呼び出しの予約は戻す（再試行で改めて予約する）
+                self.pool.settle(deployment, estimated, 0)
+                time.sleep(self._retry_delay(deployment, e, attempt))
+                continue
+
+            usage = getattr(response, "usage", None)
+            self.pool.settle(deployment, estimated, getattr(usage, "total_tokens", None))
+            return response
+
+
+class _AsyncEndpoint(_Endpoint):
+    """_Endpointの非同期版"""
+
+    async def create(self, **kwargs):
+        estimated = self._estimate(kwargs)
+
+        for attempt in range(self.pool.max_retries + 1):
+            deployment, wait, call_kwargs = self._prepare(kwargs, estimated)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                response = await self._create(**call_kwargs)
+            except RETRYABLE_ERRORS as e:
+                # 応答を得られなかった呼び出しの予約は戻す（再試行で改めて予約する）
+                self.pool.settle(deployment, estimated, 0)
+                await asyncio.sleep(self._retry_delay(deployment, e, attempt))
+                continue
+
+            usage = getattr(response, "usage", None)
+            self.pool.settle(deployment, estimated, getattr(usage, "total_tokens", None))
+            return response
+
+
+class _Chat:
+    def __init__(self, completions: _Endpoint):
+        self.completions = completions
+
+
+class RateLimitedAzureOpenAI:
+    """AzureOpenAIのレート制限対応ラッパー（chat.completions.create / embeddings.create のみ）"""
+
+    endpoint_class = _Endpoint
+
+    def __init__(self, client, pool: DeploymentPool):
+        self.client = client
+        self.pool = pool
+        self.chat = _Chat(self.endpoint_class(pool, client.chat.completions.create, _estimate_chat_tokens))
+        self.embeddings = self.endpoint_class(pool, client.embeddings.create, _estimate_embedding_tokens)
+
+
+class AsyncRateLimitedAzureOpenAI(RateLimitedAzureOpenAI):
+    """AsyncAzureOpenAIのレート制限対応ラッパー"""
+
+    endpoint_class = _AsyncEndpoint
+
+
+# 同期・非同期クライアントで同じクォータを共有する
+_pool: Optional[DeploymentPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_deployment_pool() -> DeploymentPool:
+    """デプロイメントプールを取得（シングルトン）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = DeploymentPool.from_env()
+        return _pool
+
+
+# ストリーミングでトークン使用量（stream_options.include_usage）を返すAPIバージョンの下限
+STREAM_USAGE_MIN_API_VERSION = "2024-09-01"
+
+
+def get_api_version() -> str:
+    return os.getenv("AZURE_OPENAI_API_VERSION", "2024-10-21")
+
+
+def stream_usage_options() -> Dict[str, Any]:
+    """
+    ストリーミング呼び出しに渡す引数（最後のチャンクでトークン使用量を返させる）
+
+    古いAPIバージョンは stream_options を受け付けないため、その場合は空。
+    """
+    if get_api_version()[:10] < STREAM_USAGE_MIN_API_VERSION:
+        return {}
+    return {"stream_options": {"include_usage": True}}
+
+
+def _client_settings() -> Dict[str, Any]:
+    return {
+        "azure_endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+        "api_version": get_api_version(),
+        # 再試行はこのラッパーで行う（SDKの再試行と重ねない）
+        "max_retries": 0
+    }
+
+
+def create_openai_client() -> RateLimitedAzureOpenAI:
+    """環境変数の設定でレート制限付きの同期クライアントを作成"""
+    return RateLimitedAzureOpenAI(AzureOpenAI(**_client_settings()), get_deployment_pool())
+
+
+def create_async_openai_client() -> AsyncRateLimitedAzureOpenAI:
+    """環境変数の設定でレート制限付きの非同期クライアントを作成"""
+    return AsyncRateLimitedAzureOpenAI(AsyncAzureOpenAI(**_client_settings()), get_deployment_pool())
@@ -0,0 +1,122 @@
+"""
+リクエスト単位のデッドライン（時間予算）
+
+- リクエストの開始時に期限を設定し、以降のLLM・Embedding・検索呼び出しに残り時間をタイムアウトとして渡す
+- 期限はcontextvarで保持するため、呼び出し側の引数を変えずに下位の処理まで伝わる
+  （asyncioのタスク・asyncio.to_threadには自動で引き継がれ、スレッドプールには submit_with_context で渡す）
+- 時間切れで省略・打ち切りした処理は degrade で記録し、応答の degraded として返す
+
+既定の期限は App Service のフロントエンドタイムアウト（230秒）より短くしている。
+"""
+
+import os
+import contextvars
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Callable, Iterator
+
+
+class DeadlineExceeded(TimeoutError):
+    """リクエストの期限を過ぎた"""
+
+
+class Deadline:
+    """リクエストの期限と、時間切れで省略した処理の記録"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.degraded: List[str] = []
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """残り時間（秒、期限切れなら0）"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self):
+        """期限を過ぎていればDeadlineExceededを送出"""
+        if self.expired():
+            raise DeadlineExceeded(f"リクエストの期限（{self.seconds}秒）を過ぎました")
+
+    def degrade(self, reason: str):
+        """時間切れで省略・打ち切りした処理を記録"""
+        with self._lock:
+            if reason not in self.degraded:
+                self.degraded.append(reason)
+
+
+_current: "contextvars.ContextVar[Optional[Deadline]]" = contextvars.ContextVar("request_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """現在のリクエストの期限（設定されていなければNone）"""
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float] = None) -> Iterator[Deadline]:
+    """
+    リクエストの期限を設定する
+
+    既に期限が設定されていれば（外側のリクエストから呼ばれた場合）それをそのまま使う。
+    secondsを省略した場合は REQUEST_DEADLINE_SECONDS（既定200秒）。
+    """
+    deadline = _current.get()
+    if deadline is not None:
+        yield deadline
+        return
+
+    if seconds is None:
+        seconds = float(os.getenv("REQUEST_DEADLINE_SECONDS", "200"))
+    deadline = Deadline(seconds)
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # 非同期ジェネレーターが別のコンテキストで閉じられた場合
+            pass
+
+
+def remaining_seconds(cap: Optional[float] = None) -> Optional[float]:
+    """
+    呼び出しに渡すタイムアウト（残り時間とcapの小さい方）
+
+    期限もcapもなければNone。
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return cap
+    remaining = deadline.remaining()
+    return remaining if cap is None else min(cap, remaining)
+
+
+def timeout_kwargs(cap: Optional[float] = None) -> Dict[str, Any]:
+    """Azure SDKの呼び出しに渡すtimeout引数（期限がなければ空）"""
+    timeout = remaining_seconds(cap)
+    return {} if timeout is None else {"timeout": timeout}
+
+
+def degrade(reason: str):
+    """現在のリクエストに時間切れによる省略を記録（期限がなければ何もしない）"""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.degrade(reason)
+
+
+def degraded_reasons() -> List[str]:
+    """現在のリクエストで時間切れにより省略・打ち切りした処理"""
+    deadline = _current.get()
+    return list(deadline.degraded) if deadline is not None else []
+
+
+def submit_with_context(executor: Executor, fn: Callable[..., Any], *args, **kwargs) -> Future:
+    """現在のコンテキスト（期限を含む）を引き継いでスレッドプールで実行"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# ルート直下のモジュール（agentic_router など）をインポートできるようにする
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fakes import AsyncFakeOpenAIClient, FakeEmbeddingClient, FakeOpenAIClient  # noqa: E402
+
+
+@pytest.fixture
+def embedding_client():
+    # インデックスの学習を速くするため次元数を小さくする（DocumentStore.dimensionも合わせる）
+    return FakeEmbeddingClient(dimension=64)
+
+
+@pytest.fixture
+def openai_client():
+    return FakeOpenAIClient(dimension=64)
+
+
+@pytest.fixture
+def rag(monkeypatch, openai_client):
+    """偽クライアントを使うAzureRouterRAG（スナップショット・Azure AI Searchなし）"""
+    import agentic_router
+
+    for name in ("AZURE_SEARCH_ENDPOINT", "AZURE_STORAGE_CONNECTION_STRING", "ROUTER_SNAPSHOT_PATH",
+                 "ROUTER_SNAPSHOT_BLOB_CONTAINER"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(agentic_router, "create_openai_client", lambda: openai_client)
+    monkeypatch.setattr(agentic_router, "create_async_openai_client", lambda: AsyncFakeOpenAIClient(openai_client))
+    rag = agentic_router.AzureRouterRAG()
+    rag.document_store.dimension = openai_client.dimension
+    return rag
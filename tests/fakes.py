@@ -0,0 +1,114 @@
+"""テスト用の偽クライアント"""
+
+import hashlib
+from types import SimpleNamespace
+
+import numpy as np
+
+
+def fake_embedding(text, dimension=1536):
+    """テキストから決まる正規化済みのランダムベクトル"""
+    seed = int(hashlib.md5(text.encode("utf-8")).hexdigest(), 16) % (2 ** 32)
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype("float32")
+    return vector / np.linalg.norm(vector)
+
+
+class FakeEmbeddingClient:
+    """embeddings.create だけを持つAzure OpenAIクライアントの代わり（fail_onのテキストを含む呼び出しは失敗）"""
+
+    def __init__(self, dimension=1536):
+        self.dimension = dimension
+        self.calls = 0
+        self.inputs = []
+        self.fail_on = set()
+        self.embeddings = SimpleNamespace(create=self._create)
+
+    def _create(self, input, model, **kwargs):
+        self.calls += 1
+        inputs = [input] if isinstance(input, str) else input
+        if any(text in self.fail_on for text in inputs):
+            raise RuntimeError("embedding failed")
+        self.inputs.append(list(inputs))
+        # APIと同じくindexで対応付ける（順序には依存しない）
+        data = [SimpleNamespace(index=i, embedding=fake_embedding(text, self.dimension).tolist()) for i, text in enumerate(inputs)]
+        return SimpleNamespace(
+            data=data[::-1],
+            usage=SimpleNamespace(prompt_tokens=len(inputs), total_tokens=len(inputs))
+        )
+
+
+def default_responder(model, messages, kwargs):
+    """意図分類（JSON形式）には意味検索、それ以外には固定の回答を返す"""
+    if kwargs.get("response_format"):
+        return '{"intent": "semantic_search", "reasoning": "test"}'
+    return "テストの回答です"
+
+
+class FakeOpenAIClient(FakeEmbeddingClient):
+    """
+    embeddings と chat.completions を持つAzure OpenAIクライアントの代わり
+
+    回答は responder(model, messages, kwargs) が返す文字列。
+    stream=True なら数文字ずつのチャンクを返し、stream_options.include_usage があれば最後に使用量のチャンクを付ける。
+    """
+
+    def __init__(self, dimension=1536, responder=default_responder):
+        super().__init__(dimension)
+        self.responder = responder
+        self.chat_calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+
+    @staticmethod
+    def usage(prompt_tokens=10, completion_tokens=5):
+        return SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+    def _chat_create(self, model, messages, **kwargs):
+        self.chat_calls.append({"model": model, "messages": messages, **kwargs})
+        content = self.responder(model, messages, kwargs)
+        if kwargs.get("stream"):
+            return iter(self._chunks(content, kwargs))
+        message = SimpleNamespace(content=content, tool_calls=None)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=message, finish_reason="stop")],
+            usage=self.usage()
+        )
+
+    def _chunks(self, content, kwargs):
+        chunks = [
+            SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i:i + 4]), finish_reason=None)],
+                usage=None
+            )
+            for i in range(0, len(content), 4)
+        ]
+        if (kwargs.get("stream_options") or {}).get("include_usage"):
+            chunks.append(SimpleNamespace(choices=[], usage=self.usage()))
+        return chunks
+
+
+class AsyncFakeOpenAIClient:
+    """FakeOpenAIClientの非同期版（呼び出しの記録は元のクライアントと共有）"""
+
+    def __init__(self, sync: FakeOpenAIClient):
+        self.sync = sync
+        self.embeddings = SimpleNamespace(create=self._embeddings_create)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+
+    async def _embeddings_create(self, **kwargs):
+        return self.sync.embeddings.create(**kwargs)
+
+    async def _chat_create(self, **kwargs):
+        response = self.sync.chat.completions.create(**kwargs)
+        if not kwargs.get("stream"):
+            return response
+        chunks = list(response)
+
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+
+        return stream()
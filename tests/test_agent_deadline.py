@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+from openai import APITimeoutError
+
+from agent_rag import AgentTool, MicrosoftAgent
+from request_deadline import deadline_scope
+
+
+class SearchTool(AgentTool):
+    def __init__(self):
+        super().__init__(name="search", description="")
+
+    def execute(self, query: str) -> str:
+        return f"found {query}"
+
+    def to_function_definition(self):
+        return {"type": "function", "function": {"name": self.name, "parameters": {}}}
+
+
+class ScriptedClient:
+    """1回目はツール呼び出し、以降は responses の順に返す（例外なら送出）"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        if len(self.calls) == 1:
+            call = SimpleNamespace(id="1", function=SimpleNamespace(name="search", arguments='{"query": "azure"}'))
+            return self._response(None, [call])
+        response = self.responses[len(self.calls) - 2]
+        if isinstance(response, Exception):
+            raise response
+        return self._response(response, None)
+
+    @staticmethod
+    def _response(content, tool_calls):
+        message = SimpleNamespace(content=content, tool_calls=tool_calls)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+def make_agent(client, answer_reserve):
+    agent = MicrosoftAgent(client, "gpt", [SearchTool()], "system")
+    agent.answer_reserve = answer_reserve
+    return agent
+
+
+def test_answers_without_tools_when_deadline_is_near():
+    client = ScriptedClient("回答")
+    agent = make_agent(client, answer_reserve=100)
+
+    with deadline_scope(50):
+        result = agent.run("質問")
+
+    assert result["answer"] == "回答"
+    assert client.calls[1]["tool_choice"] == "none"
+    assert result["degraded"] == ["early_answer"]
+
+
+def test_returns_tool_evidence_when_answer_times_out():
+    client = ScriptedClient(APITimeoutError(request=None))
+    agent = make_agent(client, answer_reserve=0)
+
+    result = agent.run("質問")
+
+    assert result["success"] is True
+    assert "found azure" in result["answer"]
+    assert result["degraded"] == ["answer_fallback"]
+
+
+def test_runs_normally_with_time_left():
+    client = ScriptedClient("回答")
+    agent = make_agent(client, answer_reserve=0)
+
+    result = agent.run("質問")
+
+    assert client.calls[1]["tool_choice"] == "auto"
+    assert result["degraded"] == []
@@ -0,0 +1,77 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from agent_rag import AgentTool, MicrosoftAgent, ToolResultMemo
+
+
+class SlowTool(AgentTool):
+    """queryごとの待ち時間（delays）だけ待ってから結果を返す"""
+
+    def __init__(self, name="search", delays=None):
+        super().__init__(name=name, description="")
+        self.delays = delays or {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def execute(self, query: str) -> str:
+        with self._lock:
+            self.calls.append(query)
+        time.sleep(self.delays.get(query, 0.0))
+        return f"{self.name}: {query}"
+
+
+def tool_call(query, name="search"):
+    return SimpleNamespace(function=SimpleNamespace(name=name, arguments=f'{{"query": "{query}"}}'))
+
+
+def make_agent(*tools):
+    agent = MicrosoftAgent(None, "gpt", list(tools), "system")
+    agent.answer_reserve = 0
+    return agent
+
+
+def test_tool_calls_run_in_parallel_and_keep_call_order():
+    tool = SlowTool(delays={"a": 0.2, "b": 0.2, "c": 0.0})
+    agent = make_agent(tool)
+
+    started = time.monotonic()
+    results = agent._execute_tool_calls([tool_call("a"), tool_call("b"), tool_call("c")], ToolResultMemo())
+
+    assert time.monotonic() - started < 0.35
+    assert results == ["search: a", "search: b", "search: c"]
+
+
+def test_duplicate_calls_in_one_turn_run_once():
+    tool = SlowTool()
+    agent = make_agent(tool)
+    memo = ToolResultMemo()
+
+    results = agent._execute_tool_calls([tool_call("a"), tool_call("b"), tool_call("a")], memo)
+
+    assert sorted(tool.calls) == ["a", "b"]
+    assert results == ["search: a", "search: b", "search: a"]
+    assert memo.hits == 1
+
+
+def test_slow_tool_times_out_without_blocking_others():
+    tool = SlowTool(delays={"slow": 1.0})
+    agent = make_agent(tool)
+    agent.tool_timeout = 0.1
+
+    started = time.monotonic()
+    results = agent._execute_tool_calls([tool_call("slow"), tool_call("fast")], ToolResultMemo())
+
+    assert time.monotonic() - started < 0.5
+    assert "タイムアウト" in results[0]
+    assert results[1] == "search: fast"
+
+
+def test_unknown_tool_and_bad_arguments_become_error_results():
+    agent = make_agent(SlowTool())
+    bad = SimpleNamespace(function=SimpleNamespace(name="search", arguments="{"))
+
+    results = agent._execute_tool_calls([tool_call("a", name="missing"), bad], ToolResultMemo())
+
+    assert results[0] == "ツール 'missing' が見つかりません。"
+    assert results[1].startswith("ツール引数が不正です")
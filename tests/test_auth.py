@@ -0,0 +1,109 @@
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt import PyJWK
+from jwt.algorithms import RSAAlgorithm
+
+import auth
+
+
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def public_jwk(kid):
+    jwk = json.loads(RSAAlgorithm.to_jwk(PRIVATE_KEY.public_key()))
+    return PyJWK({**jwk, "kid": kid, "alg": "RS256", "use": "sig"})
+
+
+class FakeJWKSClient:
+    """get_signing_keys だけを持つPyJWKClientの代わり（refresh=True で rotated_keys に切り替わる）"""
+
+    def __init__(self, keys, rotated_keys=None):
+        self.keys = keys
+        self.rotated_keys = rotated_keys if rotated_keys is not None else keys
+        self.calls = 0
+        self.refreshes = 0
+        self.lock_held_during_refresh = []
+
+    def get_signing_keys(self, refresh=False):
+        self.calls += 1
+        if refresh:
+            self.refreshes += 1
+            self.lock_held_during_refresh.append(auth._jwks_lock.locked())
+            self.keys = self.rotated_keys
+        return self.keys
+
+
+@pytest.fixture
+def configured(monkeypatch):
+    monkeypatch.setattr(auth, "TENANT_ID", "tenant")
+    monkeypatch.setattr(auth, "CLIENT_ID", "api")
+    monkeypatch.setattr(auth, "ISSUER", "https://issuer")
+    monkeypatch.setattr(auth, "_jwks_last_refetch", 0.0)
+    auth.clear_token_cache()
+    yield
+    auth.clear_token_cache()
+
+
+def install_client(monkeypatch, client):
+    monkeypatch.setattr(auth, "_jwks_client", client)
+    return client
+
+
+def make_token(kid="key-1", expires_in=3600):
+    payload = {"aud": "api", "iss": "https://issuer", "exp": int(time.time()) + expires_in, "oid": "user"}
+    return jwt.encode(payload, PRIVATE_KEY, algorithm="RS256", headers={"kid": kid})
+
+
+def test_verified_token_is_cached(configured, monkeypatch):
+    client = install_client(monkeypatch, FakeJWKSClient([public_jwk("key-1")]))
+    token = make_token()
+
+    assert auth.verify_token(token)["oid"] == "user"
+    assert auth.verify_token(token)["oid"] == "user"
+
+    assert client.calls == 1
+
+
+def test_expired_cache_entry_is_verified_again(configured, monkeypatch):
+    client = install_client(monkeypatch, FakeJWKSClient([public_jwk("key-1")]))
+    token = make_token()
+    auth.verify_token(token)
+    key = auth._token_cache_key(token)
+    payload, _ = auth._token_cache[key]
+    auth._token_cache[key] = (payload, time.time() - 1)
+
+    auth.verify_token(token)
+
+    assert client.calls == 2
+
+
+def test_unknown_kid_refetches_outside_the_lock(configured, monkeypatch):
+    client = install_client(monkeypatch, FakeJWKSClient([public_jwk("old")], [public_jwk("new")]))
+
+    assert auth.verify_token(make_token(kid="new"))["oid"] == "user"
+
+    assert client.refreshes == 1
+    assert client.lock_held_during_refresh == [False]
+
+
+def test_unknown_kid_refetch_is_rate_limited(configured, monkeypatch):
+    client = install_client(monkeypatch, FakeJWKSClient([public_jwk("key-1")]))
+
+    for _ in range(3):
+        with pytest.raises(auth.AuthenticationError):
+            auth.verify_token(make_token(kid="bogus"))
+
+    assert client.refreshes == 1
+
+
+def test_invalid_audience_is_rejected_and_not_cached(configured, monkeypatch):
+    install_client(monkeypatch, FakeJWKSClient([public_jwk("key-1")]))
+    monkeypatch.setattr(auth, "CLIENT_ID", "other-api")
+
+    with pytest.raises(auth.AuthenticationError, match="audience"):
+        auth.verify_token(make_token())
+    assert not auth._token_cache
@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+
+from agentic_router import EmbeddingCache, SemanticAnswerCache
+
+
+def unit(i, dimension=8):
+    vector = np.zeros(dimension, dtype="float32")
+    vector[i] = 1.0
+    return vector
+
+
+def test_embedding_cache_normalizes_query_and_counts_hits():
+    cache = EmbeddingCache(max_entries=10, ttl_seconds=60, max_bytes=1 << 20)
+    cache.put("emb", " What is\u3000ＦＡＩＳＳ? ", unit(0))
+
+    assert np.array_equal(cache.get("emb", "What is FAISS?"), unit(0))
+    assert cache.get("other-emb", "What is FAISS?") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(max_entries=2, ttl_seconds=60, max_bytes=1 << 20)
+    cache.put("emb", "a", unit(0))
+    cache.put("emb", "b", unit(1))
+    cache.get("emb", "a")
+    cache.put("emb", "c", unit(2))
+
+    assert cache.get("emb", "b") is None
+    assert cache.get("emb", "a") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_embedding_cache_respects_byte_limit_and_ttl():
+    vector_bytes = unit(0).nbytes
+    cache = EmbeddingCache(max_entries=10, ttl_seconds=0.01, max_bytes=2 * vector_bytes)
+    for i, query in enumerate("abc"):
+        cache.put("emb", query, unit(i))
+    assert cache.stats()["bytes"] == 2 * vector_bytes
+
+    time.sleep(0.02)
+    assert cache.get("emb", "c") is None
+    assert cache.stats()["entries"] == 1
+
+
+def test_embedding_cache_entries_are_read_only():
+    cache = EmbeddingCache(max_entries=10, ttl_seconds=60, max_bytes=1 << 20)
+    cache.put("emb", "a", unit(0))
+    assert not cache.get("emb", "a").flags.writeable
+
+
+def test_answer_cache_returns_similar_question():
+    cache = SemanticAnswerCache(max_entries=4, ttl_seconds=60, threshold=0.9)
+    cache.put(unit(0), version=1, result={"answer": "a"})
+
+    near = unit(0) + 0.1 * unit(1)
+    result, similarity = cache.get(near, version=1)
+    assert result == {"answer": "a"}
+    assert 0.9 < similarity <= 1.0
+    assert cache.get(unit(1), version=1) is None
+
+
+def test_answer_cache_ignores_other_versions_and_expired_entries():
+    cache = SemanticAnswerCache(max_entries=4, ttl_seconds=0.05, threshold=0.9)
+    cache.put(unit(0), version=1, result={"answer": "a"})
+
+    assert cache.get(unit(0), version=2) is None
+    time.sleep(0.06)
+    assert cache.get(unit(0), version=1) is None
+
+
+def test_answer_cache_replaces_least_recently_used_slot():
+    cache = SemanticAnswerCache(max_entries=2, ttl_seconds=60, threshold=0.9)
+    cache.put(unit(0), version=1, result={"answer": "a"})
+    cache.put(unit(1), version=1, result={"answer": "b"})
+    cache.get(unit(0), version=1)
+    cache.put(unit(2), version=1, result={"answer": "c"})
+
+    assert cache.get(unit(1), version=1) is None
+    assert cache.get(unit(0), version=1)[0] == {"answer": "a"}
+    assert cache.get(unit(2), version=1)[0] == {"answer": "c"}
+
+
+def test_answer_cache_invalidate_and_disabled():
+    cache = SemanticAnswerCache(max_entries=2, ttl_seconds=60, threshold=0.9)
+    cache.put(unit(0), version=1, result={"answer": "a"})
+    cache.invalidate()
+    assert cache.get(unit(0), version=1) is None
+    assert cache.stats()["entries"] == 0
+
+    disabled = SemanticAnswerCache(max_entries=0, ttl_seconds=60, threshold=0.9)
+    disabled.put(unit(0), version=1, result={"answer": "a"})
+    assert not disabled.enabled
+    assert disabled.get(unit(0), version=1) is None
@@ -0,0 +1,52 @@
+from agentic_router import ContextBuilder, QueryIntent
+
+
+def documents(tool, *contents):
+    return {"tool": tool, "result": {"success": True, "documents": [{"content": c} for c in contents]}}
+
+
+def test_sections_keep_tool_order_and_derived_results_come_first():
+    builder = ContextBuilder()
+    tool_results = [
+        documents("semantic_search", "doc a", "doc b"),
+        {"tool": "summarization", "result": {"success": True, "summary": "要約文"}},
+        {"tool": "broken", "result": {"success": False, "message": "error"}},
+    ]
+
+    text, tokens = builder.build(QueryIntent.SUMMARIZATION, tool_results)
+
+    assert text == "[semantic_searchの結果]\n- doc a\n- doc b\n\n[要約]\n要約文"
+    assert tokens > 0
+
+
+def test_documents_are_interleaved_deduplicated_and_cut_at_budget():
+    builder = ContextBuilder()
+    builder.budgets[QueryIntent.FACTUAL_SEARCH] = 60
+    long_text = "x" * 100
+    tool_results = [
+        documents("keyword_search", "same", long_text),
+        documents("semantic_search", "same", "other"),
+    ]
+
+    text, _ = builder.build(QueryIntent.FACTUAL_SEARCH, tool_results)
+
+    # 1位同士（重複は1回）→ 2位の順に詰め、予算を超える分は切り詰めてそれ以降は入れない
+    assert text.count("same") == 1
+    assert "x" * 100 not in text
+    assert "other" not in text
+    assert text.startswith("[keyword_searchの結果]\n- same\n- x")
+
+
+def test_tool_name_does_not_change_section_format():
+    # 見出しの文字列ではなくセクションの種類で整形する
+    builder = ContextBuilder()
+    tool_results = [{"tool": "custom", "result": {"success": True, "comparison": "比較の結果]"}}]
+
+    text, _ = builder.build(QueryIntent.COMPARISON, tool_results)
+
+    assert text == "[比較分析]\n比較の結果]"
+
+
+def test_no_usable_results_gives_empty_context():
+    builder = ContextBuilder()
+    assert builder.build(QueryIntent.UNKNOWN, [documents("semantic_search")]) == ("", 0)
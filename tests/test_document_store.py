@@ -0,0 +1,269 @@
+import numpy as np
+import pytest
+
+import agentic_router
+from agentic_router import DocumentStore
+from fakes import fake_embedding
+
+
+@pytest.fixture
+def store(monkeypatch, embedding_client):
+    monkeypatch.setenv("ROUTER_INDEX_TYPE", "flat")
+    monkeypatch.setenv("ROUTER_QUERY_CACHE_SIZE", "0")
+    # 少ない件数でもIVF系を構築できるようにする
+    monkeypatch.setattr(agentic_router, "IVF_MIN_TRAIN_SIZE", 100)
+    monkeypatch.setattr(agentic_router, "IVF_PQ_MIN_TRAIN_SIZE", 300)
+    store = DocumentStore(embedding_client, "emb")
+    store.dimension = embedding_client.dimension
+    store.pq_m = 2  # PQの学習時間を抑える
+    return store
+
+
+def wait_for_rebuild(store):
+    if store._rebuild_thread is not None:
+        store._rebuild_thread.join(timeout=30)
+
+
+def texts(n, prefix="document"):
+    return [f"{prefix} {i}" for i in range(n)]
+
+
+def expected_vectors(items, dimension=64):
+    return np.array([fake_embedding(text, dimension) for text in items], dtype="float32")
+
+
+def test_add_documents_indexes_only_new_vectors(store, embedding_client):
+    store.add_documents(texts(3))
+    index = store.index
+    store.add_documents(texts(2, "more"))
+
+    # 既存のインデックスに追記し、既存分のEmbeddingは再計算しない
+    assert store.index is index
+    assert store.index.ntotal == 5
+    assert [text for batch in embedding_client.inputs for text in batch] == texts(3) + texts(2, "more")
+    assert store.search("more 1", k=1)[0]["content"] == "more 1"
+
+
+def test_add_documents_indexes_successful_batches(store, embedding_client):
+    store.embedding_batch_size = 1
+    embedding_client.fail_on = {"document 1"}
+
+    failed = store.add_documents(texts(3), [{"source": str(i)} for i in range(3)])
+
+    assert failed == [1]
+    assert [doc.content for doc in store.documents] == ["document 0", "document 2"]
+    assert store.documents[1].metadata == {"source": "2"}
+    assert store.index.ntotal == 2
+    assert store.search("document 2", k=1)[0]["content"] == "document 2"
+
+
+def test_corpus_growth_switches_index_type_in_background(store):
+    store.index_type_setting = "auto"
+    store.ann_index_type = "hnsw"
+    store.ann_threshold = 50
+
+    store.add_documents(texts(40))
+    assert store.index_type == "flat"
+    store.add_documents(texts(20, "more"))
+    wait_for_rebuild(store)
+
+    assert store.index_type == "hnsw"
+    assert store.index.ntotal == 60
+    assert store.search("more 3", k=1)[0]["content"] == "more 3"
+
+
+def test_rebuild_is_skipped_while_another_is_running(store):
+    store.index_type_setting = "auto"
+    store.ann_threshold = 25
+    store.add_documents(texts(20))
+
+    with store._rebuild_lock:
+        store.add_documents(texts(5, "next"))
+        wait_for_rebuild(store)
+        # 実行中の再構築があれば新たに始めず、次の追加で改めて判定する
+        assert store.index_type == "flat"
+
+    store.add_documents(texts(1, "more"))
+    wait_for_rebuild(store)
+    assert store.index_type == "hnsw"
+    assert store.index.ntotal == 26
+
+
+def test_ivf_is_retrained_when_corpus_grows(store):
+    store.index_type_setting = "ivf_flat"
+    store.add_documents(texts(100))
+    wait_for_rebuild(store)
+    assert store.index_type == "ivf_flat"
+    assert store.trained_size == 100
+    index = store.index
+
+    store.add_documents(texts(299, "more"))
+    wait_for_rebuild(store)
+    assert store.index is index
+
+    store.add_documents(texts(1, "last"))
+    wait_for_rebuild(store)
+    assert store.index is not index
+    assert store.trained_size == 400
+    assert store.index.ntotal == 400
+
+
+@pytest.mark.parametrize("index_type", ["hnsw", "ivf_flat"])
+def test_rebuild_reconstructs_vectors_from_index(store, index_type):
+    items = texts(150)
+    store.add_documents(items)
+
+    store.rebuild_index(index_type)
+
+    assert store.index_type == index_type
+    assert store._vectors is None
+    assert np.allclose(store._stored_vectors(0, len(items)), expected_vectors(items))
+    assert store.search("document 7", k=1)[0]["content"] == "document 7"
+
+
+def test_lossy_index_keeps_vectors_and_switches_back(store):
+    items = texts(300)
+    store.add_documents(items)
+
+    store.rebuild_index("ivf_pq")
+    assert store._vectors is not None
+    assert np.allclose(store._vectors[:len(items)], expected_vectors(items))
+
+    # IVF-PQの間に追加したベクトルも別に保持する
+    store.add_documents(texts(2, "more"))
+    assert np.allclose(store._stored_vectors(300, 302), expected_vectors(texts(2, "more")))
+
+    store.rebuild_index("flat")
+    assert store._vectors is None
+    assert np.allclose(store._stored_vectors(0, len(items)), expected_vectors(items))
+
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq"])
+def test_snapshot_round_trip_of_trained_index(store, embedding_client, tmp_path, index_type):
+    items = texts(300)
+    store.add_documents(items)
+    store.rebuild_index(index_type)
+    path = str(tmp_path / "snapshot")
+
+    store.save_snapshot(path)
+    restored = DocumentStore(embedding_client, "emb")
+    restored.dimension = embedding_client.dimension
+    assert restored.load_snapshot(path)
+
+    assert restored.index_type == index_type
+    assert restored.trained_size == 300
+    assert (restored._vectors is not None) == (index_type == "ivf_pq")
+    assert np.allclose(restored._stored_vectors(0, 300), expected_vectors(items))
+
+
+def test_snapshot_round_trip(store, embedding_client, tmp_path):
+    items = texts(20)
+    store.add_documents(items, [{"i": i} for i in range(20)])
+    path = str(tmp_path / "snapshot")
+
+    store.save_snapshot(path)
+    restored = DocumentStore(embedding_client, "emb")
+    restored.dimension = embedding_client.dimension
+    assert restored.load_snapshot(path)
+
+    assert restored.index.ntotal == 20
+    assert restored.documents[5].content == "document 5"
+    assert restored.documents[5].metadata == {"i": 5}
+    assert np.allclose(restored._stored_vectors(0, 20), expected_vectors(items))
+
+    # 復元後も差分追加できる
+    restored.add_documents(["new document"])
+    assert restored.index.ntotal == 21
+
+
+def test_snapshot_replaces_previous_snapshot(store, embedding_client, tmp_path):
+    path = str(tmp_path / "snapshot")
+    store.add_documents(texts(2))
+    store.save_snapshot(path)
+    store.add_documents(texts(1, "more"))
+    store.save_snapshot(path)
+
+    restored = DocumentStore(embedding_client, "emb")
+    restored.dimension = embedding_client.dimension
+    assert restored.load_snapshot(path)
+    assert restored.index.ntotal == 3
+    assert not (tmp_path / ("snapshot" + agentic_router.SNAPSHOT_PREVIOUS_SUFFIX)).exists()
+
+
+def test_snapshot_falls_back_to_previous_when_replace_was_interrupted(store, embedding_client, tmp_path):
+    path = str(tmp_path / "snapshot")
+    store.add_documents(texts(2))
+    store.save_snapshot(path)
+    # 以前のスナップショットを退避した直後に停止した状態
+    (tmp_path / "snapshot").rename(tmp_path / ("snapshot" + agentic_router.SNAPSHOT_PREVIOUS_SUFFIX))
+
+    restored = DocumentStore(embedding_client, "emb")
+    restored.dimension = embedding_client.dimension
+    assert restored.load_snapshot(path)
+    assert restored.index.ntotal == 2
+
+
+def test_snapshot_with_other_embedding_model_is_not_loaded(store, embedding_client, tmp_path):
+    store.add_documents(texts(3))
+    path = str(tmp_path / "snapshot")
+    store.save_snapshot(path)
+
+    other = DocumentStore(embedding_client, "other-emb")
+    other.dimension = embedding_client.dimension
+    assert not other.load_snapshot(path)
+    assert other.documents == []
+
+
+def test_missing_snapshot_is_not_loaded(store, tmp_path):
+    assert not store.load_snapshot(str(tmp_path / "missing"))
+
+
+def test_repeated_query_uses_cached_embedding(store, embedding_client):
+    store.query_cache = agentic_router.EmbeddingCache(max_entries=10, ttl_seconds=60, max_bytes=1 << 20)
+    store.add_documents(texts(3))
+    calls = embedding_client.calls
+
+    store.search("document 1", k=1)
+    store.search(" document 1 ", k=1)
+
+    assert embedding_client.calls == calls + 1
+
+
+def test_retrieval_context_embeds_and_searches_once(store, embedding_client, monkeypatch):
+    store.add_documents(texts(10))
+    calls = embedding_client.calls
+    searches = []
+    search_by_vector = store.search_by_vector
+
+    def counting_search(*args, **kwargs):
+        searches.append(args)
+        return search_by_vector(*args, **kwargs)
+
+    monkeypatch.setattr(store, "search_by_vector", counting_search)
+    retrieval = agentic_router.RetrievalContext(store, "document 4", k=5)
+
+    top3 = retrieval.search(3)
+    top5 = retrieval.search(5)
+
+    assert embedding_client.calls == calls + 1
+    assert len(searches) == 1
+    assert top3 == top5[:3]
+    assert top3[0]["content"] == "document 4"
+
+
+def test_search_does_not_hold_store_lock(store, monkeypatch):
+    store.add_documents(texts(3))
+    index = store.index
+    locked_during_search = []
+
+    class CheckingIndex:
+        ntotal = index.ntotal
+
+        def search(self, *args):
+            locked_during_search.append(store._lock.locked())
+            return index.search(*args)
+
+    monkeypatch.setattr(store, "index", CheckingIndex())
+
+    assert store.search("document 1", k=1)[0]["content"] == "document 1"
+    assert locked_during_search == [False]
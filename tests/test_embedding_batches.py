@@ -0,0 +1,41 @@
+import numpy as np
+
+from embedding_batches import EMBEDDING_MAX_INPUT_TOKENS, embed_texts, make_batches
+from fakes import fake_embedding
+from tokenizer import count_tokens
+
+
+def test_make_batches_respects_size_and_token_limits():
+    assert make_batches([1, 1, 1, 1, 1], batch_size=2, batch_max_tokens=100) == [[0, 1], [2, 3], [4]]
+    assert make_batches([60, 50, 10, 100], batch_size=10, batch_max_tokens=100) == [[0], [1, 2], [3]]
+
+
+def test_embed_texts_keeps_input_order(embedding_client):
+    texts = [f"text {i}" for i in range(5)]
+
+    embeddings = embed_texts(embedding_client, "emb", texts, batch_size=2, batch_max_tokens=1000, max_workers=2)
+
+    assert embedding_client.calls == 3
+    for text, embedding in zip(texts, embeddings):
+        assert np.allclose(embedding, fake_embedding(text, embedding_client.dimension))
+
+
+def test_failed_batch_returns_none_only_for_its_texts(embedding_client):
+    embedding_client.fail_on = {"text 2"}
+    texts = [f"text {i}" for i in range(4)]
+
+    embeddings = embed_texts(embedding_client, "emb", texts, batch_size=2, batch_max_tokens=1000, max_workers=1)
+
+    assert [embedding is None for embedding in embeddings] == [False, False, True, True]
+
+
+def test_oversized_text_is_truncated_instead_of_failing(embedding_client):
+    long_text = "word " * (EMBEDDING_MAX_INPUT_TOKENS * 2)
+
+    embeddings = embed_texts(
+        embedding_client, "emb", ["short", long_text], batch_size=10, batch_max_tokens=10 ** 6, max_workers=1
+    )
+
+    assert all(embedding is not None for embedding in embeddings)
+    sent = [text for batch in embedding_client.inputs for text in batch]
+    assert max(count_tokens(text) for text in sent) <= EMBEDDING_MAX_INPUT_TOKENS
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import function_app
+
+
+class FakeRequest:
+    """FastAPI拡張のRequestのうちハンドラーが使う部分"""
+
+    def __init__(self, body):
+        self._body = body
+
+    async def json(self):
+        if isinstance(self._body, str):
+            return json.loads(self._body)
+        return self._body
+
+
+def call(function, body=None):
+    handler = function._function.get_user_function()
+    return asyncio.run(handler(FakeRequest(body if body is not None else {})))
+
+
+def response_json(response):
+    return json.loads(response.body)
+
+
+@pytest.fixture
+def app_agent(monkeypatch, rag):
+    monkeypatch.setattr(function_app, "_agent", rag)
+    return rag
+
+
+def test_load_documents_returns_207_with_failed_indices(app_agent, openai_client):
+    app_agent.document_store.embedding_batch_size = 1
+    openai_client.fail_on = {"bad"}
+
+    response = call(function_app.load_documents_function, {"texts": ["good", "bad", "also good"]})
+
+    assert response.status_code == 207
+    assert response_json(response)["status"] == "partial"
+    assert response_json(response)["loaded"] == 2
+    assert response_json(response)["failed"] == [1]
+
+
+def test_load_documents_returns_500_when_nothing_loaded(app_agent, openai_client):
+    openai_client.fail_on = {"bad"}
+
+    response = call(function_app.load_documents_function, {"texts": ["bad"]})
+
+    assert response.status_code == 500
+    assert response_json(response)["failed"] == [0]
+
+
+def test_chat_runs_async_pipeline(app_agent):
+    app_agent.load_documents_from_texts(["alpha", "beta"])
+
+    response = call(function_app.chat_function, {"message": "alpha", "include_timings": True})
+
+    body = response_json(response)
+    assert response.status_code == 200
+    assert body["status"] == "success"
+    assert body["answer"] == "テストの回答です"
+    assert body["tools_used"] == ["semantic_search"]
+    assert "timings" in body
+
+
+def test_chat_rejects_missing_message(app_agent):
+    response = call(function_app.chat_function, {})
+    assert response.status_code == 400
+
+
+def test_agent_initialization_does_not_block_event_loop(monkeypatch, rag):
+    monkeypatch.setattr(function_app, "_agent", None)
+
+    def slow_init():
+        time.sleep(0.2)
+        return rag
+
+    monkeypatch.setattr(function_app, "get_router_agent", slow_init)
+
+    async def main():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        agents = await asyncio.gather(function_app.get_initialized_agent(), function_app.get_initialized_agent())
+        ticker.cancel()
+        return agents, ticks
+
+    agents, ticks = asyncio.run(main())
+
+    assert agents == [rag, rag]
+    assert ticks > 5
+
+
+def stream_events(body):
+    handler = function_app.chat_stream_function._function.get_user_function()
+
+    async def run():
+        response = await handler(FakeRequest(body))
+        lines = [chunk async for chunk in response.body_iterator]
+        return response, [json.loads(line) for line in "".join(lines).splitlines()]
+
+    return asyncio.run(run())
+
+
+def test_chat_stream_returns_ndjson_events(app_agent):
+    app_agent.load_documents_from_texts(["alpha", "beta"])
+
+    response, events = stream_events({"message": "alpha"})
+
+    assert response.media_type == "application/x-ndjson"
+    kinds = [event["event"] for event in events]
+    assert kinds[0] == "intent"
+    assert "tool" in kinds
+    assert kinds[-1] == "done"
+    answer = "".join(event["content"] for event in events if event["event"] == "token")
+    assert answer == "テストの回答です"
+    assert events[-1]["answer"] == answer
+    assert events[-1]["status"] == "success"
+
+
+def test_chat_stream_rejects_missing_message(app_agent):
+    response = call(function_app.chat_stream_function, {})
+    assert response.status_code == 400
@@ -0,0 +1,75 @@
+from agent_rag import MicrosoftAgent, compact_tool_output
+from tokenizer import count_tokens
+
+
+def long_output(word, blocks=3):
+    return "\n\n".join(f"{word} {i} " + "detail " * 100 for i in range(blocks))
+
+
+def turn(call_id, content):
+    return [
+        {"role": "assistant", "content": None, "tool_calls": [
+            {"id": call_id, "type": "function", "function": {"name": "search", "arguments": "{}"}}
+        ]},
+        {"role": "tool", "tool_call_id": call_id, "content": content},
+    ]
+
+
+def history():
+    return [
+        {"role": "system", "content": "system"},
+        {"role": "user", "content": "question"},
+        *turn("1", long_output("first")),
+        *turn("2", long_output("second")),
+        *turn("3", long_output("latest")),
+    ]
+
+
+def make_agent(max_tokens, compacted_tokens=30):
+    agent = MicrosoftAgent(None, "gpt", [], "system")
+    agent.history_max_tokens = max_tokens
+    agent.compacted_tool_tokens = compacted_tokens
+    return agent
+
+
+def total_tokens(agent, messages):
+    return sum(agent._message_tokens(message) for message in messages)
+
+
+def test_history_under_threshold_is_unchanged():
+    messages = history()
+    agent = make_agent(10 ** 6)
+
+    total = agent._compact_history(messages, set())
+
+    assert messages == history()
+    assert total == total_tokens(agent, messages)
+
+
+def test_oldest_tool_outputs_are_compacted_first_and_latest_turn_is_kept():
+    messages = history()
+    tool_tokens = count_tokens(long_output("first"))
+    # 最も古いツール出力を圧縮すれば収まる上限
+    agent = make_agent(total_tokens(make_agent(0), messages) - tool_tokens + 40)
+    compacted = set()
+
+    total = agent._compact_history(messages, compacted)
+
+    assert compacted == {3}
+    assert messages[3]["content"] == compact_tool_output(long_output("first"), 30)
+    assert messages[3]["content"].startswith("first 0")
+    assert "first 2" in messages[3]["content"]
+    assert messages[5]["content"] == long_output("second")
+    assert total == total_tokens(agent, messages) <= agent.history_max_tokens
+
+
+def test_latest_turn_is_not_compacted_even_over_threshold():
+    messages = history()
+    agent = make_agent(1)
+    compacted = set()
+
+    agent._compact_history(messages, compacted)
+    agent._compact_history(messages, compacted)
+
+    assert compacted == {3, 5}
+    assert messages[7]["content"] == long_output("latest")
@@ -0,0 +1,28 @@
+import numpy as np
+
+from agentic_router import LocalIntentClassifier, QueryIntent
+
+
+def test_rules_only_accept_a_single_match():
+    classifier = LocalIntentClassifier()
+    assert classifier.classify_by_rules("この資料を要約して") == QueryIntent.SUMMARIZATION
+    assert classifier.classify_by_rules("Azure Functionsとは何ですか") == QueryIntent.FACTUAL_SEARCH
+    assert classifier.classify_by_rules("What is the difference between A and B?") is None
+    assert classifier.classify_by_rules("こんにちは") is None
+
+
+def test_centroids_survive_save_and_load(tmp_path):
+    rng = np.random.default_rng(0)
+    classifier = LocalIntentClassifier()
+    for _ in range(3):
+        classifier.learn(rng.standard_normal(8), QueryIntent.ANALYSIS)
+    classifier.learn(rng.standard_normal(8), QueryIntent.COMPARISON)
+    path = str(tmp_path / "intent_centroids.npz")
+
+    classifier.save(path, "emb")
+    restored = LocalIntentClassifier()
+    assert not restored.load(path, "other-emb")
+    assert restored.load(path, "emb")
+
+    assert restored.sample_counts() == {"analysis": 3, "comparison": 1}
+    assert np.allclose(restored._sums[QueryIntent.ANALYSIS], classifier._sums[QueryIntent.ANALYSIS])
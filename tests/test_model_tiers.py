@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from agentic_router import ModelTiers
+from fakes import AsyncFakeOpenAIClient, FakeOpenAIClient
+
+
+@pytest.fixture
+def tiers(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_SMALL_DEPLOYMENT_NAME", "small-model")
+    monkeypatch.setenv("AZURE_OPENAI_API_VERSION", "2024-10-21")
+    return ModelTiers("large-model")
+
+
+def usage_of(tiers, tier):
+    return tiers.stats()[tier]["usage"]
+
+
+def test_components_use_their_tier(tiers, monkeypatch):
+    assert tiers.deployment("classification") == "small-model"
+    assert tiers.deployment("answer") == "large-model"
+
+    monkeypatch.setenv("ROUTER_TIER_ANSWER", "small")
+    assert ModelTiers("large-model").deployment("answer") == "small-model"
+
+
+def test_non_streamed_usage_is_recorded(tiers):
+    client = tiers.track(FakeOpenAIClient(dimension=64))
+
+    client.chat.completions.create(model="large-model", messages=[])
+
+    usage = usage_of(tiers, "large")
+    assert usage["prompt_tokens"] == 10
+    assert usage["completion_tokens"] == 5
+    assert usage["latency"]["count"] == 1
+    assert usage_of(tiers, "small") == {}
+
+
+def test_streamed_usage_is_recorded_from_final_chunk(tiers):
+    fake = FakeOpenAIClient(dimension=64)
+    client = tiers.track(fake)
+
+    chunks = list(client.chat.completions.create(model="large-model", messages=[], stream=True))
+
+    assert fake.chat_calls[0]["stream_options"] == {"include_usage": True}
+    assert chunks[-1].usage is not None
+    assert usage_of(tiers, "large")["completion_tokens"] == 5
+    assert usage_of(tiers, "large")["latency"]["count"] == 1
+
+
+def test_async_streamed_usage_is_recorded_from_final_chunk(tiers):
+    fake = FakeOpenAIClient(dimension=64)
+    client = tiers.track(AsyncFakeOpenAIClient(fake))
+
+    async def main():
+        stream = await client.chat.completions.create(model="small-model", messages=[], stream=True)
+        return "".join([chunk.choices[0].delta.content async for chunk in stream if chunk.choices])
+
+    assert asyncio.run(main()) == "テストの回答です"
+    assert usage_of(tiers, "small")["prompt_tokens"] == 10
+
+
+def test_old_api_version_streams_without_usage(tiers, monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+    fake = FakeOpenAIClient(dimension=64)
+    client = tiers.track(fake)
+
+    list(client.chat.completions.create(model="large-model", messages=[], stream=True))
+
+    assert "stream_options" not in fake.chat_calls[0]
+    assert usage_of(tiers, "large")["prompt_tokens"] == 0
+    assert usage_of(tiers, "large")["latency"]["count"] == 1
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import pytest
+
+from agentic_router import DocumentStore, MultiHopTool
+from fakes import AsyncFakeOpenAIClient, FakeOpenAIClient
+
+
+def planner(*plans):
+    """呼び出しごとに plans を順に返す（最後の計画は繰り返す）"""
+    calls = []
+
+    def respond(model, messages, kwargs):
+        calls.append(messages)
+        return json.dumps(plans[min(len(calls), len(plans)) - 1])
+
+    return respond
+
+
+@pytest.fixture
+def make_tool(monkeypatch):
+    monkeypatch.setenv("ROUTER_INDEX_TYPE", "flat")
+
+    def make(*plans):
+        client = FakeOpenAIClient(dimension=64, responder=planner(*plans))
+        store = DocumentStore(client, "emb")
+        store.dimension = 64
+        store.add_documents(["東京の人口", "大阪の人口", "名古屋の人口", "札幌の人口"])
+        tool = MultiHopTool(client, "multi", store, AsyncFakeOpenAIClient(client))
+        tool.retrieval_k = 1
+        return tool, client
+
+    return make
+
+
+def test_stops_when_information_is_sufficient(make_tool):
+    tool, client = make_tool({"sufficient": True})
+
+    result = tool.execute("東京の人口")
+
+    assert result["stop_reason"] == "sufficient"
+    assert result["hops"] == 0
+    assert len(client.chat_calls) == 1
+
+
+def test_follow_up_queries_are_searched_until_sufficient(make_tool):
+    tool, _ = make_tool({"sufficient": False, "follow_up_queries": ["大阪の人口"]}, {"sufficient": True})
+
+    result = tool.execute("東京の人口")
+
+    assert result["stop_reason"] == "sufficient"
+    assert result["hops"] == 1
+    assert result["queries"] == ["東京の人口", "大阪の人口"]
+    assert [doc["content"] for doc in result["documents"]] == ["東京の人口", "大阪の人口"]
+
+
+def test_stops_when_only_already_searched_queries_are_proposed(make_tool):
+    tool, _ = make_tool({"sufficient": False, "follow_up_queries": [" 東京の人口 "]})
+
+    result = tool.execute("東京の人口")
+
+    assert result["stop_reason"] == "no_follow_up"
+    assert result["hops"] == 0
+
+
+def test_stops_at_hop_budget(make_tool):
+    tool, client = make_tool(
+        {"sufficient": False, "follow_up_queries": ["大阪の人口"]},
+        {"sufficient": False, "follow_up_queries": ["名古屋の人口"]},
+        {"sufficient": False, "follow_up_queries": ["札幌の人口"]},
+    )
+    tool.max_hops = 2
+
+    result = asyncio.run(tool.aexecute("東京の人口"))
+
+    assert result["stop_reason"] == "hop_budget"
+    assert result["hops"] == 2
+    assert len(client.chat_calls) == 2
+
+
+def test_stops_at_deadline_without_planning(make_tool):
+    tool, client = make_tool({"sufficient": False, "follow_up_queries": ["大阪の人口"]})
+    tool.deadline_seconds = 0
+
+    result = tool.execute("東京の人口")
+
+    assert result["stop_reason"] == "deadline"
+    assert result["success"] is True
+    assert client.chat_calls == []
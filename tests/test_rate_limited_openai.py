@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from openai import APITimeoutError
+
+from rate_limited_openai import (
+    DeploymentPool,
+    _AsyncEndpoint,
+    TokenBucket,
+    _Endpoint,
+    _estimate_embedding_tokens,
+)
+from request_deadline import DeadlineExceeded, deadline_scope
+
+
+def make_pool(tpm=60000, pools=None, max_retries=2):
+    return DeploymentPool(
+        pools=pools or {},
+        default_tpm=tpm,
+        tpm_overrides={},
+        max_retries=max_retries,
+        backoff_base=0.0,
+        backoff_max=0.0
+    )
+
+
+def test_token_bucket_reserve_returns_wait_when_overdrawn():
+    bucket = TokenBucket(60)  # 1秒あたり1
+    now = bucket.updated
+
+    assert bucket.reserve(60, now) == 0.0
+    assert bucket.reserve(2, now) == pytest.approx(2.0)
+    assert bucket.delay(1, now) == pytest.approx(3.0)
+
+
+def test_token_bucket_refund_is_capped_at_capacity():
+    bucket = TokenBucket(100)
+    now = bucket.updated
+    bucket.reserve(50, now)
+
+    bucket.refund(30)
+    assert bucket.tokens == pytest.approx(80)
+    bucket.refund(1000)
+    assert bucket.tokens == pytest.approx(100)
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket(0)
+    assert bucket.unlimited
+    assert bucket.reserve(10 ** 9, bucket.updated) == 0.0
+
+
+def test_pool_spreads_calls_over_deployments():
+    pool = make_pool(pools={"gpt": ["gpt-a", "gpt-b"]})
+
+    names = [pool.acquire("gpt", 100)[0].name for _ in range(4)]
+
+    assert sorted(names) == ["gpt-a", "gpt-a", "gpt-b", "gpt-b"]
+    assert pool.stats() == {"gpt-a": {"calls": 2, "throttled": 0}, "gpt-b": {"calls": 2, "throttled": 0}}
+
+
+def test_pool_prefers_deployment_with_quota_left():
+    pool = make_pool(tpm=1000, pools={"gpt": ["gpt-a", "gpt-b"]})
+
+    first, _ = pool.acquire("gpt", 900)
+    second, wait = pool.acquire("gpt", 900)
+
+    assert first.name != second.name
+    assert wait < 1.0
+
+
+def test_settle_refunds_unused_estimate():
+    pool = make_pool(tpm=1000)
+    deployment, _ = pool.acquire("gpt", 600)
+
+    pool.settle(deployment, 600, 100)
+
+    assert deployment.tokens.tokens == pytest.approx(900, abs=1)
+
+
+def test_endpoint_refunds_reservation_before_retrying():
+    pool = make_pool(tpm=60000)
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        if len(calls) < 3:
+            raise APITimeoutError(request=None)
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=10))
+
+    endpoint = _Endpoint(pool, create, _estimate_embedding_tokens)
+    endpoint.create(model="emb", input=["x" * 500])
+
+    assert len(calls) == 3
+    # 失敗した2回分の予約は戻され、成功した呼び出しの実績だけが消費される
+    assert pool._deployment("emb").tokens.tokens == pytest.approx(60000 - 10, abs=1)
+
+
+def test_endpoint_gives_up_after_max_retries():
+    pool = make_pool(max_retries=1)
+
+    def create(**kwargs):
+        raise APITimeoutError(request=None)
+
+    with pytest.raises(APITimeoutError):
+        _Endpoint(pool, create, _estimate_embedding_tokens).create(model="emb", input=["x"])
+
+
+def test_endpoint_does_not_call_after_deadline():
+    pool = make_pool()
+    calls = []
+
+    with deadline_scope(0.0):
+        with pytest.raises(DeadlineExceeded):
+            _Endpoint(pool, lambda **kwargs: calls.append(kwargs), _estimate_embedding_tokens).create(
+                model="emb", input=["x"]
+            )
+
+    assert calls == []
+
+
+def test_async_endpoint_passes_remaining_time_as_timeout():
+    pool = make_pool()
+    seen = []
+
+    async def create(**kwargs):
+        seen.append(kwargs)
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=1))
+
+    async def main():
+        with deadline_scope(30):
+            await _AsyncEndpoint(pool, create, _estimate_embedding_tokens).create(model="emb", input=["x"])
+
+    asyncio.run(main())
+    assert 0 < seen[0]["timeout"] <= 30
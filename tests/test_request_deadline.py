@@ -0,0 +1,80 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from request_deadline import (
+    DeadlineExceeded,
+    current_deadline,
+    deadline_scope,
+    degrade,
+    degraded_reasons,
+    remaining_seconds,
+    submit_with_context,
+    timeout_kwargs,
+)
+
+
+def test_no_deadline_outside_scope():
+    assert current_deadline() is None
+    assert remaining_seconds() is None
+    assert remaining_seconds(5) == 5
+    assert timeout_kwargs() == {}
+    degrade("ignored")
+    assert degraded_reasons() == []
+
+
+def test_remaining_time_is_capped():
+    with deadline_scope(10) as deadline:
+        assert current_deadline() is deadline
+        assert 9 < remaining_seconds() <= 10
+        assert remaining_seconds(3) == 3
+        assert timeout_kwargs(3) == {"timeout": 3}
+    assert current_deadline() is None
+
+
+def test_nested_scope_reuses_outer_deadline():
+    with deadline_scope(10) as outer:
+        with deadline_scope(1) as inner:
+            assert inner is outer
+
+
+def test_expired_deadline_raises_on_check():
+    with deadline_scope(0.01) as deadline:
+        time.sleep(0.02)
+        assert deadline.expired()
+        assert remaining_seconds() == 0.0
+        with pytest.raises(DeadlineExceeded):
+            deadline.check()
+
+
+def test_degrade_records_each_reason_once():
+    with deadline_scope(10):
+        degrade("tool_timeout:search")
+        degrade("tool_timeout:search")
+        degrade("multi_hop")
+        assert degraded_reasons() == ["tool_timeout:search", "multi_hop"]
+
+
+def test_submit_with_context_carries_deadline_to_thread():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with deadline_scope(10) as deadline:
+            assert submit_with_context(executor, current_deadline).result() is deadline
+        # コンテキストを渡さなければスレッドからは見えない
+        assert executor.submit(current_deadline).result() is None
+
+
+def test_deadline_is_visible_in_tasks_and_to_thread():
+    async def read():
+        return current_deadline()
+
+    async def main():
+        with deadline_scope(10) as deadline:
+            in_task = await asyncio.create_task(read())
+            in_thread = await asyncio.to_thread(current_deadline)
+            return deadline, in_task, in_thread
+
+    deadline, in_task, in_thread = asyncio.run(main())
+    assert in_task is deadline
+    assert in_thread is deadline
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from agentic_router import KnowledgeTool, StageTimings
+
+
+class FakeTool(KnowledgeTool):
+    """指定時間待ってから結果を返す（errorがあれば送出する）ツール"""
+
+    retrieval_k = 0
+
+    def __init__(self, name, delay=0.0, error=None):
+        super().__init__(name=name, description=name)
+        self.delay = delay
+        self.error = error
+
+    def execute(self, query, context=None):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {"success": True, "message": self.name}
+
+    async def aexecute(self, query, context=None):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return {"success": True, "message": self.name}
+
+
+def install_tools(agent, *tools):
+    agent.tools = {tool.name: tool for tool in tools}
+    agent.answer_reserve = 0
+    agent.tool_timeout = 0.2
+    return [tool.name for tool in tools]
+
+
+def test_tools_run_in_parallel_and_keep_selection_order(rag):
+    agent = rag.agent
+    names = install_tools(agent, FakeTool("first", delay=0.1), FakeTool("second", delay=0.1), FakeTool("third"))
+    timings = StageTimings()
+
+    started = time.monotonic()
+    results = agent._execute_tools("q", names, {}, timings)
+
+    assert time.monotonic() - started < 0.19
+    assert [r["tool"] for r in results] == names
+    assert all(r["result"]["success"] for r in results)
+    assert set(timings.finish()) >= {"tool.first", "tool.second", "tool.third"}
+
+
+def test_slow_and_failing_tools_degrade_to_failed_results(rag):
+    agent = rag.agent
+    names = install_tools(agent, FakeTool("slow", delay=1.0), FakeTool("broken", error=RuntimeError("boom")), FakeTool("ok"))
+
+    started = time.monotonic()
+    results = {r["tool"]: r["result"] for r in agent._execute_tools("q", names, {}, StageTimings())}
+
+    assert time.monotonic() - started < 0.5
+    assert results["slow"]["success"] is False
+    assert "タイムアウト" in results["slow"]["message"]
+    assert results["broken"] == {"success": False, "message": "ツール実行エラー: boom"}
+    assert results["ok"]["success"] is True
+
+
+def test_async_tools_time_out_independently(rag):
+    agent = rag.agent
+    names = install_tools(agent, FakeTool("slow", delay=1.0), FakeTool("ok", delay=0.05))
+
+    results = asyncio.run(agent._aexecute_tools("q", names, {}, StageTimings()))
+
+    assert [r["tool"] for r in results] == names
+    assert results[0]["result"]["success"] is False
+    assert results[1]["result"]["success"] is True
+
+
+def test_speculative_retrieval_runs_when_a_slot_is_free(rag, monkeypatch):
+    rag.load_documents_from_texts(["alpha", "beta"])
+    agent = rag.agent
+    prefetched = []
+    prefetch = agent._prefetch
+
+    def recording_prefetch(retrieval):
+        prefetched.append(retrieval)
+        prefetch(retrieval)
+
+    monkeypatch.setattr(agent, "_prefetch", recording_prefetch)
+
+    result = agent.route("alpha")
+
+    assert result["answer"] == "テストの回答です"
+    assert len(prefetched) == 1
+    # 使い終わった枠は返却される
+    assert agent._prefetch_slots.acquire(blocking=False)
+
+
+def test_speculative_retrieval_is_skipped_when_pool_is_busy(rag, monkeypatch):
+    rag.load_documents_from_texts(["alpha", "beta"])
+    agent = rag.agent
+    prefetched = []
+    monkeypatch.setattr(agent, "_prefetch", prefetched.append)
+    while agent._prefetch_slots.acquire(blocking=False):
+        pass
+
+    result = agent.route("alpha")
+
+    # 先行検索なしでもツール実行時に検索される
+    assert prefetched == []
+    assert result["tool_results"][0]["result"]["documents"][0]["content"] == "alpha"
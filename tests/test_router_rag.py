@@ -0,0 +1,32 @@
+def test_load_documents_reports_partial_failure(rag, openai_client):
+    rag.document_store.embedding_batch_size = 1
+    openai_client.fail_on = {"bad"}
+
+    result = rag.load_documents_from_texts(["good", "bad"])
+
+    assert result["success"] is False
+    assert result["loaded"] == 1
+    assert result["failed"] == [1]
+    assert len(rag.document_store.documents) == 1
+
+
+def test_load_documents_reports_success(rag):
+    result = rag.load_documents_from_texts(["a", "b"])
+    assert result == {"success": True, "loaded": 2, "failed": [], "message": "2個のドキュメントをロードしました"}
+
+
+def test_repeated_question_is_answered_from_cache_until_documents_change(rag, openai_client):
+    rag.load_documents_from_texts(["alpha", "beta"])
+
+    first = rag.query("alpha")
+    chat_calls = len(openai_client.chat_calls)
+    second = rag.query("alpha")
+
+    assert not first.get("cached")
+    assert second["cached"] is True
+    assert second["answer"] == first["answer"]
+    assert len(openai_client.chat_calls) == chat_calls
+
+    # ドキュメントを追加するとキャッシュは使わない
+    rag.load_documents_from_texts(["gamma"])
+    assert not rag.query("alpha").get("cached")
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from agentic_router import SingleFlight
+from request_deadline import deadline_scope, degraded_reasons
+
+
+def test_do_shares_result_between_concurrent_callers():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", work)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("k", work))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert all(result == "result" for result, _ in results)
+    assert flight.stats()["executions"] == 1
+    assert flight.stats()["shared"] == 3
+
+
+def test_do_propagates_error_and_runs_again_after_completion():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        flight.do("k", fail)
+    assert flight.do("k", lambda: 1) == (1, False)
+
+
+def test_ado_shares_result():
+    flight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*[flight.ado("k", work) for _ in range(4)])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert [shared for _, shared in results] == [False, True, True, True]
+    assert flight.stats() == {"executions": 1, "shared": 3, "shared_rate": 0.75}
+
+
+def test_ado_leader_cancellation_does_not_fail_followers():
+    flight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        leader = asyncio.create_task(flight.ado("k", work))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.ado("k", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == ("result", True)
+
+
+def test_ado_propagates_error_to_all_callers():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def main():
+        return await asyncio.gather(*[flight.ado("k", fail) for _ in range(2)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_do_follower_runs_itself_when_its_deadline_expires():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "leader"
+
+    leader = threading.Thread(target=flight.do, args=("k", slow))
+    leader.start()
+    started.wait(5)
+    try:
+        with deadline_scope(0.05):
+            began = time.monotonic()
+            result = flight.do("k", lambda: "follower")
+            reasons = degraded_reasons()
+    finally:
+        release.set()
+        leader.join(5)
+
+    assert result == ("follower", False)
+    assert time.monotonic() - began < 1
+    assert reasons == ["coalesce_wait_timeout"]
+
+
+def test_ado_follower_runs_itself_when_its_deadline_expires():
+    flight = SingleFlight()
+
+    async def slow():
+        await asyncio.sleep(0.5)
+        return "leader"
+
+    async def fast():
+        return "follower"
+
+    async def follow():
+        with deadline_scope(0.05):
+            return await flight.ado("k", fast)
+
+    async def main():
+        leader = asyncio.create_task(flight.ado("k", slow))
+        await asyncio.sleep(0)
+        follower = await follow()
+        return await leader, follower
+
+    assert asyncio.run(main()) == (("leader", False), ("follower", False))
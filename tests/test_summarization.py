@@ -0,0 +1,63 @@
+import asyncio
+
+from agentic_router import SummarizationTool
+from fakes import AsyncFakeOpenAIClient, FakeOpenAIClient
+
+
+def summary_responder(model, messages, kwargs):
+    return f"{model}:{messages[-1]['content'][:3]}"
+
+
+def make_tool(client, chunk_tokens=20):
+    tool = SummarizationTool(client, "large", async_client=AsyncFakeOpenAIClient(client), map_deployment_name="small")
+    tool.chunk_tokens = chunk_tokens
+    return tool
+
+
+def test_no_documents_is_reported_without_calling_the_model():
+    client = FakeOpenAIClient(dimension=64)
+    tool = make_tool(client)
+
+    result = tool.execute("要約して", {})
+    async_result = asyncio.run(tool.aexecute("要約して", {}))
+
+    assert result == {"success": False, "message": "要約するドキュメントが見つかりませんでした"}
+    assert async_result == result
+    assert client.chat_calls == []
+
+
+def test_map_uses_small_deployment_and_final_uses_large():
+    client = FakeOpenAIClient(dimension=64, responder=summary_responder)
+    tool = make_tool(client)
+    text = "a" * 30 + "b" * 30
+
+    result = tool.execute("要約して", {"text": text})
+
+    models = [call["model"] for call in client.chat_calls]
+    assert models[:-1] == ["small"] * (len(models) - 1)
+    assert models[-1] == "large"
+    assert result["success"] is True
+    assert result["summary"].startswith("large:")
+    assert result["reduce_levels"] >= 1
+
+
+def test_partial_summaries_are_cached_but_final_is_not():
+    client = FakeOpenAIClient(dimension=64, responder=summary_responder)
+    tool = make_tool(client)
+    text = "a" * 30 + "b" * 30
+
+    tool.execute("要約して", {"text": text})
+    calls = len(client.chat_calls)
+    asyncio.run(tool.aexecute("要約して", {"text": text}))
+
+    assert [call["model"] for call in client.chat_calls[calls:]] == ["large"]
+
+
+def test_short_text_is_summarized_in_one_call():
+    client = FakeOpenAIClient(dimension=64, responder=summary_responder)
+    tool = make_tool(client, chunk_tokens=1000)
+
+    result = tool.execute("要約して", {"text": "short"})
+
+    assert [call["model"] for call in client.chat_calls] == ["large"]
+    assert result["reduce_levels"] == 0
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+from agent_rag import AgentTool, MicrosoftAgent, ToolError, ToolResultMemo
+
+
+def test_key_normalizes_whitespace_and_case():
+    memo = ToolResultMemo()
+    assert memo.key("search", {"query": "  Azure   Functions "}) == memo.key("search", {"query": "azure functions"})
+    assert memo.key("search", {"query": "a"}) != memo.key("other", {"query": "a"})
+
+
+def test_get_counts_hits_and_misses():
+    memo = ToolResultMemo()
+    key = memo.key("search", {"query": "a"})
+    assert memo.get(key) is None
+    memo.put(key, "result")
+    assert memo.get(key) == "result"
+    assert memo.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+class CountingTool(AgentTool):
+    def __init__(self, fail=False):
+        super().__init__(name="search", description="")
+        self.fail = fail
+        self.calls = 0
+
+    def execute(self, query: str) -> str:
+        self.calls += 1
+        if self.fail:
+            raise ToolError("検索に失敗しました")
+        return f"result for {query}"
+
+
+def tool_call(query):
+    return SimpleNamespace(function=SimpleNamespace(name="search", arguments=f'{{"query": "{query}"}}'))
+
+
+def test_agent_reuses_successful_results():
+    tool = CountingTool()
+    agent = MicrosoftAgent(None, "gpt", [tool], "system")
+    memo = ToolResultMemo()
+
+    first = agent._execute_tool_calls([tool_call("a"), tool_call(" A ")], memo)
+    second = agent._execute_tool_calls([tool_call("a")], memo)
+
+    assert tool.calls == 1
+    assert first == ["result for a", "result for a"]
+    assert second == ["result for a"]
+
+
+def test_agent_does_not_memoize_failures():
+    tool = CountingTool(fail=True)
+    agent = MicrosoftAgent(None, "gpt", [tool], "system")
+    memo = ToolResultMemo()
+
+    assert agent._execute_tool_calls([tool_call("a")], memo) == ["検索に失敗しました"]
+    agent._execute_tool_calls([tool_call("a")], memo)
+
+    assert tool.calls == 2
+    assert memo.stats()["entries"] == 0
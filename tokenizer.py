@@ -0,0 +1,56 @@
+"""
+トークン数の計算（cl100k_base）
+
+- プロンプトの予算管理・テキストの切り詰めや分割・クォータの見積もりで共通に使う
+- トークナイザはプロセスで1回だけロードし、取得できない場合（オフライン環境など）は文字数で代用する
+"""
+
+import logging
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def _get_encoding() -> Optional["tiktoken.Encoding"]:
+    """トークナイザを取得（初回のみロード、取得できない場合はNone）"""
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken encoding load failed: {str(e)}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """テキストのトークン数を数える"""
+    encoding = _get_encoding()
+    if encoding is None:
+        # トークナイザが使えない場合は文字数で多めに見積もる
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """テキストを先頭からmax_tokensトークン以内に切り詰める"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def split_to_tokens(text: str, max_tokens: int) -> List[str]:
+    """テキストをmax_tokensトークン以内の断片に分割"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return [text[i:i + max_tokens] for i in range(0, len(text), max_tokens)] or [text]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return [text]
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]